@@ -1,4 +1,5 @@
 import numpy as NP
+from functools import lru_cache
 
 """
 A module which implements the continuous wavelet transform
@@ -29,6 +30,10 @@ DOG4       : 4th Derivative Of Gaussian
 Haar       : Unnormalised version of continuous Haar transform
 HaarW      : Normalised Haar
 
+Functions:
+filter_bank : cached Fourier domain wavelet bank for (wavelet, ndata, scales, order)
+cwt_batch   : all scales of many channels in one batched fft, optionally chunked
+
 Usage e.g.
 wavelet=Morlet(data, largestscale=2, notes=0, order=2, scaling="log")
  data:  Numeric array of data (float), with length ndata.
@@ -68,6 +73,7 @@ updates:
 (25/07/08): log and lin scale increment in same direction!
             swap indices in 2-d coeffiecient matrix
             explicit scaling of scale axis
+            python 3, vectorised wf, cached filter bank, cwt_batch
 """
 
 class Cwt:
@@ -76,10 +82,13 @@ class Cwt:
     Implements cwt via the Fourier transform
     Used by subclass which provides the method wf(self,s_omega)
     wf is the Fourier transform of the wavelet function.
+    support is the half width of the wavelet in units of scale, beyond which
+    less than ~1e-4 of the wavelet's envelope lies (used to pad chunks in cwt_batch).
     Returns an instance.
     """
 
     fourierwl=1.00
+    support=4.0
 
     def _log2(self, x):
         # utility function to return (integer) log2
@@ -102,24 +111,34 @@ class Cwt:
         self.order=order
         self.scale=largestscale
         self._setscales(ndata,largestscale,notes,scaling)
-        self.cwt= NP.zeros((self.nscale,ndata), NP.complex64)
-        omega= NP.array(range(0,ndata/2)+range(-ndata/2,0))*(2.0*NP.pi/ndata)
         datahat=NP.fft.fft(data)
         self.fftdata=datahat
-        #self.psihat0=self.wf(omega*self.scales[3*self.nscale/4])
-        # loop over scales and compute wvelet coeffiecients at each scale
-        # using the fft to do the convolution
-        for scaleindex in range(self.nscale):
-            currentscale=self.scales[scaleindex]
-            self.currentscale=currentscale  # for internal use
-            s_omega = omega*currentscale
-            psihat=self.wf(s_omega)
-            psihat = psihat *  NP.sqrt(2.0*NP.pi*currentscale)
-            convhat = psihat * datahat
-            W    = NP.fft.ifft(convhat)
-            self.cwt[scaleindex,0:ndata] = W
+        # all scales at once: one product with the (cached) filter bank and one ifft along the time axis
+        psihat=filter_bank(type(self),ndata,self.scales,order)
+        self.cwt=NP.fft.ifft(psihat*datahat,axis=-1).astype(NP.complex64)
         return
 
+    @classmethod
+    def _bank(cls, ndata, scales, order=2):
+        """
+        Fourier transform of the wavelet at every scale, (nscales,ndata) array.
+        The scales are broadcast down the first axis so wf is evaluated once for the whole bank.
+        """
+        scales=NP.asarray(scales,float)[:,NP.newaxis]
+        wavelet=cls.__new__(cls)
+        wavelet.order=order
+        wavelet.currentscale=scales  # for internal use
+        omega=NP.fft.fftfreq(ndata)*(2.0*NP.pi)
+        s_omega=omega*scales
+        psihat=wavelet.wf(s_omega)
+        return psihat*NP.sqrt(2.0*NP.pi*scales)
+
+    @classmethod
+    def _support(cls, order=2):
+        wavelet=cls.__new__(cls)
+        wavelet.order=order
+        return wavelet.support
+
     def _setscales(self,ndata,largestscale,notes,scaling):
         """
         if notes non-zero, returns a log scale based on notes per ocave
@@ -171,11 +190,9 @@ class Morlet(Cwt):
     """
     _omega0=5.0
     fourierwl=4* NP.pi/(_omega0+ NP.sqrt(2.0+_omega0**2))
+    support=4.5
     def wf(self, s_omega):
-        H= NP.ones(len(s_omega))
-        n=len(s_omega)
-        for i in range(len(s_omega)):
-            if s_omega[i] < 0.0: H[i]=0.0
+        H= NP.where(s_omega < 0.0, 0.0, 1.0)
         # !!!! note : was s_omega/8 before 17/6/03
         xhat=0.75112554*( NP.exp(-(s_omega-self._omega0)**2/2.0))*H
         return xhat
@@ -186,11 +203,8 @@ class MorletReal(Cwt):
     """
     _omega0=5.0
     fourierwl=4* NP.pi/(_omega0+ NP.sqrt(2.0+_omega0**2))
+    support=4.5
     def wf(self, s_omega):
-        H= NP.ones(len(s_omega))
-        n=len(s_omega)
-        for i in range(len(s_omega)):
-            if s_omega[i] < 0.0: H[i]=0.0
         # !!!! note : was s_omega/8 before 17/6/03
         xhat=0.75112554*( NP.exp(-(s_omega-self._omega0)**2/2.0)+ NP.exp(-(s_omega+self._omega0)**2/2.0)- NP.exp(-(self._omega0)**2/2.0)+ NP.exp(-(self._omega0)**2/2.0))
         return xhat
@@ -200,10 +214,12 @@ class Paul4(Cwt):
     Paul m=4 wavelet
     """
     fourierwl=4* NP.pi/(2.*4+1.)
+    # the envelope decays as t**-(m+1), so its tail beyond k*scale is ~k**-m/m
+    support=(1.0e4/4)**(1.0/4)
     def wf(self, s_omega):
-        n=len(s_omega)
-        xhat= NP.zeros(n)
-        xhat[0:n/2]=0.11268723*s_omega[0:n/2]**4* NP.exp(-s_omega[0:n/2])
+        n=NP.shape(s_omega)[-1]
+        xhat= NP.zeros(NP.shape(s_omega))
+        xhat[...,0:n//2]=0.11268723*s_omega[...,0:n//2]**4* NP.exp(-s_omega[...,0:n//2])
         #return 0.11268723*s_omega**2*exp(-s_omega)*H
         return xhat
 
@@ -212,10 +228,11 @@ class Paul2(Cwt):
     Paul m=2 wavelet
     """
     fourierwl=4* NP.pi/(2.*2+1.)
+    support=(1.0e4/2)**(1.0/2)
     def wf(self, s_omega):
-        n=len(s_omega)
-        xhat= NP.zeros(n)
-        xhat[0:n/2]=1.1547005*s_omega[0:n/2]**2* NP.exp(-s_omega[0:n/2])
+        n=NP.shape(s_omega)[-1]
+        xhat= NP.zeros(NP.shape(s_omega))
+        xhat[...,0:n//2]=1.1547005*s_omega[...,0:n//2]**2* NP.exp(-s_omega[...,0:n//2])
         #return 0.11268723*s_omega**2*exp(-s_omega)*H
         return xhat
 
@@ -223,16 +240,24 @@ class Paul(Cwt):
     """
     Paul order m wavelet
     """
+    @property
+    def fourierwl(self):
+        return 4* NP.pi/(2.*self.order+1.)
+
+    @property
+    def support(self):
+        # heavy tailed: the envelope decays as t**-(m+1)
+        return (1.0e4/self.order)**(1.0/self.order)
+
     def wf(self, s_omega):
-        Cwt.fourierwl=4* NP.pi/(2.*self.order+1.)
         m=self.order
-        n=len(s_omega)
+        n=NP.shape(s_omega)[-1]
         normfactor=float(m)
         for i in range(1,2*m):
             normfactor=normfactor*i
         normfactor=2.0**m/ NP.sqrt(normfactor)
-        xhat= NP.zeros(n)
-        xhat[0:n/2]=normfactor*s_omega[0:n/2]**m* NP.exp(-s_omega[0:n/2])
+        xhat= NP.zeros(NP.shape(s_omega))
+        xhat[...,0:n//2]=normfactor*s_omega[...,0:n//2]**m* NP.exp(-s_omega[...,0:n//2])
         #return 0.11268723*s_omega**2*exp(-s_omega)*H
         return xhat
 
@@ -241,6 +266,7 @@ class MexicanHat(Cwt):
     2nd Derivative Gaussian (mexican hat) wavelet
     """
     fourierwl=2.0* NP.pi/ NP.sqrt(2.5)
+    support=5.0
     def wf(self, s_omega):
         # should this number be 1/sqrt(3/4) (no pi)?
         #s_omega = s_omega/self.fourierwl
@@ -257,6 +283,7 @@ class DOG4(Cwt):
     but reconstruction seems to work best with +!
     """
     fourierwl=2.0* NP.pi/ NP.sqrt(4.5)
+    support=6.0
     def wf(self, s_omega):
         return s_omega**4* NP.exp(-s_omega**2/2.0)/3.4105319
 
@@ -266,8 +293,9 @@ class DOG1(Cwt):
     but reconstruction seems to work best with +!
     """
     fourierwl=2.0* NP.pi/ NP.sqrt(1.5)
+    support=5.0
     def wf(self, s_omega):
-        dog1= NP.zeros(len(s_omega),NP.complex64)
+        dog1= NP.zeros(NP.shape(s_omega),NP.complex64)
         dog1.imag=s_omega* NP.exp(-s_omega**2/2.0)/NP.sqrt(NP.pi)
         return dog1
 
@@ -276,13 +304,20 @@ class DOG(Cwt):
     Derivative Gaussian wavelet of order m
     but reconstruction seems to work best with +!
     """
+    @property
+    def fourierwl(self):
+        return 2* NP.pi/ NP.sqrt(self.order+0.5)
+
+    @property
+    def support(self):
+        return 4.5+0.5*self.order
+
     def wf(self, s_omega):
         try:
             from scipy.special import gamma
         except ImportError:
             print ("Requires scipy gamma function")
             raise ImportError
-        Cwt.fourierwl=2* NP.pi/ NP.sqrt(self.order+0.5)
         m=self.order
         dog=1.0J**m*s_omega**m* NP.exp(-s_omega**2/2)/ NP.sqrt(gamma(self.order+0.5))
         return dog
@@ -297,10 +332,11 @@ class Haar(Cwt):
     # 2/8/05 constants adjusted to match artem eim
 
     fourierwl=1.0#1.83129  #2.0
+    support=1.0
     def wf(self, s_omega):
-        haar= NP.zeros(len(s_omega),NP.complex64)
-        om = s_omega[:]/self.currentscale
-        om[0]=1.0  #prevent divide error
+        haar= NP.zeros(NP.shape(s_omega),NP.complex64)
+        om = s_omega/self.currentscale
+        om[...,0]=1.0  #prevent divide error
         #haar.imag=4.0*sin(s_omega/2)**2/om
         haar.imag=4.0* NP.sin(s_omega/4)**2/om
         return haar
@@ -315,15 +351,85 @@ class HaarW(Cwt):
     # normalised to unit power
 
     fourierwl=1.83129*1.2  #2.0
+    support=2.0
     def wf(self, s_omega):
-        haar= NP.zeros(len(s_omega),NP.complex64)
-        om = s_omega[:]#/self.currentscale
-        om[0]=1.0  #prevent divide error
+        haar= NP.zeros(NP.shape(s_omega),NP.complex64)
+        om = NP.array(s_omega)#/self.currentscale
+        om[...,0]=1.0  #prevent divide error
         #haar.imag=4.0*sin(s_omega/2)**2/om
         haar.imag=4.0* NP.sin(s_omega/2)**2/om
         return haar
 
 
+@lru_cache(maxsize=32)
+def _cached_bank(wavelet, ndata, scales, order):
+    bank=wavelet._bank(ndata,scales,order)
+    bank.flags.writeable=False
+    return bank
+
+
+def filter_bank(wavelet, ndata, scales, order=2):
+    """
+    Fourier domain filter bank of a wavelet class (Morlet, Paul, DOG, ...)
+    for data of length ndata at the given scales, (nscales,ndata) array.
+    Banks are cached so repeated transforms with the same (ndata, scales, wavelet, order)
+    do not re-evaluate the wavelet. The returned array is read only.
+    """
+    scales=tuple(float(scale) for scale in NP.ravel(scales))
+    return _cached_bank(wavelet,int(ndata),scales,order)
+
+
+def cwt_batch(data, wavelet, scales, order=2, chunk_size=None, pad=None, dtype=NP.complex64):
+    """
+    Continuous wavelet transform of many channels at all scales with one batched fft
+
+    data:       (ndata,) or (nchannels,ndata) array
+    wavelet:    one of the wavelet classes of this module (Morlet, Paul, DOG, MexicanHat, ...)
+    scales:     array of scales (e.g. Cwt.getscales() of a previous transform)
+    order:      order of wavelet for wavelets with variable order
+    chunk_size: None to transform the whole signal in one go, otherwise the number of
+                samples transformed at once (for long signals)
+    pad:        samples of data taken on each side of a chunk to keep the wavelets'
+                support away from the chunk edges, default the wavelet's support
+                times the largest scale
+    dtype:      dtype of the returned coefficients
+
+    Returns (nscales,ndata) or (nchannels,nscales,ndata) array of coefficients.
+    Without chunk_size the result equals Cwt's (circular) transform. In chunked mode the
+    ends of the signal are not wrapped around, so the first and last pad samples differ,
+    and elsewhere the coefficients differ by the part of the wavelets cut off by the pad
+    (~1e-4 of their envelope with the default pad, more with a shorter one).
+    """
+    data=NP.asarray(data)
+    one_d=data.ndim==1
+    if one_d:
+        data=data[NP.newaxis,:]
+    nchannels,ndata=data.shape
+    scales=NP.ravel(scales)
+    result=NP.empty((nchannels,len(scales),ndata),dtype)
+
+    if chunk_size is None or chunk_size>=ndata:
+        psihat=filter_bank(wavelet,ndata,scales,order)
+        datahat=NP.fft.fft(data,axis=-1)
+        result[:]=NP.fft.ifft(psihat*datahat[:,NP.newaxis,:],axis=-1)
+    else:
+        if pad is None:
+            pad=int(NP.ceil(wavelet._support(order)*NP.max(scales)))
+        for start in range(0,ndata,chunk_size):
+            end=min(start+chunk_size,ndata)
+            segment_start=max(start-pad,0)
+            segment_end=min(end+pad,ndata)
+            # the bank is cached, so only the (at most two) differently sized edge segments build a new one
+            psihat=filter_bank(wavelet,segment_end-segment_start,scales,order)
+            datahat=NP.fft.fft(data[:,segment_start:segment_end],axis=-1)
+            W=NP.fft.ifft(psihat*datahat[:,NP.newaxis,:],axis=-1)
+            result[:,:,start:end]=W[:,:,start-segment_start:end-segment_start]
+
+    if one_d:
+        result=result[0]
+    return result
+
+
 if __name__=="__main__":
     import numpy as np
     import pylab as mpl
@@ -0,0 +1,162 @@
+
+"""
+Cross correlograms of spike trains built on sorted spike times.
+
+The spikes of one train that are within lag of each spike of the other are found with searchsorted on the sorted
+times (a sorted merge instead of comparing every spike with every other) and the differences are binned directly
+with bincount.
+"""
+import numpy as np
+
+
+def _default_lag(spike_times_train_1, spike_times_train_2):
+    # the same default as crosscorrelate_spike_trains (10 or 20 mean isis of the smaller train)
+    if spike_times_train_1.size < spike_times_train_2.size:
+        return np.ceil(10 * np.mean(np.diff(spike_times_train_1)))
+    return np.ceil(20 * np.mean(np.diff(spike_times_train_2)))
+
+
+def _window_pairs(spike_times_train_1, spike_times_train_2, lag):
+    """
+    For sorted trains, the indices (i, j) of all pairs with |train_1[i] - train_2[j]| < lag
+    """
+    starts = np.searchsorted(spike_times_train_2, spike_times_train_1 - lag, side='right')
+    ends = np.searchsorted(spike_times_train_2, spike_times_train_1 + lag, side='left')
+    counts = ends - starts
+    first_indices = np.repeat(np.arange(spike_times_train_1.size), counts)
+    offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    second_indices = np.repeat(starts, counts) + offsets
+    return first_indices, second_indices
+
+
+def cross_differences(spike_times_train_1, spike_times_train_2, lag, remove_zero_lag=True):
+    """
+    All the differences spike_times_train_1[i] - spike_times_train_2[j] smaller (in absolute value) than lag.
+    If remove_zero_lag the differences of spikes at the same time are not included (e.g. each spike with itself in
+    an autocorrelogram).
+    """
+    spike_times_train_1 = np.sort(np.ravel(spike_times_train_1))
+    spike_times_train_2 = np.sort(np.ravel(spike_times_train_2))
+    first_indices, second_indices = _window_pairs(spike_times_train_1, spike_times_train_2, lag)
+    differences = spike_times_train_1[first_indices] - spike_times_train_2[second_indices]
+    if remove_zero_lag:
+        differences = differences[differences != 0]
+    return differences
+
+
+def crosscorrelate_spike_trains(spike_times_train_1, spike_times_train_2, lag=None):
+    """
+    Drop in replacement of the crosscorrelate_spike_trains of the GUIs. Returns the differences of spike times within
+    lag (without the zero lag ones) and the normalisation factor sqrt(N1 * N2).
+    """
+    spike_times_train_1 = np.ravel(spike_times_train_1)
+    spike_times_train_2 = np.ravel(spike_times_train_2)
+    if lag is None:
+        lag = _default_lag(spike_times_train_1, spike_times_train_2)
+    differences = cross_differences(spike_times_train_1, spike_times_train_2, lag, remove_zero_lag=True)
+    norm = np.sqrt(spike_times_train_1.size * spike_times_train_2.size)
+    return differences, norm
+
+
+def _bin_differences(differences, lag, number_of_bins):
+    bin_indices = np.floor((differences + lag) * (number_of_bins / (2 * lag))).astype(np.int64)
+    bin_indices = np.clip(bin_indices, 0, number_of_bins - 1)
+    return bin_indices
+
+
+def correlogram(spike_times_train_1, spike_times_train_2, lag, number_of_bins=100, remove_zero_lag=True):
+    """
+    Histogram of the differences of the two trains in number_of_bins equal bins between -lag and lag.
+    Returns the counts and the bin edges (like np.histogram).
+    """
+    differences = cross_differences(spike_times_train_1, spike_times_train_2, lag, remove_zero_lag=remove_zero_lag)
+    counts = np.bincount(_bin_differences(differences, lag, number_of_bins), minlength=number_of_bins)
+    return counts, np.linspace(-lag, lag, number_of_bins + 1)
+
+
+def all_pairs_correlograms(spike_times, spike_clusters, lag, number_of_bins=100, clusters=None,
+                           spikes_per_chunk=100000):
+    """
+    The correlograms of all pairs of a set of units in one pass over the sorted spike times.
+
+    spike_times -- the times of all spikes
+    spike_clusters -- the unit of each spike
+    clusters -- the units to use (all the units in spike_clusters if None)
+    spikes_per_chunk -- the pairs of this number of spikes are found and binned at a time
+
+    Returns the (units x units x number_of_bins) counts (element [a, b] is the correlogram of the times of a minus the
+    times of b, the diagonal the autocorrelograms without the zero lags), the units and the bin edges
+    """
+    spike_times = np.ravel(spike_times)
+    spike_clusters = np.ravel(spike_clusters)
+    if clusters is None:
+        clusters = np.unique(spike_clusters)
+    clusters = np.asarray(clusters)
+
+    used = np.in1d(spike_clusters, clusters)
+    order = np.argsort(spike_times[used], kind='stable')
+    times = spike_times[used][order]
+    units = np.searchsorted(np.sort(clusters), spike_clusters[used][order])
+    unit_order = np.argsort(clusters)
+    number_of_units = clusters.size
+
+    counts = np.zeros(number_of_units * number_of_units * number_of_bins, dtype=np.int64)
+    for chunk_start in np.arange(0, times.size, spikes_per_chunk):
+        chunk = slice(chunk_start, min(chunk_start + spikes_per_chunk, times.size))
+        first_indices, second_indices = _window_pairs(times[chunk], times, lag)
+        first_indices += chunk_start
+        differences = times[first_indices] - times[second_indices]
+        # like correlogram(t, t, remove_zero_lag=True): no zero lags (self pairs included) in the autocorrelograms
+        kept = (differences != 0) | (units[first_indices] != units[second_indices])
+        first_indices = first_indices[kept]
+        second_indices = second_indices[kept]
+        bins = _bin_differences(differences[kept], lag, number_of_bins)
+        flat = (units[first_indices] * number_of_units + units[second_indices]) * number_of_bins + bins
+        counts += np.bincount(flat, minlength=counts.size)
+
+    counts = counts.reshape((number_of_units, number_of_units, number_of_bins))
+    # back to the order of the clusters argument
+    inverse = np.empty(number_of_units, dtype=np.int64)
+    inverse[unit_order] = np.arange(number_of_units)
+    counts = counts[inverse][:, inverse]
+    return counts, clusters, np.linspace(-lag, lag, number_of_bins + 1)
+
+
+def shuffle_predictor(spike_times_train, n_pred=1):
+    """
+    n_pred surrogate trains made of randomly permuted isis of the train, each starting at the train's first spike plus
+    an exponentially distributed random time (like the 'shuffle' predictor of pairedcrosscorrelation.crosscorrelate)
+    """
+    spike_times_train = np.sort(np.ravel(spike_times_train))
+    isi = np.diff(spike_times_train)
+    predictors = []
+    for ni in range(n_pred):
+        idx = np.random.permutation(isi.size - 1)
+        predictors.append(np.insert(np.cumsum(isi[idx]), 0, 0) + spike_times_train.min() +
+                          np.random.exponential(isi.mean()))
+    return np.concatenate(predictors)
+
+
+def crosscorrelate(spike_times_train_1, spike_times_train_2, lag=None, n_pred=1, predictor=None):
+    """
+    Same as pairedcrosscorrelation.crosscorrelate: the differences of the two trains within lag (zero lags included),
+    the differences with the shuffled predictor of the larger train (if predictor == 'shuffle', otherwise an empty
+    array) and the normalisation factor.
+    """
+    assert predictor == 'shuffle' or predictor is None, "predictor must be either None or 'shuffle'."
+    spike_times_train_1 = np.ravel(spike_times_train_1)
+    spike_times_train_2 = np.ravel(spike_times_train_2)
+    if lag is None:
+        lag = _default_lag(spike_times_train_1, spike_times_train_2)
+
+    differences = cross_differences(spike_times_train_1, spike_times_train_2, lag, remove_zero_lag=False)
+    pred = np.array([])
+    if predictor == 'shuffle':
+        if spike_times_train_1.size < spike_times_train_2.size:
+            pred = cross_differences(spike_times_train_1, shuffle_predictor(spike_times_train_2, n_pred), lag,
+                                     remove_zero_lag=False)
+        else:
+            pred = -cross_differences(spike_times_train_2, shuffle_predictor(spike_times_train_1, n_pred), lag,
+                                      remove_zero_lag=False)
+    norm = np.sqrt(spike_times_train_1.size * spike_times_train_2.size)
+    return differences, pred, norm
@@ -1,18 +1,21 @@
 __author__ = 'George Dimitriadis'
 
 
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import scipy.signal as signal
 from BrainDataAnalysis import Constants as ct
 
 
 
-def low_pass_filter(data, Fsampling, Fcutoff, filterType='but', filterOrder=None, filterDirection='twopass'):
+def low_pass_filter(data, Fsampling, Fcutoff, filterType='but', filterOrder=None, filterDirection='twopass', use_sos=False):
     """
     Low passes the data at the Fcutoff frequency.
     filterType = ´but´ (butterworth) (default) OR ´fir´
     filterOrder = the order of the filter. For the default butterworth filter it is 6
     filterDirection = FilterDirection which defines whether the filter is passed over the data once (and how) or twice
+    use_sos = if True the butterworth filter is designed and run as second-order sections (numerically stable at high
+    orders)
     """
     Wn = np.float32(Fcutoff / (Fsampling / 2.0))
     if filterType == 'fir':
@@ -22,6 +25,9 @@ def low_pass_filter(data, Fsampling, Fcutoff, filterType='but', filterOrder=None
     else:
         if filterOrder == None:
             filterOrder = 6
+        if use_sos:
+            sos = signal.butter(filterOrder, Wn, btype='lowpass', analog=0, output='sos')
+            return _sos_filter(sos, data, filterDirection)
         (b, a) = signal.butter(filterOrder, Wn, btype='lowpass', analog=0, output='ba')
 
     dims = data.ndim
@@ -40,12 +46,14 @@ def low_pass_filter(data, Fsampling, Fcutoff, filterType='but', filterOrder=None
     return filteredData
 
 
-def high_pass_filter(data, Fsampling, Fcutoff, filterType='but', filterOrder=None, filterDirection='twopass'):
+def high_pass_filter(data, Fsampling, Fcutoff, filterType='but', filterOrder=None, filterDirection='twopass', use_sos=False):
     """
     High passes the data at the Fcutoff frequency.
     filterType = ´but´ (butterworth) (default) OR ´fir´
     filterOrder = the order of the filter. For the default butterworth filter it is 6
     filterDirection = FilterDirection which defines whether the filter is passed over the data once (and how) or twice
+    use_sos = if True the butterworth filter is designed and run as second-order sections (numerically stable at high
+    orders)
     """
     Wn = np.float32(Fcutoff / (Fsampling / 2.0))
     if filterType == 'fir':
@@ -55,6 +63,9 @@ def high_pass_filter(data, Fsampling, Fcutoff, filterType='but', filterOrder=Non
     else:
         if filterOrder == None:
             filterOrder = 6
+        if use_sos:
+            sos = signal.butter(filterOrder, Wn, btype='highpass', analog=0, output='sos')
+            return _sos_filter(sos, data, filterDirection)
         (b, a) = signal.butter(filterOrder, Wn, btype='highpass', analog=0, output='ba')
 
     dims = data.ndim
@@ -73,7 +84,7 @@ def high_pass_filter(data, Fsampling, Fcutoff, filterType='but', filterOrder=Non
     return filteredData
 
 
-def band_iir_filter(data, Fsampling, stopband=[49,51], passband = [47,53], gpass = 1, gstop = 20, filterType='butter', filterDirection='twopass', pad_samples = None, pad_type = None, **pad_kwargs):
+def band_iir_filter(data, Fsampling, stopband=[49,51], passband = [47,53], gpass = 1, gstop = 20, filterType='butter', filterDirection='twopass', pad_samples = None, pad_type = None, use_sos=False, **pad_kwargs):
     """
     High passes the data at the Fcutoff frequency.
     stopband = the inside corner points in Hz
@@ -85,12 +96,16 @@ def band_iir_filter(data, Fsampling, stopband=[49,51], passband = [47,53], gpass
     filterDirection = FilterDirection which defines whether the filter is passed over the data once (and how) or twice
     pad_samples = the number of samples to pad with at each side (if None and pad_type is not None then default pad_samples = np.shape(data)[-1])
     pad_type = the type of paddding (see numpy.pad's mode for more info)
+    use_sos = if True the filter is designed and run as second-order sections (numerically stable at high orders)
     pad_kwargs = extra padding arguments (see numpy.pad for more info
     """
     ws = [np.float(x / (Fsampling / 2.0)) for x in stopband]
     wp = [np.float(x / (Fsampling / 2.0)) for x in passband]
 
-    (b, a) = signal.iirdesign(ws = ws, wp = wp, gpass = gpass, gstop = gstop,  ftype  = filterType, output='ba')
+    if use_sos:
+        sos = signal.iirdesign(ws = ws, wp = wp, gpass = gpass, gstop = gstop,  ftype  = filterType, output='sos')
+    else:
+        (b, a) = signal.iirdesign(ws = ws, wp = wp, gpass = gpass, gstop = gstop,  ftype  = filterType, output='ba')
 
     dims = data.ndim
     axis = 0
@@ -100,7 +115,9 @@ def band_iir_filter(data, Fsampling, stopband=[49,51], passband = [47,53], gpass
     if pad_type:
         data = np.pad(data, pad_samples, pad_type, pad_kwargs)
 
-    if filterDirection == ct.FilterDirection.TWO_PASS:
+    if use_sos:
+        filteredData = _sos_filter(sos, data, filterDirection)
+    elif filterDirection == ct.FilterDirection.TWO_PASS:
         filteredData = signal.filtfilt(b, a, data, axis)
     elif filterDirection == ct.FilterDirection.ONE_PASS:
         filteredData = signal.lfilter(b, a, data, axis, zi=None)
@@ -118,6 +135,127 @@ def band_iir_filter(data, Fsampling, stopband=[49,51], passband = [47,53], gpass
     return filteredData
 
 
+def _sos_filter(sos, data, filterDirection):
+    """
+    In memory second-order sections version of the filterDirection switch used by the 'ba' filters above.
+    """
+    if filterDirection == ct.FilterDirection.TWO_PASS:
+        filteredData = signal.sosfiltfilt(sos, data, axis=-1)
+    elif filterDirection == ct.FilterDirection.ONE_PASS:
+        filteredData = signal.sosfilt(sos, data, axis=-1)
+    elif filterDirection == ct.FilterDirection.ONE_PASS_REVERSE:
+        filteredData = signal.sosfilt(sos, data[..., ::-1], axis=-1)[..., ::-1]
+    return filteredData
+
+
+def sos_filter_chunked(sos, data, output=None, filterDirection='twopass', block_size=2**16, padlen=None, n_jobs=1,
+                       output_dtype=np.float32):
+    """
+    Filters a (channels x time) array, usually a memmap of a whole recording, with a second-order sections filter
+    without loading it in memory. The data are processed in blocks of samples carrying the filter state from one block
+    to the next, so the one pass results are identical to signal.sosfilt and the two pass result is identical to
+    signal.sosfiltfilt (odd extension padding of padlen samples at each end) as long as the output is float64. A float32
+    output is also used to store the forward pass so it will differ from sosfiltfilt at the float32 precision level.
+
+    sos = the second-order sections of the filter (e.g. signal.butter(..., output='sos'))
+    data = a channels x time (or 1D) array or memmap
+    output = None (a new float64 array is returned), an array of the same shape as data, or a file name in which case
+    a memmap of output_dtype is created
+    filterDirection = FilterDirection which defines whether the filter is passed over the data once (and how) or twice
+    block_size = the number of samples filtered at once per channel
+    padlen = the number of samples of odd extension at each side for the two pass filter (default as sosfiltfilt)
+    n_jobs = the number of threads, each filtering a different group of channels
+    output_dtype = the dtype of the output memmap if output is a file name
+    """
+    sos = np.atleast_2d(np.asarray(sos, dtype=np.float64))
+    if output is None:
+        output = np.empty(data.shape, dtype=np.float64)
+    elif isinstance(output, str):
+        output = np.memmap(output, dtype=output_dtype, mode='w+', shape=data.shape)
+    if data.ndim == 1:
+        data = data[np.newaxis, :]
+    out = output[np.newaxis, :] if output.ndim == 1 else output
+    num_channels, num_samples = data.shape
+
+    if filterDirection == ct.FilterDirection.TWO_PASS:
+        if padlen is None:
+            padlen = 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum()))
+        if padlen >= num_samples:
+            raise ValueError("The length of the data must be larger than padlen ({})".format(padlen))
+        worker = lambda rows: _sos_filtfilt_rows(sos, data, out, rows, block_size, padlen)
+    elif filterDirection in [ct.FilterDirection.ONE_PASS, ct.FilterDirection.ONE_PASS_REVERSE]:
+        reverse = filterDirection == ct.FilterDirection.ONE_PASS_REVERSE
+        worker = lambda rows: _sos_filt_rows(sos, data, out, rows, block_size, reverse)
+    else:
+        raise ValueError("Unknown filterDirection {}".format(filterDirection))
+
+    groups = [slice(g[0], g[-1] + 1) for g in np.array_split(np.arange(num_channels), max(1, n_jobs)) if len(g) > 0]
+    if len(groups) == 1:
+        worker(groups[0])
+    else:
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            list(executor.map(worker, groups))
+
+    if isinstance(output, np.memmap):
+        output.flush()
+    return output
+
+
+def _block_starts(num_samples, block_size):
+    return [(start, min(start + block_size, num_samples)) for start in range(0, num_samples, block_size)]
+
+
+def _sos_filt_rows(sos, data, out, rows, block_size, reverse):
+    num_samples = data.shape[1]
+    num_rows = rows.stop - rows.start
+    state = np.zeros((sos.shape[0], num_rows, 2))
+    blocks = _block_starts(num_samples, block_size)
+    if reverse:
+        blocks = blocks[::-1]
+    for start, end in blocks:
+        block = np.asarray(data[rows, start:end], dtype=np.float64)
+        if reverse:
+            block = block[:, ::-1]
+        filtered, state = signal.sosfilt(sos, block, axis=-1, zi=state)
+        out[rows, start:end] = filtered[:, ::-1] if reverse else filtered
+
+
+def _sos_filtfilt_rows(sos, data, out, rows, block_size, padlen):
+    num_samples = data.shape[1]
+    zi = signal.sosfilt_zi(sos)[:, np.newaxis, :]
+    blocks = _block_starts(num_samples, block_size)
+
+    # odd extension at both ends, as signal.sosfiltfilt
+    first = np.asarray(data[rows, :padlen + 1], dtype=np.float64)
+    last = np.asarray(data[rows, num_samples - padlen - 1:], dtype=np.float64)
+    left_pad = 2 * first[:, :1] - first[:, :0:-1]
+    right_pad = 2 * last[:, -1:] - last[:, -2::-1]
+
+    # forward pass, the filtered data are kept in the output
+    x0 = left_pad[:, 0] if padlen > 0 else first[:, 0]
+    state = zi * x0[np.newaxis, :, np.newaxis]
+    if padlen > 0:
+        _, state = signal.sosfilt(sos, left_pad, axis=-1, zi=state)
+    for start, end in blocks:
+        filtered, state = signal.sosfilt(sos, np.asarray(data[rows, start:end], dtype=np.float64), axis=-1, zi=state)
+        out[rows, start:end] = filtered
+    if padlen > 0:
+        right_filtered, state = signal.sosfilt(sos, right_pad, axis=-1, zi=state)
+        y0 = right_filtered[:, -1]
+    else:
+        y0 = np.asarray(out[rows, num_samples - 1], dtype=np.float64)
+
+    # backward pass over the forward result, starting from the end of the right padding
+    state = zi * y0[np.newaxis, :, np.newaxis]
+    if padlen > 0:
+        _, state = signal.sosfilt(sos, right_filtered[:, ::-1], axis=-1, zi=state)
+    for start, end in blocks[::-1]:
+        block = np.asarray(out[rows, start:end], dtype=np.float64)[:, ::-1]
+        filtered, state = signal.sosfilt(sos, block, axis=-1, zi=state)
+        out[rows, start:end] = filtered[:, ::-1]
+
+
+
 # def pad_data(data, pad_samples = None, type = 'zeros'):
 #
 #     if len(np.shape(data) >1):
@@ -83,18 +83,14 @@ def create_spike_triggered_events(data_raw_spikes, threshold, inter_spike_time_d
 
 def spikedetect(data_raw_spikes, threshold_multiplier=4, single_max_threshold=True, inter_spike_time_distance=0.01,
                 sampling_freq=32556, bad_channels=None):
-    bad_channels = np.array(bad_channels)
+    if bad_channels is None:
+        bad_channels = np.empty(0, dtype=int)
+    bad_channels = np.atleast_1d(bad_channels)
     num_of_channels = np.shape(data_raw_spikes)[0]
-    samples = np.arange(0, np.shape(data_raw_spikes)[1])
-    thresholds = np.zeros(num_of_channels)
-    for i in np.arange(0, num_of_channels):
-        thresholds[i] = threshold_multiplier * np.median(np.abs(data_raw_spikes[i, :])) / .6745
-        if not thresholds[i].any():
-            print("Bad Channel " + str(i))
-            if bad_channels is None:
-                bad_channels = i
-            else:
-                bad_channels = np.append(bad_channels, i)
+    thresholds = threshold_multiplier * np.median(np.abs(data_raw_spikes), axis=1) / .6745
+    for i in np.nonzero(thresholds == 0)[0]:
+        print("Bad Channel " + str(i))
+    bad_channels = np.union1d(bad_channels, np.nonzero(thresholds == 0)[0])
 
     if single_max_threshold:
         thresholds[:] = np.max(thresholds)
@@ -103,27 +99,115 @@ def spikedetect(data_raw_spikes, threshold_multiplier=4, single_max_threshold=Tr
 
     all_channels_spike_times = np.empty(0)
     for i in np.arange(0, num_of_channels):
-        if not is_element_in_array(bad_channels, i):
+        if i not in bad_channels:
             print("Threshold = " + str(thresholds[i]))
-            spike_times = np.array([x for x in samples if (data_raw_spikes[i, x] > thresholds[i])])
-            diff_spikes_times = np.diff(spike_times)
-            spike_times = np.array(
-                [x for i, x in enumerate(spike_times[:-1]) if (diff_spikes_times[i] > inter_spike_distance)])
-            print("spike_time size = " + str(np.size(spike_times)))
-            if all_channels_spike_times.size is 0:
-                all_channels_spike_times = np.append(all_channels_spike_times, spike_times)
-                print("1 all_channels_spike_times size = " + str(np.size(all_channels_spike_times)))
-            else:
-                spike_times = np.array(
-                    [x for i, x in enumerate(spike_times) if not is_element_in_array(all_channels_spike_times, x)])
-                all_channels_spike_times = np.append(all_channels_spike_times, spike_times)
-                print("2 all_channels_spike_times size = " + str(np.size(all_channels_spike_times)))
-            print(i)
-        print(i)
+            spike_times = np.nonzero(data_raw_spikes[i, :] > thresholds[i])[0]
+            spike_times = spike_times[:-1][np.diff(spike_times) > inter_spike_distance]
+            spike_times = spike_times[~np.isin(spike_times, all_channels_spike_times)]
+            all_channels_spike_times = np.append(all_channels_spike_times, spike_times)
+            print("all_channels_spike_times size = " + str(np.size(all_channels_spike_times)))
 
     return all_channels_spike_times
 
 
+SPIKE_DTYPE = np.dtype([('sample', np.int64), ('channel', np.int32), ('amplitude', np.float32)])
+
+
+def detect_spikes(data, threshold_multiplier=4, sampling_freq=30000, polarity='negative', refractory_time=0.001,
+                  peak_time=0.001, chunk_size=300000, bad_channels=None, single_max_threshold=False):
+    """
+    Threshold crossing spike detection over all channels of a (high passed) channels x time array or memmap.
+
+    The data are read in chunks of chunk_size samples. In each chunk the threshold of every channel is
+    threshold_multiplier * MAD / 0.6745 (MAD = median of the absolute data). A spike is a crossing of the threshold in
+    the direction given by polarity ('negative', 'positive' or 'both') and is aligned to the extreme sample in the
+    peak_time seconds after the crossing. Spikes on the same channel closer than refractory_time seconds are merged
+    into the largest one.
+
+    Input:
+    data -- channels x time array or memmap (filtered)
+    threshold_multiplier -- number of (MAD estimated) standard deviations for the threshold
+    sampling_freq -- the sampling frequency in Hz
+    polarity -- 'negative', 'positive' or 'both'
+    refractory_time -- the minimum time in seconds between two spikes on the same channel
+    peak_time -- the time in seconds after the crossing in which the peak is searched for
+    chunk_size -- the number of samples (per channel) loaded at once
+    bad_channels -- channels to ignore
+    single_max_threshold -- if True all channels use the maximum threshold of the chunk
+
+    Output:
+    A structured array with fields 'sample', 'channel' and 'amplitude' (the value of the data at the peak) sorted by
+    sample
+    """
+    num_of_channels, num_of_samples = np.shape(data)
+    refractory_samples = int(refractory_time * sampling_freq)
+    peak_samples = max(int(peak_time * sampling_freq), 1)
+    good_channels = np.setdiff1d(np.arange(num_of_channels), [] if bad_channels is None else bad_channels)
+
+    channels_list = []
+    samples_list = []
+    amplitudes_list = []
+    for chunk_start in np.arange(0, num_of_samples, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, num_of_samples)
+        # One sample before the chunk catches crossings on its first sample, peak_samples after it let the peaks of
+        # crossings near its end be found
+        read_start = max(chunk_start - 1, 0)
+        read_end = min(chunk_end + peak_samples, num_of_samples)
+        chunk = np.asarray(data[good_channels, read_start:read_end], dtype=np.float32)
+
+        thresholds = threshold_multiplier * np.median(np.abs(chunk[:, chunk_start - read_start:chunk_end - read_start]),
+                                                      axis=1) / .6745
+        if single_max_threshold:
+            thresholds[:] = np.max(thresholds)
+        if polarity == 'negative':
+            signed = -chunk
+        elif polarity == 'positive':
+            signed = chunk
+        else:
+            signed = np.abs(chunk)
+
+        above = signed > thresholds[:, np.newaxis]
+        crossing_channels, crossings = np.nonzero(above[:, 1:] & ~above[:, :-1])
+        crossings += 1
+        in_chunk = (crossings + read_start >= chunk_start) & (crossings + read_start < chunk_end) & \
+                   (thresholds[crossing_channels] > 0)
+        crossing_channels = crossing_channels[in_chunk]
+        crossings = crossings[in_chunk]
+
+        windows = np.minimum(crossings[:, np.newaxis] + np.arange(peak_samples), signed.shape[1] - 1)
+        peaks = windows[np.arange(len(crossings)), np.argmax(signed[crossing_channels[:, np.newaxis], windows], axis=1)]
+
+        channels_list.append(good_channels[crossing_channels])
+        samples_list.append(peaks + read_start)
+        amplitudes_list.append(chunk[crossing_channels, peaks])
+
+    channels = np.concatenate(channels_list) if channels_list else np.empty(0, dtype=int)
+    samples = np.concatenate(samples_list) if samples_list else np.empty(0, dtype=int)
+    amplitudes = np.concatenate(amplitudes_list) if amplitudes_list else np.empty(0, dtype=np.float32)
+
+    # Refractory merging: spikes of a channel closer than refractory_samples to the previous one belong to the same
+    # group and only the largest spike of each group is kept
+    order = np.lexsort((samples, channels))
+    channels, samples, amplitudes = channels[order], samples[order], amplitudes[order]
+    new_group = np.ones(len(samples), dtype=bool)
+    new_group[1:] = (np.diff(channels) != 0) | (np.diff(samples) > refractory_samples)
+    groups = np.cumsum(new_group)
+    if polarity == 'negative':
+        size = -amplitudes
+    elif polarity == 'positive':
+        size = amplitudes
+    else:
+        size = np.abs(amplitudes)
+    best = np.lexsort((-size, groups))
+    keep = best[np.concatenate(([True], np.diff(groups[best]) != 0))] if len(best) else best
+
+    spikes = np.empty(len(keep), dtype=SPIKE_DTYPE)
+    spikes['sample'] = samples[keep]
+    spikes['channel'] = channels[keep]
+    spikes['amplitude'] = amplitudes[keep]
+    return np.sort(spikes, order=['sample', 'channel'])
+
+
 def is_element_in_array(array, element):
     return np.size(np.nonzero(array - element)) < np.size(array)
 
@@ -245,6 +329,126 @@ def time_lock_raw_data(data, events, times_to_cut, sampling_freq, baseline_time=
     return returned_tuple
 
 
+def time_lock_raw_data_batch(data, events, times_to_cut, sampling_freq, baseline_time=None, sub_sample_freq=None,
+                             high_pass_cutoff=None, rectify=False, low_pass_cutoff=None, avg_reref=False, output=None,
+                             chunk_size=None, filter_pad_time=0.5):
+    """
+    Batch version of time_lock_raw_data. Instead of cutting and filtering every trial separately the continuous data
+    are filtered once (or once per chunk of chunk_size samples, padded by filter_pad_time seconds at each side) with
+    the same re-referencing / filtering / rectifying steps, and all the trials are then gathered with one fancy index.
+    Subsampling (anti aliasing fir filter on the continuous data and a strided gather) and baseline correction happen in
+    the same pass. Trials that do not fit in the data are dropped.
+    The baseline is the mean of all the samples of the baseline_time window of each trial. For channels x time data
+    time_lock_raw_data (baseline_correct_basis) subtracts the mean of only the first and last samples of the window,
+    so the baseline corrected trials of the two functions differ by a constant per trial and channel.
+
+    Input:
+    data -- channels x time (or 1D) array or memmap
+    events -- the samples of the events (or a 2D events array with the samples in the first row)
+    times_to_cut -- [start, end] time in seconds of the window around each event
+    output -- None (a new array is returned) or a file name for a memmap of the trials
+    chunk_size -- None to filter the whole data in one go, otherwise the number of samples filtered at once
+    filter_pad_time -- the time in seconds of data on each side of a chunk used to avoid filter edge effects
+
+    Output:
+    [trials x channels x time (or trials x time for 1D data) array, the average over trials, time axis]
+    """
+    if np.ndim(events) == 2:
+        events = events[0, :]
+    events = np.asarray(events).astype(np.int64)
+    one_d = np.ndim(data) == 1
+    if one_d:
+        data = data[np.newaxis, :]
+    number_of_channels, total_samples = np.shape(data)
+    times_to_cut = np.array(times_to_cut)
+    samples_to_cut = (times_to_cut * sampling_freq).astype(int)
+    number_of_samples = samples_to_cut[1] - samples_to_cut[0]
+
+    step = 1
+    if sub_sample_freq:
+        if int((sampling_freq / sub_sample_freq) % int(sampling_freq / sub_sample_freq)) != 0:
+            raise ArithmeticError("Subsampling can be done only with integer factors of Old Frequency / New Frequency")
+        step = int(sampling_freq / sub_sample_freq)
+    window_indices = np.arange(0, number_of_samples, step)
+    time_axis = times_to_cut[0] + window_indices / sampling_freq
+
+    starts = events + samples_to_cut[0]
+    valid = (starts >= 0) & (starts + number_of_samples <= total_samples)
+    if not np.all(valid):
+        warnings.warn(str(np.sum(~valid)) + " trial(s) do not fit in the data and will be dropped.", UserWarning)
+    starts = starts[valid]
+    number_of_trials = len(starts)
+
+    out_shape = (number_of_trials, number_of_channels, len(window_indices))
+    if output is None:
+        trials = np.empty(out_shape)
+    else:
+        trials = np.memmap(output, dtype=np.float64, mode='w+', shape=out_shape)
+
+    if baseline_time is not None:
+        baseline_samples = np.ceil((np.array(baseline_time) - times_to_cut[0]) * sampling_freq / step).astype(int)
+        if np.any(baseline_samples < 0):
+            raise ArithmeticError("The baseline times must be after the starting time of the trial")
+
+    if chunk_size is None:
+        chunk_size = total_samples
+    pad = int(filter_pad_time * sampling_freq) if chunk_size < total_samples else 0
+    order = np.argsort(starts)
+    sorted_starts = starts[order]
+    for chunk_start in np.arange(0, total_samples, chunk_size):
+        first, last = np.searchsorted(sorted_starts, [chunk_start, chunk_start + chunk_size])
+        if first == last:
+            continue
+        if chunk_size < total_samples:
+            # the chunk's trials (with pad samples on each side if filter_pad_time > 0)
+            segment_start = max(chunk_start - pad, 0)
+            segment_end = min(sorted_starts[last - 1] + number_of_samples + pad, total_samples)
+        else:
+            segment_start, segment_end = 0, total_samples
+        segment = _filter_for_time_lock(np.asarray(data[:, segment_start:segment_end], dtype=np.float64),
+                                        sampling_freq, high_pass_cutoff, rectify, low_pass_cutoff, avg_reref, step)
+
+        indices = (sorted_starts[first:last] - segment_start)[:, np.newaxis] + window_indices
+        chunk_trials = np.transpose(segment[:, indices], (1, 0, 2))
+        if baseline_time is not None:
+            chunk_trials -= np.mean(chunk_trials[:, :, baseline_samples[0]:baseline_samples[1]], axis=2,
+                                    keepdims=True)
+        trials[order[first:last]] = chunk_trials
+
+    tl_avgtrials_data = np.mean(trials, axis=0)
+    if one_d:
+        trials = trials[:, 0, :]
+        tl_avgtrials_data = tl_avgtrials_data[0]
+    return [trials, tl_avgtrials_data, time_axis]
+
+
+def _filter_for_time_lock(data, sampling_freq, high_pass_cutoff, rectify, low_pass_cutoff, avg_reref, subsample_step):
+    """
+    The re-referencing / filtering / rectifying steps of time_lock_raw_data applied on a channels x time segment,
+    followed by the anti aliasing filter of the subsampling if subsample_step > 1.
+    """
+    if avg_reref:  # rereference with mean over all channels
+        data = data - np.mean(data, 0)
+
+    if high_pass_cutoff:
+        data = filt.high_pass_filter(data, sampling_freq, high_pass_cutoff)
+    elif low_pass_cutoff:
+        data = filt.low_pass_filter(data, sampling_freq, low_pass_cutoff)
+    if rectify:
+        data = np.abs(data)
+        if low_pass_cutoff:
+            data = filt.low_pass_filter(data, sampling_freq, low_pass_cutoff)
+        else:
+            data = filt.low_pass_filter(data, sampling_freq, high_pass_cutoff / 2)
+    elif not rectify and high_pass_cutoff:
+        data = filt.low_pass_filter(data, sampling_freq, high_pass_cutoff / 2)
+
+    if subsample_step > 1:  # the same order 30 fir that subsample_data uses, run forwards and backwards
+        b = signal.firwin(31, 1. / subsample_step, window='hamming')
+        data = signal.filtfilt(b, 1., data, axis=1)
+    return data
+
+
 def subsample_basis_data(data, oldFreq, newFreq, filterType='Default', filterOrder=None):
     if int((oldFreq / newFreq) % int(oldFreq / newFreq)) is not 0:
         raise ArithmeticError("Subsampling can be done only with integer factors of Old Frequency / New Frequency")
@@ -0,0 +1,156 @@
+
+"""
+Cubes of the waveforms of spikes (the windows of the raw data around every spike) written to a memmap.
+
+The raw data are read once, sequentially, in chunks of time and all the windows of the spikes in a chunk are cut out
+together and written to their rows. The default layout is spike major (spikes x channels x time points), so the
+waveforms of one spike are contiguous and reading a set of spikes (e.g. the spikes of a unit, if the spikes are
+given ordered by unit) is a read of whole rows instead of a strided gather. The (channels x time points x spikes)
+layout of the older cubes can still be written.
+"""
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def _window_offset(num_of_points_in_spike_trig):
+    # the same window as int(t - n / 2) : int(t + n / 2)
+    return -(num_of_points_in_spike_trig - num_of_points_in_spike_trig // 2)
+
+
+def _time_major_view(raw_extracellular_data, number_of_channels_in_binary_file=None, binary_dtype=np.int16):
+    """
+    A (time points x channels) view of either a channels x time points array or a time major binary file
+    """
+    if isinstance(raw_extracellular_data, str):
+        data_raw = np.memmap(raw_extracellular_data, dtype=binary_dtype, mode='r')
+        number_of_timepoints_in_raw = int(data_raw.shape[0] / number_of_channels_in_binary_file)
+        return np.reshape(data_raw[:number_of_timepoints_in_raw * number_of_channels_in_binary_file],
+                          (number_of_timepoints_in_raw, number_of_channels_in_binary_file))
+    return np.transpose(raw_extracellular_data)
+
+
+def data_cube_shape(num_of_spikes, num_of_channels, num_of_points_in_spike_trig, spike_major=True):
+    if spike_major:
+        return num_of_spikes, num_of_channels, num_of_points_in_spike_trig
+    return num_of_channels, num_of_points_in_spike_trig, num_of_spikes
+
+
+def _fill_data_cube(raw_extracellular_data, number_of_channels_in_binary_file, binary_dtype, data_cube_filename,
+                    cube_shape, cube_type, spike_major, spike_times, rows, channels_of_spikes,
+                    num_of_points_in_spike_trig, num_of_points_for_baseline, chunk_time_points, spikes_per_batch):
+    """
+    Writes the windows of the (time sorted) spike_times to the rows of the cube. Only the given rows are written so
+    workers with disjoint rows can fill the same cube at the same time.
+    """
+    raw = _time_major_view(raw_extracellular_data, number_of_channels_in_binary_file, binary_dtype)
+    cube = np.memmap(data_cube_filename, dtype=cube_type, mode='r+', shape=cube_shape)
+    offset = _window_offset(num_of_points_in_spike_trig)
+    window = np.arange(num_of_points_in_spike_trig) + offset
+
+    for chunk_start in np.arange(spike_times[0], spike_times[-1] + 1, chunk_time_points):
+        chunk_end = chunk_start + chunk_time_points
+        first_spike, last_spike = np.searchsorted(spike_times, [chunk_start, chunk_end])
+        if first_spike == last_spike:
+            continue
+        read_start = chunk_start + offset
+        read_end = min(chunk_end + offset + num_of_points_in_spike_trig, raw.shape[0])
+        chunk = np.array(raw[read_start:read_end])
+
+        for batch_start in np.arange(first_spike, last_spike, spikes_per_batch):
+            batch_end = min(batch_start + spikes_per_batch, last_spike)
+            time_indices = (spike_times[batch_start:batch_end] - read_start)[:, np.newaxis] + window
+            windows = chunk[time_indices]
+            if channels_of_spikes is not None:
+                windows = np.take_along_axis(windows, channels_of_spikes[batch_start:batch_end, np.newaxis, :],
+                                             axis=2)
+            # spikes x channels x time points
+            windows = np.transpose(windows, (0, 2, 1))
+            if num_of_points_for_baseline is not None:
+                baseline = np.mean(windows[:, :, [0, num_of_points_for_baseline]], axis=2)
+                windows = windows - baseline[:, :, np.newaxis]
+            if spike_major:
+                cube[rows[batch_start:batch_end]] = windows.astype(cube_type)
+            else:
+                cube[:, :, rows[batch_start:batch_end]] = np.transpose(windows, (1, 2, 0)).astype(cube_type)
+    cube.flush()
+    del cube
+
+
+def create_data_cube(raw_extracellular_data, data_cube_filename, spike_times, num_of_points_in_spike_trig, cube_type,
+                     num_of_points_for_baseline=None, spike_major=True, channels_of_spikes=None,
+                     number_of_channels_in_binary_file=None, binary_dtype=np.int16, chunk_time_points=2**18,
+                     spikes_per_batch=1000, n_jobs=1):
+    """
+    Cuts the windows of num_of_points_in_spike_trig time points around every spike out of the raw data into a memmap
+
+    raw_extracellular_data -- a channels x time points array or the filename of a time major binary file (then
+                              number_of_channels_in_binary_file and binary_dtype must describe it)
+    spike_times -- the (trigger) time point of every spike. The rows of the cube follow the order of spike_times
+                   (e.g. give the spikes ordered by unit to make the reads of a unit contiguous)
+    num_of_points_for_baseline -- if not None the mean of the time points 0 and num_of_points_for_baseline of every
+                                  window is subtracted from it (like tsne_cluster.create_data_cube_from_raw_extra_data)
+    spike_major -- if True the cube is spikes x channels x time points, otherwise channels x time points x spikes
+    channels_of_spikes -- optional (spikes x k) indices of the channels to keep for every spike (e.g. the k channels
+                          closest to the spike's best channel). The cube then has k channels
+    chunk_time_points -- the raw data are read sequentially in chunks of this many time points
+    spikes_per_batch -- the number of windows cut and written at a time
+    n_jobs -- the spikes are split (in time order) in n_jobs parts that write disjoint rows of the cube. The workers
+              are processes if raw_extracellular_data is a filename and threads if it is an array
+
+    Spikes whose window does not fit in the recording are left as zeros.
+    Returns the shape of the cube.
+    """
+    spike_times = np.ravel(np.asarray(spike_times)).astype(np.int64)
+    raw = _time_major_view(raw_extracellular_data, number_of_channels_in_binary_file, binary_dtype)
+    number_of_timepoints_in_raw, num_of_channels = raw.shape
+    del raw
+    if channels_of_spikes is not None:
+        channels_of_spikes = np.asarray(channels_of_spikes, dtype=np.int64)
+        num_of_channels = channels_of_spikes.shape[1]
+
+    cube_shape = data_cube_shape(len(spike_times), num_of_channels, num_of_points_in_spike_trig, spike_major)
+    cube = np.memmap(data_cube_filename, dtype=cube_type, mode='w+', shape=cube_shape)
+    del cube
+
+    # the spikes that fit in the recording, in time order
+    offset = _window_offset(num_of_points_in_spike_trig)
+    fits = (spike_times + offset >= 0) & (spike_times + offset + num_of_points_in_spike_trig <=
+                                          number_of_timepoints_in_raw)
+    rows = np.flatnonzero(fits)
+    rows = rows[np.argsort(spike_times[rows], kind='stable')]
+    if len(rows) == 0:
+        return cube_shape
+
+    parts = np.array_split(np.arange(len(rows)), max(n_jobs, 1))
+    arguments = []
+    for part in parts:
+        if len(part) == 0:
+            continue
+        part_rows = rows[part]
+        part_channels = channels_of_spikes[part_rows] if channels_of_spikes is not None else None
+        arguments.append((raw_extracellular_data, number_of_channels_in_binary_file, binary_dtype,
+                          data_cube_filename, cube_shape, cube_type, spike_major, spike_times[part_rows], part_rows,
+                          part_channels, num_of_points_in_spike_trig, num_of_points_for_baseline, chunk_time_points,
+                          spikes_per_batch))
+
+    if len(arguments) == 1:
+        _fill_data_cube(*arguments[0])
+    else:
+        executor_type = ProcessPoolExecutor if isinstance(raw_extracellular_data, str) else ThreadPoolExecutor
+        with executor_type(max_workers=len(arguments)) as executor:
+            futures = [executor.submit(_fill_data_cube, *args) for args in arguments]
+            for future in futures:
+                future.result()
+
+    return cube_shape
+
+
+def load_data_cube(data_cube_filename, cube_type, cube_shape, spike_major=True):
+    """
+    Opens a cube made by create_data_cube (read only). A spike major cube is returned as a channels x time points x
+    spikes view so code indexing the older cubes (cube[:, :, spike_indices]) works unchanged, reading whole rows.
+    """
+    cube = np.memmap(data_cube_filename, dtype=cube_type, mode='r', shape=tuple(cube_shape))
+    if spike_major:
+        return np.transpose(cube, (1, 2, 0))
+    return cube
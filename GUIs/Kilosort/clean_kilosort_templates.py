@@ -8,7 +8,12 @@ import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui
 from pyqtgraph.widgets import MatplotlibWidget as ptl_widget
 from GUIs.Kilosort import spike_heatmap as sh
+from GUIs.Kilosort.template_cache import TemplateCache
+from GUIs.Kilosort.template_store import TemplateStore
+from BrainDataAnalysis import correlograms
 from joblib import Parallel, delayed
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 
 def cleanup_kilosorted_data(base_folder, number_of_channels_in_binary_file, binary_data_filename,
@@ -30,19 +35,36 @@ def cleanup_kilosorted_data(base_folder, number_of_channels_in_binary_file, bina
 
     global current_template_index
     current_template_index = 0
-    #global visibility_threshold
+    global visibility_threshold
     visibility_threshold = 2
 
-    if exists(join(base_folder, 'template_marking.npy')):
-        template_marking = np.load(join(base_folder, 'template_marking.npy'))
-    else:
-        template_marking = np.zeros(number_of_templates)
-        np.save(join(base_folder, 'template_marking.npy'), template_marking)
-
     assert exists(join(base_folder, 'avg_spike_template.npy'))
     data = np.load(join(base_folder, 'avg_spike_template.npy'))
     time_points = int(data.shape[2] / 2)
 
+    # the marking and merges of the templates (the averages of merged templates come from their sums, not the raw data)
+    if exists(join(base_folder, 'template_sums.npy')) and exists(join(base_folder, 'template_spike_counts.npy')):
+        # saved by generate_average_over_spikes_per_template_streaming
+        template_store = TemplateStore(base_folder, number_of_templates)
+    else:
+        # an avg_spike_template.npy of the older generators, averaged over the same spikes the streaming one uses
+        in_time = _spikes_in_recording(np.ravel(spike_times), binary_data_filename, number_of_channels_in_binary_file,
+                                       time_points)
+        spike_counts = np.bincount(np.ravel(spike_templates)[in_time], minlength=number_of_templates)
+        template_store = TemplateStore(base_folder, number_of_templates, averages=data, spike_counts=spike_counts)
+    for root in np.unique(template_store.roots):
+        if len(template_store.members(root)) > 1:
+            data[root] = template_store.average(root)
+
+    prb_file = join(probe_info_folder, 'prb.txt')
+    connected = np.squeeze(np.load(join(probe_info_folder, probe_connected_channels_file)))
+    bad_channels = np.squeeze(np.argwhere(connected == False).astype(np.int))
+
+    # the spikes sorted by template so the spikes of a template are one slice
+    spike_order = np.argsort(np.ravel(spike_templates), kind='stable')
+    template_starts = np.searchsorted(np.ravel(spike_templates)[spike_order], np.arange(number_of_templates + 1))
+    spike_times_sorted_by_template = np.ravel(spike_times)[spike_order].astype(np.int64)
+
 
     def get_visible_channels(current_template_index, visibility_threshold):
         median = np.median(np.nanmin(templates[current_template_index, :, :], axis=0))
@@ -52,22 +74,53 @@ def cleanup_kilosorted_data(base_folder, number_of_channels_in_binary_file, bina
         return channels_over_threshold
 
 
-    def update_all_plots():
-        update_average_spikes_plot()
-        update_heatmap_plot()
-        update_autocorelogram()
-        update_marking_led()
+    def compute_template_artifacts(template_index):
+        # runs on the template cache's worker thread, so no Qt or matplotlib calls here
+        # a merged template shows the template it was merged into (with the spikes of all its members)
+        threshold = visibility_threshold
+        root = template_store.roots[template_index]
+        spike_times_in_template = np.concatenate([spike_times_sorted_by_template[template_starts[t]:
+                                                                                 template_starts[t + 1]]
+                                                  for t in template_store.members(root)])
+        hist, edges = correlograms.correlogram(spike_times_in_template, spike_times_in_template, lag=1500,
+                                               number_of_bins=100)
+        heatmap = sh.interpolate_heatmap(data[root], prb_file, window_size=60, bad_channels=bad_channels,
+                                         num_of_shanks=5, rotate_90=True, flip_ud=False, flip_lr=False)
+        return {'visibility_threshold': threshold,
+                'visible_channels': get_visible_channels(root, threshold),
+                'heatmap': heatmap,
+                'autocorrelogram': (hist, edges),
+                'number_of_spikes': len(spike_times_in_template)}
 
+    template_cache = TemplateCache(compute_template_artifacts, number_of_templates, neighbours=5, max_entries=64)
 
-    def update_average_spikes_plot():
+
+    def update_all_plots():
+        update_marking_led()
+        template_cache.prefetch_around(current_template_index)
+        artifacts = template_cache.get(current_template_index)
+        if artifacts is None:
+            # not computed yet, draw when it is
+            redraw_timer.start(20)
+            return
+        update_average_spikes_plot(artifacts)
+        update_heatmap_plot(artifacts)
+        update_autocorelogram(artifacts)
+
+
+    def update_average_spikes_plot(artifacts=None):
         global current_template_index
-        visible_channels = get_visible_channels(current_template_index=current_template_index,
-                                                visibility_threshold=visibility_threshold)
+        root = template_store.roots[current_template_index]
+        if artifacts is not None and artifacts['visibility_threshold'] == visibility_threshold:
+            visible_channels = artifacts['visible_channels']
+        else:
+            visible_channels = get_visible_channels(current_template_index=root,
+                                                    visibility_threshold=visibility_threshold)
         time_points = data.shape[2]
         total_time = time_points / sampling_frequency
         time_axis = np.arange(-(total_time/2), total_time/2, 1 / sampling_frequency)
         for i in np.arange(electrodes):
-            electrode_curves[i].setData(time_axis, data[current_template_index, i, :])
+            electrode_curves[i].setData(time_axis, data[root, i, :])
             if i in visible_channels:
                 electrode_curves[i].setPen(pg.mkPen((i, len(visible_channels) * 1.3)))
             else:
@@ -85,63 +138,43 @@ def cleanup_kilosorted_data(base_folder, number_of_channels_in_binary_file, bina
         heatmap_plot.setImage(image)
     '''
 
-    def update_heatmap_plot():
-        prb_file = join(probe_info_folder, 'prb.txt')
-        connected = np.squeeze(np.load(join(probe_info_folder, probe_connected_channels_file)))
-        bad_channels = np.squeeze(np.argwhere(connected == False).astype(np.int))
-        sh.create_heatmap_on_matplotlib_widget(heatmap_plot, data[current_template_index], prb_file, window_size=60,
-                                               bad_channels=bad_channels, num_of_shanks=5, rotate_90=True, flip_ud=False,
-                                               flip_lr=False)
+    def update_heatmap_plot(artifacts):
+        operator, interpolated, zlimits = artifacts['heatmap']
+        sh.draw_heatmap_on_matplotlib_widget(heatmap_plot, operator, interpolated, zlimits)
         heatmap_plot.draw()
 
 
-    def crosscorrelate_spike_trains(spike_times_train_1, spike_times_train_2, lag=None):
-        if spike_times_train_1.size < spike_times_train_2.size:
-            if lag is None:
-                lag = np.ceil(10 * np.mean(np.diff(spike_times_train_1)))
-            reverse = False
-        else:
-            if lag is None:
-                lag = np.ceil(20 * np.mean(np.diff(spike_times_train_2)))
-            spike_times_train_1, spike_times_train_2 = spike_times_train_2, spike_times_train_1
-            reverse = True
-
-        # calculate cross differences in spike times
-        differences = np.array([])
-        for k in np.arange(0, spike_times_train_1.size):
-            differences = np.append(differences, spike_times_train_1[k] - spike_times_train_2[np.nonzero(
-                (spike_times_train_2 > spike_times_train_1[k] - lag)
-                 & (spike_times_train_2 < spike_times_train_1[k] + lag)
-                 & (spike_times_train_2 != spike_times_train_1[k]))])
-        if reverse is True:
-            differences = -differences
-        norm = np.sqrt(spike_times_train_1.size * spike_times_train_2.size)
-        return differences, norm
-
-
-    def update_autocorelogram():
+    def update_autocorelogram(artifacts):
         global current_template_index
-        spike_indices_in_template = np.argwhere(np.in1d(spike_templates, current_template_index))
-        diffs, norm = crosscorrelate_spike_trains(spike_times[spike_indices_in_template].astype(np.int64),
-                                                  spike_times[spike_indices_in_template].astype(np.int64),
-                                                  lag=1500)
-        hist, edges = np.histogram(diffs, bins=100)
+        hist, edges = artifacts['autocorrelogram']
         autocorelogram_curve.setData(x=edges, y=hist, stepMode=True, fillLevel=0, brush=(0, 0, 255, 150))
 
-        number_of_spikes = len(spike_indices_in_template)
+        number_of_spikes = artifacts['number_of_spikes']
         plot_average_spikes_in_template.plotItem.setTitle('Average spikes in template {}.  Spike number = {}'.
                                                           format(current_template_index, number_of_spikes))
 
 
     def update_marking_led():
         global current_template_index
-        if template_marking[current_template_index]:
+        root = template_store.roots[current_template_index]
+        if root != current_template_index:
+            label_led_marking.setText('MERGED INTO {}'.format(root))
+            label_led_marking.setPalette(merged_palette)
+        elif template_store.marking[current_template_index]:
             label_led_marking.setText('KEPT')
             label_led_marking.setPalette(kept_palette)
         else:
             label_led_marking.setText('DELETED')
             label_led_marking.setPalette(deleted_palette)
 
+    def update_merged_templates(changed_templates):
+        # the averages of the changed templates are derived again from the sums and their plots recomputed
+        for t in changed_templates:
+            data[t] = template_store.average(t)
+        template_cache.invalidate(np.flatnonzero(np.in1d(template_store.roots, changed_templates)).tolist() +
+                                  list(changed_templates))
+        update_all_plots()
+
     def on_press_button_next():
         global current_template_index
         current_template_index += 1
@@ -154,15 +187,26 @@ def cleanup_kilosorted_data(base_folder, number_of_channels_in_binary_file, bina
 
     def on_keep():
         global current_template_index
-        template_marking[current_template_index] = 1
+        template_store.mark(current_template_index, True)
         update_marking_led()
-        np.save(join(base_folder, 'template_marking.npy'), template_marking)
 
     def on_delete():
         global current_template_index
-        template_marking[current_template_index] = 0
+        template_store.mark(current_template_index, False)
         update_marking_led()
-        np.save(join(base_folder, 'template_marking.npy'), template_marking)
+
+    def on_merge():
+        try:
+            templates_to_merge = [int(t) for t in line_edit_merge.text().replace(',', ' ').split()]
+        except ValueError:
+            print('The templates to merge must be template numbers separated by spaces or commas')
+            return
+        templates_to_merge = [t for t in templates_to_merge if 0 <= t < number_of_templates]
+        line_edit_merge.clear()
+        update_merged_templates(template_store.merge(current_template_index, templates_to_merge))
+
+    def on_undo():
+        update_merged_templates(template_store.undo())
 
     def on_slider_update():
         global visibility_threshold
@@ -172,6 +216,11 @@ def cleanup_kilosorted_data(base_folder, number_of_channels_in_binary_file, bina
 
     # Main window and layout-----
     app = QtGui.QApplication([])
+    app.aboutToQuit.connect(template_cache.shutdown)
+    app.aboutToQuit.connect(template_store.close)
+    redraw_timer = QtCore.QTimer()
+    redraw_timer.setSingleShot(True)
+    redraw_timer.timeout.connect(update_all_plots)
     main_window = QtGui.QMainWindow()
     main_window.setWindowTitle('Clear kilosort results')
     main_window.resize(800,800)
@@ -223,6 +272,18 @@ def cleanup_kilosorted_data(base_folder, number_of_channels_in_binary_file, bina
     button_add = QtGui.QPushButton('Keep')
     button_add.clicked.connect(on_keep)
     grid_layout.addWidget(button_add, 5, 2, 1, 1)
+
+    line_edit_merge = QtGui.QLineEdit()
+    line_edit_merge.setPlaceholderText('Templates to merge into this one')
+    grid_layout.addWidget(line_edit_merge, 7, 0, 1, 1)
+
+    button_merge = QtGui.QPushButton('Merge')
+    button_merge.clicked.connect(on_merge)
+    grid_layout.addWidget(button_merge, 7, 1, 1, 1)
+
+    button_undo = QtGui.QPushButton('Undo')
+    button_undo.clicked.connect(on_undo)
+    grid_layout.addWidget(button_undo, 7, 2, 1, 1)
     # ----------------------------
 
     # Slider for visibility threshold
@@ -245,6 +306,8 @@ def cleanup_kilosorted_data(base_folder, number_of_channels_in_binary_file, bina
     kept_palette.setColor(QtGui.QPalette.Background, QtCore.Qt.green)
     deleted_palette = QtGui.QPalette()
     deleted_palette.setColor(QtGui.QPalette.Background, QtCore.Qt.red)
+    merged_palette = QtGui.QPalette()
+    merged_palette.setColor(QtGui.QPalette.Background, QtCore.Qt.yellow)
     label_led_marking.setPalette(deleted_palette)
     # ----------------------------
 
@@ -370,4 +433,134 @@ def generate_average_over_spikes_per_template_multiprocess(base_folder, binary_d
     np.save(join(base_folder, 'avg_spike_template.npy'), data)
 
 
+def _spikes_in_recording(spike_times, binary_data_filename, number_of_channels_in_binary_file,
+                         cut_time_points_around_spike):
+    """
+    Which spikes have cut_time_points_around_spike time points before and after them in the recording (the spikes the
+    averages are calculated from)
+    """
+    data_raw = np.memmap(binary_data_filename, dtype=np.int16, mode='r')
+    number_of_timepoints_in_raw = int(data_raw.shape[0] / number_of_channels_in_binary_file)
+    del data_raw
+    return (spike_times >= cut_time_points_around_spike) & \
+           (spike_times <= number_of_timepoints_in_raw - cut_time_points_around_spike)
+
+
+def _accumulate_template_sums(binary_data_filename, number_of_channels_in_binary_file, first_time_point,
+                              last_time_point, spike_times, spike_templates, active_channel_map,
+                              cut_time_points_around_spike, chunk_time_points, spikes_per_batch, sums):
+    """
+    Adds the windows of all spikes with times in [first_time_point, last_time_point) to the sums (templates x channels
+    x time points) of their templates, reading the raw data sequentially in chunks of chunk_time_points.
+    The spike_times must be sorted and far enough from the start and end of the recording.
+    """
+    data_raw = np.memmap(binary_data_filename, dtype=np.int16, mode='r')
+    number_of_timepoints_in_raw = int(data_raw.shape[0] / number_of_channels_in_binary_file)
+    # time x channels view (the binary file is time major)
+    data_raw_matrix = np.reshape(data_raw[:number_of_timepoints_in_raw * number_of_channels_in_binary_file],
+                                 (number_of_timepoints_in_raw, number_of_channels_in_binary_file))
+    window = np.arange(-cut_time_points_around_spike, cut_time_points_around_spike)
+
+    for chunk_start in np.arange(first_time_point, last_time_point, chunk_time_points):
+        chunk_end = min(chunk_start + chunk_time_points, last_time_point)
+        first_spike, last_spike = np.searchsorted(spike_times, [chunk_start, chunk_end])
+        if first_spike == last_spike:
+            continue
+        read_start = max(chunk_start - cut_time_points_around_spike, 0)
+        read_end = min(chunk_end + cut_time_points_around_spike, number_of_timepoints_in_raw)
+        chunk = np.array(data_raw_matrix[read_start:read_end, active_channel_map])
+
+        for batch_start in np.arange(first_spike, last_spike, spikes_per_batch):
+            batch_end = min(batch_start + spikes_per_batch, last_spike)
+            time_indices = (spike_times[batch_start:batch_end] - read_start)[:, np.newaxis] + window
+            windows = np.transpose(chunk[time_indices], (0, 2, 1)).astype(np.float64)
+            np.add.at(sums, spike_templates[batch_start:batch_end], windows)
+
+
+def _accumulate_template_sums_in_shared_memory(shared_memory_name, sums_shape, worker, *args):
+    shared_sums = shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        sums = np.ndarray(sums_shape, dtype=np.float64, buffer=shared_sums.buf)[worker]
+        _accumulate_template_sums(*args, sums)
+    finally:
+        shared_sums.close()
+
+
+def generate_average_over_spikes_per_template_streaming(base_folder, binary_data_filename,
+                                                        number_of_channels_in_binary_file,
+                                                        cut_time_points_around_spike=100, chunk_time_points=2**18,
+                                                        spikes_per_batch=None, max_batch_bytes=2**28, n_jobs=1):
+    """
+    Same result as generate_average_over_spikes_per_template but with one sequential read of the raw data.
+    The recording is read in chunks of chunk_time_points and every spike window in a chunk is added (np.add.at) to
+    the running sum of its template.
+    The windows are added spikes_per_batch at a time. If spikes_per_batch is None it is the number of (float64)
+    windows that fit in max_batch_bytes (e.g. 116 spikes for 1440 channels and 200 time points in 256MB).
+    If n_jobs > 1 the recording's time range is split in n_jobs parts read by different processes, each adding into
+    its own templates x channels x time points sums in shared memory (so n_jobs times the memory of the averages) that
+    are added together at the end.
+    The averages are saved in avg_spike_template.npy and returned. The sums and the numbers of spikes are saved in
+    template_sums.npy and template_spike_counts.npy.
+    """
+    channel_map = np.load(join(base_folder, 'channel_map.npy'))
+    active_channel_map = np.squeeze(channel_map, axis=1)
 
+    spike_templates = np.squeeze(np.load(join(base_folder, r'spike_templates.npy')))
+    template_feature_ind = np.load(join(base_folder, 'template_feature_ind.npy'))
+    number_of_templates = template_feature_ind.shape[0]
+
+    spike_times = np.squeeze(np.load(join(base_folder, 'spike_times.npy')).astype(np.int64))
+
+    num_of_channels = active_channel_map.size
+
+    data_raw = np.memmap(binary_data_filename, dtype=np.int16, mode='r')
+    number_of_timepoints_in_raw = int(data_raw.shape[0] / number_of_channels_in_binary_file)
+    del data_raw
+
+    # remove any spikes that don't have enough time points and sort the rest in time
+    in_time = _spikes_in_recording(spike_times, binary_data_filename, number_of_channels_in_binary_file,
+                                   cut_time_points_around_spike)
+    order = np.argsort(spike_times[in_time], kind='stable')
+    spike_times = spike_times[in_time][order]
+    spike_templates = spike_templates[in_time][order]
+    num_of_spikes_in_templates = np.bincount(spike_templates, minlength=number_of_templates)
+
+    sums_shape = (number_of_templates, num_of_channels, cut_time_points_around_spike * 2)
+    if spikes_per_batch is None:
+        spikes_per_batch = max(int(max_batch_bytes // (num_of_channels * cut_time_points_around_spike * 2 * 8)), 1)
+    args = (binary_data_filename, number_of_channels_in_binary_file)
+    spike_args = (spike_times, spike_templates, active_channel_map, cut_time_points_around_spike, chunk_time_points,
+                  spikes_per_batch)
+    if n_jobs <= 1:
+        sums = np.zeros(sums_shape)
+        _accumulate_template_sums(*args, 0, number_of_timepoints_in_raw, *spike_args, sums)
+    else:
+        all_sums_shape = (n_jobs,) + sums_shape
+        shared_sums = shared_memory.SharedMemory(create=True, size=int(np.prod(all_sums_shape)) * 8)
+        try:
+            all_sums = np.ndarray(all_sums_shape, dtype=np.float64, buffer=shared_sums.buf)
+            all_sums[:] = 0
+            boundaries = np.linspace(0, number_of_timepoints_in_raw, n_jobs + 1).astype(np.int64)
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(_accumulate_template_sums_in_shared_memory, shared_sums.name,
+                                           all_sums_shape, worker, *args, boundaries[worker],
+                                           boundaries[worker + 1], *spike_args)
+                           for worker in np.arange(n_jobs)]
+                for future in futures:
+                    future.result()
+            sums = np.sum(all_sums, axis=0)
+            del all_sums
+        finally:
+            shared_sums.close()
+            shared_sums.unlink()
+
+    with np.errstate(invalid='ignore'):
+        data = sums / num_of_spikes_in_templates[:, np.newaxis, np.newaxis]
+    data[num_of_spikes_in_templates == 0] = 0
+    print('Averaged ' + str(len(spike_times)) + ' spikes in ' + str(number_of_templates) + ' templates')
+
+    np.save(join(base_folder, 'avg_spike_template.npy'), data)
+    # the sums the cleanup gui's TemplateStore derives the averages of merged templates from
+    np.save(join(base_folder, 'template_sums.npy'), sums)
+    np.save(join(base_folder, 'template_spike_counts.npy'), num_of_spikes_in_templates.astype(np.int64))
+    return data
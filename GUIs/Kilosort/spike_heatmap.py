@@ -8,7 +8,10 @@ Version:            0.2.0
 import numpy as np
 import scipy.stats as stats
 import scipy.interpolate as interpolate
+from scipy import sparse
+from scipy.spatial import Delaunay
 import os.path as op
+from functools import lru_cache
 from six import exec_
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -40,21 +43,14 @@ def peaktopeak(data, window_size=60):
     lower_bound = int(num_time_points / 2.0 - window_size / 2.0)
     upper_bound = int(num_time_points / 2.0 + window_size / 2.0)
 
-    argminima = np.zeros(num_channels)
-    for m in range(num_channels):
-        argminima[m] = np.argmin(extracellular_avg_microvolts[m][lower_bound:upper_bound])+lower_bound
+    window = np.asarray(extracellular_avg_microvolts[:, lower_bound:upper_bound])
+    channels = np.arange(num_channels)
 
-    argmaxima = np.zeros(num_channels)
-    for n in range(num_channels):
-        argmaxima[n] = np.argmax(extracellular_avg_microvolts[n][lower_bound:upper_bound])+lower_bound
+    argminima = (np.argmin(window, axis=1) + lower_bound).astype(np.float64)
+    argmaxima = (np.argmax(window, axis=1) + lower_bound).astype(np.float64)
 
-    maxima = np.zeros(num_channels)
-    for p in range(num_channels):
-            maxima[p] = np.max(extracellular_avg_microvolts[p][lower_bound:upper_bound])
-
-    minima = np.zeros(num_channels)
-    for k in range(num_channels):
-        minima[k] = np.min(extracellular_avg_microvolts[k][lower_bound:upper_bound])
+    maxima = window[channels, argmaxima.astype(np.int64) - lower_bound].astype(np.float64)
+    minima = window[channels, argminima.astype(np.int64) - lower_bound].astype(np.float64)
 
     p2p = maxima-minima
 
@@ -84,6 +80,75 @@ def get_probe_geometry_from_prb_file(prb_file):
     return shanks
 
 
+def _channel_coordinates(channel_positions, rotate_90=False, flip_ud=False, flip_lr=False, hpos=0, vpos=0,
+                         width=None, height=None):
+    """
+    The (x, y) coordinates of the electrodes (in the order of the channel_positions index) after the rotation, flips,
+    scaling and offsets of plot_topoplot
+    """
+    channel_positions = channel_positions.sort_index(ascending=[1])
+    if not rotate_90:
+        channel_positions = np.array([[x, y] for x, y in channel_positions.values])
+        if flip_ud:
+            channel_positions[:, 1] = np.abs(channel_positions[:, 1] - np.max(channel_positions[:, 1]))
+        if flip_lr:
+            channel_positions[:, 0] = np.abs(channel_positions[:, 0] - np.max(channel_positions[:, 0]))
+    else:
+        channel_positions = np.array([[y, x] for x, y in channel_positions.values])
+        if flip_ud:
+            channel_positions[:, 0] = np.abs(channel_positions[:, 0] - np.max(channel_positions[:, 0]))
+        if flip_lr:
+            channel_positions[:, 1] = np.abs(channel_positions[:, 1] - np.max(channel_positions[:, 1]))
+
+    all_coordinates = channel_positions
+
+    natural_width = np.max(all_coordinates[:, 0]) - np.min(all_coordinates[:, 0])
+    natural_height = np.max(all_coordinates[:, 1]) - np.min(all_coordinates[:, 1])
+
+    if not width and not height:
+        x_scaling = 1
+        y_scaling = 1
+    elif not width and height:
+        y_scaling = height/natural_height
+        x_scaling = y_scaling
+    elif width and not height:
+        x_scaling = width/natural_width
+        y_scaling = x_scaling
+    elif width and height:
+        x_scaling = width/natural_width
+        y_scaling = height/natural_height
+
+    chan_x = channel_positions[:, 0] * x_scaling + hpos
+    chan_y = channel_positions[:, 1] * y_scaling + vpos
+    chan_x = np.max(chan_x) - chan_x
+    return chan_x, chan_y
+
+
+def _interpolation_grid(chan_x, chan_y, gridscale=1, interpolation_method="bicubic"):
+    """
+    The pixel grid (xi, yi) the electrode values are interpolated on and its horizontal and vertical limits
+    """
+    hlim = [np.min(chan_y), np.max(chan_y)]
+    vlim = [np.min(chan_x), np.max(chan_x)]
+
+    if interpolation_method != 'none':
+        yi, xi = np.mgrid[hlim[0]:hlim[1]:complex(0, gridscale)*(hlim[1]-hlim[0]),
+                          vlim[0]:vlim[1]:complex(0, gridscale)*(vlim[1]-vlim[0])]
+    else:
+        yi, xi = np.mgrid[hlim[0]:hlim[1]+1, vlim[0]:vlim[1]+1]
+    return xi, yi, hlim, vlim
+
+
+def _show_heatmap(axis, zi, chan_x, chan_y, hlim, vlim, vmin, vmax, interpolation_method):
+    cmap = plt.get_cmap("jet")
+    image = axis.imshow(zi.T, cmap=cmap, origin=['lower'], vmin=vmin,
+                        vmax=vmax, interpolation=interpolation_method,
+                        extent=[hlim[0], hlim[1], vlim[0], vlim[1]],
+                        aspect='equal')
+    channels_grid = axis.scatter(chan_y, chan_x, s=0.5)
+    return image, channels_grid
+
+
 def plot_topoplot(axis, channel_positions, data, show=True, rotate_90=False, flip_ud=False, flip_lr=False, **kwargs):
     """
     This function interpolates the data between electrodes and plots it into
@@ -145,50 +210,10 @@ def plot_topoplot(axis, channel_positions, data, show=True, rotate_90=False, fli
         These will create unexpected results in the interpolation. \
         Deal with them.')
 
-    channel_positions = channel_positions.sort_index(ascending=[1])
-    if not rotate_90:
-        channel_positions = np.array([[x, y] for x, y in channel_positions.values])
-        if flip_ud:
-            channel_positions[:, 1] = np.abs(channel_positions[:, 1] - np.max(channel_positions[:, 1]))
-        if flip_lr:
-            channel_positions[:, 0] = np.abs(channel_positions[:, 0] - np.max(channel_positions[:, 0]))
-    else:
-        channel_positions = np.array([[y, x] for x, y in channel_positions.values])
-        if flip_ud:
-            channel_positions[:, 0] = np.abs(channel_positions[:, 0] - np.max(channel_positions[:, 0]))
-        if flip_lr:
-            channel_positions[:, 1] = np.abs(channel_positions[:, 1] - np.max(channel_positions[:, 1]))
-
-    all_coordinates = channel_positions
-
-    natural_width = np.max(all_coordinates[:, 0]) - np.min(all_coordinates[:, 0])
-    natural_height = np.max(all_coordinates[:, 1]) - np.min(all_coordinates[:, 1])
-
-    if not width and not height:
-        x_scaling = 1
-        y_scaling = 1
-    elif not width and height:
-        y_scaling = height/natural_height
-        x_scaling = y_scaling
-    elif width and not height:
-        x_scaling = width/natural_width
-        y_scaling = x_scaling
-    elif width and height:
-        x_scaling = width/natural_width
-        y_scaling = height/natural_height
-
-    chan_x = channel_positions[:, 0] * x_scaling + hpos
-    chan_y = channel_positions[:, 1] * y_scaling + vpos
-    chan_x = np.max(chan_x) - chan_x
-
-    hlim = [np.min(chan_y), np.max(chan_y)]
-    vlim = [np.min(chan_x), np.max(chan_x)]
-
-    if interpolation_method is not 'none':
-        yi, xi = np.mgrid[hlim[0]:hlim[1]:complex(0, gridscale)*(hlim[1]-hlim[0]),
-                          vlim[0]:vlim[1]:complex(0, gridscale)*(vlim[1]-vlim[0])]
-    else:
-        yi, xi = np.mgrid[hlim[0]:hlim[1]+1, vlim[0]:vlim[1]+1]
+    chan_x, chan_y = _channel_coordinates(channel_positions, rotate_90=rotate_90, flip_ud=flip_ud, flip_lr=flip_lr,
+                                          hpos=hpos, vpos=vpos, width=width, height=height)
+    xi, yi, hlim, vlim = _interpolation_grid(chan_x, chan_y, gridscale=gridscale,
+                                             interpolation_method=interpolation_method)
 
     zi = interpolate.griddata((chan_x, chan_y), data, (xi, yi))
 
@@ -199,12 +224,8 @@ def plot_topoplot(axis, channel_positions, data, show=True, rotate_90=False, fli
         vmin = zlimits[0]
         vmax = zlimits[1]
 
-    cmap = plt.get_cmap("jet")
-    image = axis.imshow(zi.T, cmap=cmap, origin=['lower'], vmin=vmin,
-                        vmax=vmax, interpolation=interpolation_method,
-                        extent=[hlim[0], hlim[1], vlim[0], vlim[1]],
-                        aspect='equal').make_image(renderer=None)
-    channels_grid = axis.scatter(chan_y, chan_x, s=0.5)
+    image, channels_grid = _show_heatmap(axis, zi, chan_x, chan_y, hlim, vlim, vmin, vmax, interpolation_method)
+    image = image.make_image(renderer=None)
 
     if show:
         cb = plt.colorbar(image)
@@ -212,6 +233,141 @@ def plot_topoplot(axis, channel_positions, data, show=True, rotate_90=False, fli
     return image, channels_grid
 
 
+def interpolation_weights(chan_x, chan_y, xi, yi):
+    """
+    The linear interpolation of griddata(method='linear') written as a sparse matrix. Every pixel of the grid (xi, yi)
+    is the barycentric average of the three electrodes of the Delaunay triangle it falls in, so for any electrode
+    values v the interpolated image is weights.dot(v) (with NaN on the pixels outside the electrodes' convex hull).
+
+    Parameters
+    ----------
+    chan_x, chan_y: the coordinates of the electrodes
+    xi, yi: the coordinates of the pixels
+
+    Returns
+    -------
+    weights: (pixels x electrodes) csr matrix
+    outside: boolean array (of the shape of xi) with the pixels outside the convex hull
+    """
+    triangulation = Delaunay(np.column_stack((chan_x, chan_y)))
+    pixels = np.column_stack((np.ravel(xi), np.ravel(yi)))
+    simplices = triangulation.find_simplex(pixels)
+    inside = simplices >= 0
+
+    transforms = triangulation.transform[simplices[inside]]
+    barycentric = np.einsum('nij,nj->ni', transforms[:, :2, :], pixels[inside] - transforms[:, 2, :])
+    barycentric = np.column_stack((barycentric, 1 - np.sum(barycentric, axis=1)))
+
+    rows = np.repeat(np.flatnonzero(inside), 3)
+    columns = np.ravel(triangulation.simplices[simplices[inside]])
+    weights = sparse.csr_matrix((np.ravel(barycentric), (rows, columns)), shape=(len(pixels), len(chan_x)))
+    return weights, np.reshape(~inside, np.shape(xi))
+
+
+def _channel_positions_of_shanks(probe, bad_channels=None, num_of_shanks=None, shanks_from_groups=False):
+    # the same split of the (good) electrodes of the probe's first group into shanks as the heatmap functions (or, if
+    # shanks_from_groups, every channel group of the probe as a shank like t_sne_bhcuda.spike_heatmap)
+    if shanks_from_groups:
+        shanks = []
+        for group in sorted(probe.keys()):
+            channel_positions = pd.Series(probe[group]['geometry'])
+            if bad_channels is not None:
+                channel_positions = channel_positions.drop([c for c in bad_channels if c in channel_positions.index])
+            shanks.append(channel_positions)
+        return shanks
+
+    if num_of_shanks is None:
+        num_of_shanks = len(list(probe.keys()))
+
+    channel_positions = pd.Series(probe[0]['geometry'])
+    if bad_channels is not None:
+        channel_positions = channel_positions.drop(bad_channels)
+        channel_positions.index = np.arange(len(channel_positions))
+
+    total_electrodes = len(channel_positions)
+    electrodes_per_shank = int(total_electrodes / num_of_shanks)
+
+    shanks = []
+    for shank in np.arange(num_of_shanks):
+        begin_electrode = shank * electrodes_per_shank
+        end_electrode = (shank + 1) * electrodes_per_shank
+        if shank == num_of_shanks - 1:
+            end_electrode = total_electrodes
+        shanks.append(channel_positions[begin_electrode:end_electrode])
+    return shanks
+
+
+class HeatmapOperator:
+    """
+    Everything of a probe's heatmap that depends only on the probe geometry (the electrode coordinates and pixel grid
+    of every shank and one sparse channels -> pixels interpolation matrix for all the shanks). Interpolating the p2p
+    of a template is then a single sparse matrix - vector product.
+    Use heatmap_operator() to get the (cached) operator of a prb file.
+    """
+    def __init__(self, probe, bad_channels=None, num_of_shanks=None, rotate_90=False, flip_ud=False, flip_lr=False,
+                 gridscale=1, interpolation_method="bicubic", shanks_from_groups=False):
+        self.interpolation_method = interpolation_method
+        self.shanks = []
+        weights = []
+        channels = []
+        for channel_positions_shank in _channel_positions_of_shanks(probe, bad_channels, num_of_shanks,
+                                                                    shanks_from_groups):
+            chan_x, chan_y = _channel_coordinates(channel_positions_shank, rotate_90=rotate_90, flip_ud=flip_ud,
+                                                  flip_lr=flip_lr)
+            xi, yi, hlim, vlim = _interpolation_grid(chan_x, chan_y, gridscale=gridscale,
+                                                     interpolation_method=interpolation_method)
+            shank_weights, outside = interpolation_weights(chan_x, chan_y, xi, yi)
+            weights.append(shank_weights)
+            channels.append(np.sort(channel_positions_shank.index.values))
+            self.shanks.append({'chan_x': chan_x, 'chan_y': chan_y, 'hlim': hlim, 'vlim': vlim,
+                                'grid_shape': np.shape(xi), 'outside': outside,
+                                'channels': np.sort(channel_positions_shank.index.values).astype(np.int64)})
+
+        self.channels = np.concatenate(channels).astype(np.int64)
+        self.weights = sparse.block_diag(weights, format='csr')
+        self.pixel_offsets = np.cumsum([0] + [w.shape[0] for w in weights])
+
+    def interpolate(self, values):
+        """
+        values: the value (e.g. p2p) of every channel of the data
+
+        Returns the list of the interpolated images (zi) of the shanks
+        """
+        pixels = self.weights.dot(np.asarray(values, dtype=np.float64)[self.channels])
+        images = []
+        for shank, info in enumerate(self.shanks):
+            zi = np.reshape(pixels[self.pixel_offsets[shank]:self.pixel_offsets[shank + 1]], info['grid_shape'])
+            zi[info['outside']] = np.nan
+            images.append(zi)
+        return images
+
+
+@lru_cache(maxsize=16)
+def _cached_heatmap_operator(path, modification_time, bad_channels, num_of_shanks, rotate_90, flip_ud, flip_lr,
+                             gridscale, interpolation_method, shanks_from_groups):
+    probe = get_probe_geometry_from_prb_file(path)
+    if bad_channels is not None:
+        bad_channels = list(bad_channels)
+    return HeatmapOperator(probe, bad_channels=bad_channels, num_of_shanks=num_of_shanks, rotate_90=rotate_90,
+                           flip_ud=flip_ud, flip_lr=flip_lr, gridscale=gridscale,
+                           interpolation_method=interpolation_method, shanks_from_groups=shanks_from_groups)
+
+
+def heatmap_operator(prb_file, bad_channels=None, num_of_shanks=None, rotate_90=False, flip_ud=False, flip_lr=False,
+                     gridscale=1, interpolation_method="bicubic", shanks_from_groups=False):
+    """
+    The HeatmapOperator of a probe. Operators are cached per (prb file, bad channels, shank layout, grid), so only the
+    first heatmap of a probe pays for the triangulation. A changed prb file (new modification time) gets a new one.
+    If shanks_from_groups every channel group of the prb file is a shank (num_of_shanks is then not used), otherwise the
+    first group is split in num_of_shanks shanks.
+    """
+    path = op.realpath(op.expanduser(prb_file))
+    if bad_channels is not None:
+        bad_channels = tuple(int(channel) for channel in np.ravel(bad_channels))
+    return _cached_heatmap_operator(path, op.getmtime(path), bad_channels, num_of_shanks, rotate_90, flip_ud, flip_lr,
+                                    gridscale, interpolation_method, shanks_from_groups)
+
+
 def create_heatmap_image(data, prb_file, window_size=60, bad_channels=None, num_of_shanks=None,
                          rotate_90=False, flip_ud=False, flip_lr=False):
     """
@@ -237,31 +393,17 @@ def create_heatmap_image(data, prb_file, window_size=60, bad_channels=None, num_
     zlimits[0] = p2p.min()
     zlimits[1] = p2p.max()
 
-    probe = get_probe_geometry_from_prb_file(prb_file)
-
-    if num_of_shanks is None:
-        num_of_shanks = len(list(probe.keys()))
+    operator = heatmap_operator(prb_file, bad_channels=bad_channels, num_of_shanks=num_of_shanks, rotate_90=rotate_90,
+                                flip_ud=flip_ud, flip_lr=flip_lr)
+    interpolated = operator.interpolate(p2p)
 
     fig = plt.figure()
 
-    channel_positions = pd.Series(probe[0]['geometry'])
-    if bad_channels is not None:
-        channel_positions = channel_positions.drop(bad_channels)
-        channel_positions.index = np.arange(len(channel_positions))
-
-    total_electrodes = len(channel_positions)
-    electrodes_per_shank = int(total_electrodes / num_of_shanks)
-
-    for shank in np.arange(num_of_shanks):
-        ax = fig.add_subplot(1, num_of_shanks, shank + 1)
-        begin_electrode = shank * electrodes_per_shank
-        end_electrode = (shank + 1) * electrodes_per_shank
-        if shank == num_of_shanks - 1:
-            end_electrode = total_electrodes
-        channel_positions_shank = channel_positions[begin_electrode:end_electrode]
-        data = p2p[channel_positions_shank.index]
-        image, channels_grid = plot_topoplot(ax, channel_positions_shank, data, show=False, rotate_90=rotate_90,
-                                             flip_ud=flip_ud, flip_lr=flip_lr, zlimits=zlimits)
+    for shank, info in enumerate(operator.shanks):
+        ax = fig.add_subplot(1, len(operator.shanks), shank + 1)
+        image, channels_grid = _show_heatmap(ax, interpolated[shank], info['chan_x'], info['chan_y'], info['hlim'],
+                                             info['vlim'], zlimits[0], zlimits[1], operator.interpolation_method)
+        image = image.make_image(renderer=None)
 
         temp_image = image[0]
 
@@ -304,38 +446,55 @@ def create_heatmap_on_matplotlib_widget(widget, data, prb_file, window_size=60,
     -------
     Nothing. Just fills the widget with the image generated
     """
+    operator, interpolated, zlimits = interpolate_heatmap(data, prb_file, window_size=window_size,
+                                                          bad_channels=bad_channels, num_of_shanks=num_of_shanks,
+                                                          rotate_90=rotate_90, flip_ud=flip_ud, flip_lr=flip_lr)
+    draw_heatmap_on_matplotlib_widget(widget, operator, interpolated, zlimits)
+
+
+def interpolate_heatmap(data, prb_file, window_size=60, bad_channels=None, num_of_shanks=None, rotate_90=False,
+                        flip_ud=False, flip_lr=False):
+    """
+    The part of create_heatmap_on_matplotlib_widget that does not touch the widget (so it can run on another thread)
+
+    Returns
+    -------
+    operator: the HeatmapOperator of the probe
+    interpolated: the list of the interpolated p2p images of the shanks
+    zlimits: the color limits
+    """
     _, _, _, _, p2p = peaktopeak(data, window_size=window_size)
     zlimits = [p2p.min(), p2p.max()]
 
-    probe = get_probe_geometry_from_prb_file(prb_file)
+    operator = heatmap_operator(prb_file, bad_channels=bad_channels, num_of_shanks=num_of_shanks, rotate_90=rotate_90,
+                                flip_ud=flip_ud, flip_lr=flip_lr)
+    interpolated = operator.interpolate(p2p)
+    return operator, interpolated, zlimits
 
-    if num_of_shanks is None:
-        num_of_shanks = len(list(probe.keys()))
 
+def draw_heatmap_on_matplotlib_widget(widget, operator, interpolated, zlimits):
+    """
+    Draws the result of interpolate_heatmap on the widget
+    """
     fig = widget.getFigure()
+
+    # If the widget already shows a heatmap of the same probe just swap the images' data
+    shown = getattr(widget, '_heatmap_images', None)
+    if shown is not None and shown[0] is operator and all(image.axes in fig.axes for image in shown[1]):
+        for image, zi in zip(shown[1], interpolated):
+            image.set_data(zi.T)
+            image.set_clim(zlimits[0], zlimits[1])
+        return
+
     fig.clf(True)
     fig.set_tight_layout({'rect': [0, 0, 1, 1]})
     fig.canvas.toolbar.hide()
 
-    channel_positions = pd.Series(probe[0]['geometry'])
-    if bad_channels is not None:
-        channel_positions = channel_positions.drop(bad_channels)
-        channel_positions.index = np.arange(len(channel_positions))
-
-    total_electrodes = len(channel_positions)
-    electrodes_per_shank = int(total_electrodes / num_of_shanks)
-
-    for shank in np.arange(num_of_shanks):
-        ax = fig.add_subplot(1, num_of_shanks, shank + 1)
+    images = []
+    for shank, info in enumerate(operator.shanks):
+        ax = fig.add_subplot(1, len(operator.shanks), shank + 1)
         ax.set_axis_off()
-        begin_electrode = shank * electrodes_per_shank
-        end_electrode = (shank + 1) * electrodes_per_shank
-        if shank == num_of_shanks - 1:
-            end_electrode = total_electrodes
-        channel_positions_shank = channel_positions[begin_electrode:end_electrode]
-        data = p2p[channel_positions_shank.index]
-        image, channels_grid = plot_topoplot(ax, channel_positions_shank, data, show=False, rotate_90=rotate_90,
-                                             flip_ud=flip_ud, flip_lr=flip_lr, zlimits=zlimits)
-
-
-
+        image, channels_grid = _show_heatmap(ax, interpolated[shank], info['chan_x'], info['chan_y'], info['hlim'],
+                                             info['vlim'], zlimits[0], zlimits[1], operator.interpolation_method)
+        images.append(image)
+    widget._heatmap_images = (operator, images)
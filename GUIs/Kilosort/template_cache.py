@@ -0,0 +1,109 @@
+
+"""
+Background computation and caching of what the Kilosort cleanup gui (clean_kilosort_templates.py) shows for every
+template, so that stepping through the templates only draws.
+
+A worker thread computes the artifacts (the result of compute_function(template_index)) of the templates around the
+current one and keeps them in a bounded least recently used cache. Requests for templates that are not ready yet
+return None (the gui polls again) instead of blocking the gui thread.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TemplateCache:
+    """
+    compute_function -- computes the artifacts of a template index (called on the worker thread so it must not touch
+                        any Qt or matplotlib object)
+    number_of_templates -- the valid template indices are 0 to number_of_templates - 1
+    neighbours -- the number of templates after and before the current one that are prefetched
+    max_entries -- the maximum number of templates kept in the cache
+    """
+    def __init__(self, compute_function, number_of_templates, neighbours=5, max_entries=64, max_workers=1):
+        self.compute_function = compute_function
+        self.number_of_templates = number_of_templates
+        self.neighbours = neighbours
+        self.max_entries = max(max_entries, 2 * neighbours + 1)
+
+        self._cache = OrderedDict()
+        self._pending = {}
+        # bumped on invalidation so results computed from stale data are not stored
+        self._generation = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _compute_and_store(self, template_index, generation):
+        artifacts = self.compute_function(template_index)
+        with self._lock:
+            if self._generation.get(template_index, 0) == generation:
+                self._cache[template_index] = artifacts
+                self._cache.move_to_end(template_index)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+            if self._pending.get(template_index, (None, None))[1] == generation:
+                del self._pending[template_index]
+        return artifacts
+
+    def _submit(self, template_index):
+        # must be called with the lock held
+        if template_index in self._cache or template_index in self._pending:
+            return
+        generation = self._generation.get(template_index, 0)
+        future = self._executor.submit(self._compute_and_store, template_index, generation)
+        self._pending[template_index] = (future, generation)
+
+    def get(self, template_index):
+        """
+        The artifacts of template_index if they are ready, otherwise None (after queueing their computation before
+        any prefetching)
+        """
+        with self._lock:
+            if template_index in self._cache:
+                self._cache.move_to_end(template_index)
+                return self._cache[template_index]
+            if template_index in self._pending:
+                future = self._pending[template_index][0]
+                if future.done() and not future.cancelled() and future.exception() is not None:
+                    # report the error of a failed computation on the calling thread (it is retried next time)
+                    del self._pending[template_index]
+                    raise future.exception()
+            self._submit(template_index)
+        return None
+
+    def prefetch_around(self, template_index):
+        """
+        Queues the templates around template_index (nearest first) and cancels the queued ones that are not
+        around it any more
+        """
+        wanted = [template_index]
+        for offset in range(1, self.neighbours + 1):
+            wanted += [template_index + offset, template_index - offset]
+        wanted = [t for t in wanted if 0 <= t < self.number_of_templates]
+        with self._lock:
+            for t in list(self._pending.keys()):
+                if t not in wanted and self._pending[t][0].cancel():
+                    del self._pending[t]
+            for t in wanted:
+                self._submit(t)
+
+    def invalidate(self, template_indices=None):
+        """
+        Drops the cached artifacts of template_indices (of all templates if None), e.g. after templates are merged
+        """
+        with self._lock:
+            if template_indices is None:
+                template_indices = list(self._cache.keys()) + list(self._pending.keys())
+            for t in template_indices:
+                self._generation[t] = self._generation.get(t, 0) + 1
+                self._cache.pop(t, None)
+                if t in self._pending:
+                    self._pending[t][0].cancel()
+                    del self._pending[t]
+
+    def shutdown(self):
+        with self._lock:
+            for future, _ in self._pending.values():
+                future.cancel()
+            self._pending = {}
+        self._executor.shutdown(wait=False)
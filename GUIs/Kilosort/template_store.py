@@ -0,0 +1,242 @@
+
+"""
+State of the Kilosort cleanup gui (clean_kilosort_templates.py): the marking (kept or deleted) of every template, the
+merges of templates and the spike counts and waveform sums the averages are derived from.
+
+The per template spike counts and waveform sums (templates x channels x time points) of the original Kilosort
+templates are written once (template_spike_counts.npy and template_sums.npy) and never change. A merge only records
+which template every original template now belongs to (its root), so the average of a merged template is the sum of
+the sums of its original templates divided by the sum of their counts, without going back to the raw data.
+
+Every edit (marking or merge) is appended (and fsynced) as one json line with the templates it changes to
+template_store.journal. Every compact_every edits (and on close) the marking and the roots are written to a small
+snapshot (template_store.npz), template_marking.npy and template_merged_into.npy are re-exported for the code that
+reads them and the journal is emptied. avg_spike_template.npy is never rewritten.
+"""
+import json
+import numpy as np
+from os import fsync, replace
+from os.path import join, isfile
+
+
+def _atomic_write(filename, write_function):
+    """
+    Writes through write_function(file) into a temporary file that then replaces filename, so a crash while writing
+    never leaves a half written file behind
+    """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as file:
+        write_function(file)
+        file.flush()
+        fsync(file.fileno())
+    replace(temp_filename, filename)
+
+
+class TemplateStore:
+    """
+    Journaled marking and merges of number_of_templates Kilosort templates.
+
+    base_folder -- the Kilosort folder the store's files are kept in
+    averages, spike_counts -- the average waveform (templates x channels x time points) and the number of spikes
+                              each average was calculated from (not the number of spikes of the template if some
+                              were left out). Only used to create template_sums.npy and template_spike_counts.npy if
+                              they do not exist (generate_average_over_spikes_per_template_streaming saves them)
+
+    marking -- 1 for the kept templates and 0 for the deleted ones (templates merged into another are deleted)
+    roots -- the template every template has been merged into (itself if it has not been merged)
+    counts, sums -- the number of spikes and the waveform sums of the original templates (read only)
+    """
+    def __init__(self, base_folder, number_of_templates, averages=None, spike_counts=None, compact_every=200):
+        self.base_folder = base_folder
+        self.snapshot_file = join(base_folder, 'template_store.npz')
+        self.journal_file = join(base_folder, 'template_store.journal')
+        self.compact_every = compact_every
+
+        self.undo_stack = []
+        self.redo_stack = []
+        self.sequence = 0
+        self._journal = None
+        self._edits_since_compaction = 0
+        self._merged_sums = {}
+
+        self._load_sums(number_of_templates, averages, spike_counts)
+
+        if isfile(self.snapshot_file):
+            self._load_snapshot()
+            self._replay_journal()
+        else:
+            self.roots = np.arange(number_of_templates, dtype=np.int64)
+            if isfile(join(base_folder, 'template_marking.npy')):
+                self.marking = np.load(join(base_folder, 'template_marking.npy')).astype(np.int8)
+            else:
+                self.marking = np.zeros(number_of_templates, dtype=np.int8)
+
+        assert len(self.marking) == number_of_templates, 'The template store has a different number of templates'
+        self.compact()
+
+    # Loading ----------------------------------------------------------------------------------------------------------
+    def _load_sums(self, number_of_templates, averages, spike_counts):
+        sums_file = join(self.base_folder, 'template_sums.npy')
+        counts_file = join(self.base_folder, 'template_spike_counts.npy')
+        if not isfile(sums_file) or not isfile(counts_file):
+            assert averages is not None and spike_counts is not None, \
+                'The template sums do not exist yet, the averages and spike counts are needed to create them'
+            spike_counts = np.asarray(spike_counts, dtype=np.int64)
+            _atomic_write(counts_file, lambda file: np.save(file, spike_counts))
+            _atomic_write(sums_file, lambda file: np.save(file, averages * spike_counts[:, np.newaxis, np.newaxis]))
+        self.counts = np.load(counts_file)
+        self.sums = np.load(sums_file, mmap_mode='r')
+        assert len(self.counts) == number_of_templates, 'The template sums have a different number of templates'
+
+    def _load_snapshot(self):
+        with np.load(self.snapshot_file) as snapshot:
+            self.marking = snapshot['marking'].astype(np.int8)
+            self.roots = snapshot['roots'].astype(np.int64)
+            self.sequence = int(snapshot['sequence'])
+
+    def _replay_journal(self):
+        if not isfile(self.journal_file):
+            return
+        with open(self.journal_file, 'r') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash while it was written (always the last one)
+                    break
+                if entry['sequence'] <= self.sequence:
+                    continue
+                self._apply_entry(entry['kind'], entry['change'])
+                self.sequence = entry['sequence']
+
+    # Applying changes -------------------------------------------------------------------------------------------------
+    def _apply(self, change, inverse=False):
+        templates = np.asarray(change['templates'], dtype=np.int64)
+        when = 'before' if inverse else 'after'
+        touched_roots = np.union1d(self.roots[templates], change['roots_' + when])
+        self.marking[templates] = change['marking_' + when]
+        self.roots[templates] = change['roots_' + when]
+        for root in touched_roots:
+            self._merged_sums.pop(int(root), None)
+        return touched_roots.tolist()
+
+    def _apply_entry(self, kind, change):
+        if kind == 'do':
+            touched_roots = self._apply(change)
+            self.undo_stack.append(change)
+            self.redo_stack = []
+        elif kind == 'undo':
+            touched_roots = self._apply(change, inverse=True)
+            if len(self.undo_stack) > 0:
+                self.undo_stack.pop()
+            self.redo_stack.append(change)
+        else:
+            touched_roots = self._apply(change)
+            if len(self.redo_stack) > 0:
+                self.redo_stack.pop()
+            self.undo_stack.append(change)
+        return touched_roots
+
+    def _write(self, kind, change):
+        self.sequence += 1
+        self._journal.write(json.dumps({'sequence': self.sequence, 'kind': kind, 'change': change}) + '\n')
+        self._journal.flush()
+        fsync(self._journal.fileno())
+        touched_roots = self._apply_entry(kind, change)
+
+        self._edits_since_compaction += 1
+        if self._edits_since_compaction >= self.compact_every:
+            self.compact()
+        return touched_roots
+
+    def _change(self, templates, marking_after, roots_after):
+        templates = np.asarray(templates, dtype=np.int64)
+        return {'templates': templates.tolist(),
+                'marking_before': self.marking[templates].tolist(),
+                'marking_after': np.broadcast_to(marking_after, templates.shape).astype(np.int64).tolist(),
+                'roots_before': self.roots[templates].tolist(),
+                'roots_after': np.broadcast_to(roots_after, templates.shape).astype(np.int64).tolist()}
+
+    # Edits ------------------------------------------------------------------------------------------------------------
+    def mark(self, template_index, keep):
+        """
+        Marks a template as kept (keep=True) or deleted
+        """
+        template_index = int(self.roots[template_index])
+        if self.marking[template_index] == int(keep):
+            return
+        self._write('do', self._change([template_index], int(keep), template_index))
+
+    def merge(self, target, templates):
+        """
+        Merges the templates (and everything already merged into them) into the template target. The merged templates
+        are marked as deleted and target keeps its marking.
+
+        Returns the templates whose average changed (target and the merged templates)
+        """
+        target = int(self.roots[target])
+        sources = np.setdiff1d(self.roots[np.asarray(templates, dtype=np.int64)], [target])
+        if len(sources) == 0:
+            return []
+        members = np.flatnonzero(np.in1d(self.roots, sources))
+        return self._write('do', self._change(members, 0, target))
+
+    def undo(self):
+        """
+        Undoes the last edit. Returns the templates whose average changed
+        """
+        if len(self.undo_stack) == 0:
+            return []
+        return self._write('undo', self.undo_stack[-1])
+
+    def redo(self):
+        if len(self.redo_stack) == 0:
+            return []
+        return self._write('redo', self.redo_stack[-1])
+
+    # Queries ----------------------------------------------------------------------------------------------------------
+    def members(self, template_index):
+        """
+        The original templates merged into (the root of) template_index, including itself
+        """
+        return np.flatnonzero(self.roots == self.roots[template_index])
+
+    def number_of_spikes(self, template_index):
+        return int(np.sum(self.counts[self.members(template_index)]))
+
+    def waveform_sum(self, template_index):
+        root = int(self.roots[template_index])
+        if root not in self._merged_sums:
+            members = self.members(root)
+            if len(members) == 1:
+                self._merged_sums[root] = np.array(self.sums[root], dtype=np.float64)
+            else:
+                self._merged_sums[root] = np.sum(self.sums[members], axis=0, dtype=np.float64)
+        return self._merged_sums[root]
+
+    def average(self, template_index):
+        """
+        The average waveform (channels x time points) of all the spikes of the templates merged into template_index
+        """
+        return self.waveform_sum(template_index) / max(self.number_of_spikes(template_index), 1)
+
+    # Persistence ------------------------------------------------------------------------------------------------------
+    def compact(self):
+        """
+        Writes the snapshot, template_marking.npy and template_merged_into.npy and empties the journal. The snapshot
+        holds the sequence number of the last edit it includes so a crash between writing it and emptying the journal
+        replays nothing twice.
+        """
+        if self._journal is not None:
+            self._journal.close()
+        _atomic_write(self.snapshot_file, lambda file: np.savez(file, marking=self.marking, roots=self.roots,
+                                                                sequence=self.sequence))
+        _atomic_write(join(self.base_folder, 'template_marking.npy'),
+                      lambda file: np.save(file, self.marking.astype(np.float64)))
+        _atomic_write(join(self.base_folder, 'template_merged_into.npy'), lambda file: np.save(file, self.roots))
+        self._journal = open(self.journal_file, 'w')
+        self._edits_since_compaction = 0
+
+    def close(self):
+        self.compact()
+        self._journal.close()
@@ -1,5 +1,6 @@
 __author__ = 'George Dimitriadis'
 
+import os
 import numpy as np
 import BrainDataAnalysis.Structures as dm
 import BrainDataAnalysis.Constants as ct
@@ -17,6 +18,73 @@ def load_raw_data(filename, numchannels=32, dtype=np.uint16):
     return data
 
 
+def get_number_of_samples(filename, numchannels=32, dtype=np.uint16):
+    return int(os.path.getsize(filename) / (numchannels * np.dtype(dtype).itemsize))
+
+
+def iterate_raw_data_blocks(filename, numchannels=32, dtype=np.uint16, block_size=30000, overlap=0, channels=None,
+                            out_dtype=None, offset=0, scaling=1, start_sample=0, end_sample=None):
+    """
+    Streams a flat raw data file (Time1Chan1, Time1Chan2, ... Time1ChanN, Time2Chan1, ... structure) as a sequence of
+    channels x time blocks. Every block is read from a single contiguous region of the file and copied into a
+    C-contiguous array so that operations over the time axis of a channel do not stride through the file. Only one
+    block is kept in memory at any time.
+
+    Parameters
+    ----------
+    filename: the raw data file
+    numchannels: the number of channels in the file
+    dtype: the data type of the samples in the file
+    block_size: the number of time points in every block (the last block can be shorter)
+    overlap: the number of time points each block shares with the previous one (must be smaller than block_size)
+    channels: the channels to return (in the given order). If None all channels are returned
+    out_dtype: the data type of the returned blocks. If None it is the file's dtype if no offset or scaling is applied
+    and np.float32 otherwise
+    offset: a value subtracted from the samples (e.g. 32768 to center unsigned data)
+    scaling: a value the offsetted samples are multiplied with (e.g. voltage_step_size to get Volts)
+    start_sample: the first time point to read
+    end_sample: the time point to stop reading at (not included). If None read until the end of the file
+
+    Yields
+    ------
+    block_start: the time point in the file of the first sample of the block
+    block: a channels x time array
+    """
+    if overlap >= block_size or overlap < 0:
+        raise ValueError("The overlap must be non negative and smaller than the block_size")
+
+    numsamples = get_number_of_samples(filename, numchannels, dtype)
+    if end_sample is None or end_sample > numsamples:
+        end_sample = numsamples
+    if channels is None:
+        channels = slice(None)
+    else:
+        channels = np.array(channels, dtype=np.int64)
+
+    convert = offset != 0 or scaling != 1
+    if out_dtype is None:
+        out_dtype = np.float32 if convert else dtype
+
+    fdata = np.memmap(filename, dtype, mode='r', shape=(numsamples, numchannels))
+    step = block_size - overlap
+    block_start = start_sample
+    while block_start < end_sample:
+        block_end = min(block_start + block_size, end_sample)
+        samples = fdata[block_start:block_end, channels]
+        if convert:
+            block = np.array(samples.T, dtype=np.result_type(out_dtype, np.float32), order='C')
+            block -= offset
+            block *= scaling
+            block = block.astype(out_dtype, copy=False)
+        else:
+            block = np.array(samples.T, dtype=out_dtype, order='C')
+        yield block_start, block
+        if block_end == end_sample:
+            break
+        block_start += step
+    del fdata
+
+
 def load_raw_event_trace(filename, number_of_channels=8, channel_used=None, dtype=np.int32):
     fdata = np.fromfile(filename, dtype)
     numsamples = int(len(fdata) / number_of_channels)
@@ -1,19 +1,51 @@
+import os
 import numpy as np
 
 
 # For klusta the data must be in a flat array with Time1Chan1, Time1Chan2,... Time1ChanN, Time2Chan1,... structure
-def make_dat_file(raw_data, filename, num_channels, time_limits=None):
+def make_dat_file(raw_data, filename, num_channels, time_limits=None, offset=20000, channel_order=None,
+                  block_size=100000, resume=False):
+    """
+    Write a (channels x time) array (usually a memmap) into the flat, time major int16 file klusta and kilosort
+    expect. The data are converted one block of samples at a time so memory use does not depend on the length of
+    the recording.
+
+    Input:
+    raw_data -- channels x time array
+    filename -- the .dat file to write
+    num_channels -- the number of channels to write (len(channel_order) if channel_order is given)
+    time_limits -- [start, end] samples of raw_data to write (default the whole recording)
+    offset -- subtracted from the data before the cast to int16 (the default -20K brings amplifier data within the
+    int16 range)
+    channel_order -- optional list of raw_data rows in the order they should appear in the file
+    block_size -- number of samples converted and written at once
+    resume -- if True and filename exists, the samples already in the file are kept and writing continues from the
+    first sample not yet written (a partially written last sample is overwritten)
+
+    Output:
+    The number of samples (per channel) in the file
+    """
     if not time_limits:
         time_limits = [0, raw_data.shape[1]]
-    raw_data_ivm_klusta = np.reshape(np.transpose(raw_data[:, time_limits[0]:time_limits[1]]),
-                                     (num_channels * (time_limits[1] - time_limits[0])))
-    raw_data_ivm_klusta = (raw_data_ivm_klusta - 20000).astype('int16') #The -20K is to bring the number within the int16 range
+    if channel_order is None:
+        channel_order = np.arange(num_channels)
+    channel_order = np.asarray(channel_order)
+    if len(channel_order) != num_channels:
+        raise ValueError('channel_order must have num_channels entries')
+    total_samples = time_limits[1] - time_limits[0]
+    bytes_per_sample = num_channels * np.dtype(np.int16).itemsize
 
-    raw_klusta_size = len(raw_data_ivm_klusta)
+    samples_done = 0
+    if resume and os.path.isfile(filename):
+        samples_done = min(os.path.getsize(filename) // bytes_per_sample, total_samples)
+    mode = 'r+b' if samples_done > 0 else 'wb'
 
-    temp = np.memmap(filename,
-                     dtype=np.int16,
-                     mode='w+',
-                     shape=raw_klusta_size)
-    temp[:] = raw_data_ivm_klusta
-    del temp
\ No newline at end of file
+    with open(filename, mode) as f:
+        f.truncate(samples_done * bytes_per_sample)
+        f.seek(samples_done * bytes_per_sample)
+        for start in np.arange(time_limits[0] + samples_done, time_limits[1], block_size):
+            end = min(start + block_size, time_limits[1])
+            block = np.asarray(raw_data[:, start:end])[channel_order, :]
+            block = (block.astype(np.int32) - offset).astype(np.int16)
+            np.ascontiguousarray(block.T).tofile(f)
+    return total_samples
@@ -4,14 +4,24 @@ __author__ = 'Kaushik Ghose and George Dimitriadis'
 """Functions to read the flotilla of files produced by the Neuralynx system."""
 
 from struct import unpack as upk, pack as pk, calcsize as csize
+from concurrent.futures import ThreadPoolExecutor
 import logging, pylab
-import os, platform, sys
+import numpy as np
+import os
 
 logger = logging.getLogger(__name__)
 
 NUM_SAMPLES_IN_PACKET = 512
 HEADER_BYTE_SIZE = 2* 8 * 1024 # For some reason this works for a header size of 32Kb and not for a 16kB header
 
+CSC_PACKET = np.dtype([
+    ('timestamp', 'Q'),
+    ('chan', 'I'),
+    ('Fs', 'I'),
+    ('Ns', 'I'),
+    ('samp', '{:d}h'.format(NUM_SAMPLES_IN_PACKET))
+])
+
 #NOTE: For python 3  fin = open(filename, mode='br')
 
 def read_header(fin):
@@ -43,18 +53,11 @@ def read_single_csc(fin, assume_same_fs=True, memmap=False):
     sampling frequency has not changed during the recording
     """
     hdr = read_header(fin)
-    csc_packet = pylab.dtype([
-    ('timestamp', 'Q'),
-    ('chan', 'I'),
-    ('Fs', 'I'),
-    ('Ns', 'I'),
-    ('samp', '512h')
-    ])
 
     if not memmap:
-        data = pylab.fromfile(fin, dtype=csc_packet, count=-1)
+        data = pylab.fromfile(fin, dtype=CSC_PACKET, count=-1)
     else:
-        data = pylab.memmap(fin, dtype=csc_packet, mode = 'r', offset=HEADER_BYTE_SIZE)
+        data = pylab.memmap(fin, dtype=CSC_PACKET, mode = 'r', offset=HEADER_BYTE_SIZE)
     Fs = None
     trace = None
     if assume_same_fs:
@@ -64,53 +67,103 @@ def read_single_csc(fin, assume_same_fs=True, memmap=False):
 
     if not assume_same_fs or memmap: return {'header': hdr, 'packets': data}
 
-    sample_duration_us = (1./data['Fs'][0])*1e6
-    packet_duration_us = 513 * sample_duration_us
-    #For the version we are dealing with, Neuralynx packets are always 512
-    #This is actually a very poor estimate if the sampling freq is low, since it rounds to nearest Hz
-    #So we'll not rely on this but come up with our own estimate
-    #Using 512 samples makes the estimate in high sampling frequencies be 1 or 2 us smaller than the dt_us
-    #So we are going to assume that any pause we did takes longer than 1/Fs seconds
-
     samp = data['samp']
     ts_us = data['timestamp']
-    dt_us = pylab.diff(ts_us).astype('f')
-    idx = pylab.find(dt_us > packet_duration_us) #This will find any instances where we paused the recording
-    if idx.size == 0:#No padding needed
+    offsets, num_samples, Fs = _csc_packet_offsets(ts_us, data['Fs'], data['Ns'])
+    if num_samples == samp.size: #No padding needed
         trace = samp.ravel()
-        Fs = (data['Ns'][:-1]/(dt_us*1e-6)).mean()
     else: #We have some padding to do.
         logger.debug('Gaps in record, padding')
-        #Our first task is to find all the contiguous sections of data
-        idx += 1 #Shifting indexes to point at the packets that come after a gap
-        idx = pylab.insert(idx, 0, 0) #Now idx contains the indexes of every packet that starts a contiguous section
-        idx = pylab.append(idx,ts_us.size) #And the index of the last packet
-        Ns = data['Ns']
-        estimFs_sum = 0
-        N_samps = 0
-        sections = []
-        for n in range(idx.size-1): #collect all the sections
-            n0 = idx[n]; n1=idx[n+1]
-            sections.append(samp[n0:n1].ravel())
-            if n1-n0 > 1:#We need more than one packet in a section to get an estimate
-                estimFs_sum += (Ns[n0:n1-1]/(dt_us[n0:n1-1]*1e-6)).sum()
-                N_samps += n1-1-n0
-
-        Fs = estimFs_sum / float(N_samps)
-        #Now pad the data appropriately
-        padded = [sections[0]]
-        cum_N = sections[0].size
-        for n in range(1,len(sections)):
-            #Now figure out how many zeros we have to pad to get the right length
-            Npad = int((ts_us[idx[n]] - ts_us[0])*1e-6*Fs - cum_N)
-            padded.append(pylab.zeros(Npad))
-            padded.append(sections[n])
-            cum_N += Npad + sections[n].size
-        trace = pylab.concatenate(padded) #From this packet to the packet before the gap
+        trace = np.zeros(num_samples, dtype=samp.dtype)
+        _copy_csc_packets_to_trace(trace, samp, offsets)
 
     return {'header': hdr, 'packets': data, 'Fs': Fs, 'trace': trace, 't0': ts_us[0]}
 
 
+def _csc_packet_offsets(ts_us, packet_Fs, Ns):
+    """Find where in the concatenated (zero padded) trace the first sample of every packet should go.
+    This is the vectorized equivalent of looping over the contiguous sections of a record. All packet offsets are
+    computed at once from the timestamps.
+    Input:
+    ts_us - the timestamps of the packets (us)
+    packet_Fs - the sampling frequency each packet reports
+    Ns - the number of valid samples in each packet
+    Output:
+    offsets - the sample (in the padded trace) each packet starts at
+    num_samples - the length of the padded trace
+    Fs - the average frequency computed from the timestamps of packets that are not separated by a gap
+    """
+    num_packets = ts_us.size
+    offsets = np.arange(num_packets, dtype=np.int64) * NUM_SAMPLES_IN_PACKET
+    if num_packets < 2:
+        return offsets, num_packets * NUM_SAMPLES_IN_PACKET, float(packet_Fs[0]) if num_packets else None
+
+    sample_duration_us = (1. / packet_Fs[0]) * 1e6
+    packet_duration_us = 513 * sample_duration_us
+    #For the version we are dealing with, Neuralynx packets are always 512
+    #This is actually a very poor estimate if the sampling freq is low, since it rounds to nearest Hz
+    #So we'll not rely on this but come up with our own estimate
+    #Using 512 samples makes the estimate in high sampling frequencies be 1 or 2 us smaller than the dt_us
+    #So we are going to assume that any pause we did takes longer than 1/Fs seconds
+    dt_us = np.diff(ts_us).astype('f')
+    gaps = dt_us > packet_duration_us
+    contiguous = ~gaps
+    if contiguous.any():
+        Fs = (Ns[:-1][contiguous] / (dt_us[contiguous] * 1e-6)).mean()
+    else:
+        Fs = float(packet_Fs[0])
+
+    if not gaps.any():
+        return offsets, num_packets * NUM_SAMPLES_IN_PACKET, Fs
+
+    #Every packet after a gap starts a new section whose first sample is placed according to its timestamp.
+    #Sections never overlap the end of the previous one.
+    first_packets = np.flatnonzero(gaps) + 1
+    section_starts = np.floor((ts_us[first_packets] - ts_us[0]) * 1e-6 * Fs).astype(np.int64)
+    shifts = np.maximum.accumulate(np.maximum(section_starts - offsets[first_packets], 0))
+    section_of_packet = np.concatenate(([0], np.cumsum(gaps)))
+    offsets += np.concatenate(([0], shifts))[section_of_packet]
+    return offsets, int(offsets[-1]) + NUM_SAMPLES_IN_PACKET, Fs
+
+
+def _copy_csc_packets_to_trace(trace, samp, offsets):
+    """Copy the samples of consecutive packets into the trace at the given packet offsets, one slice per section."""
+    breaks = np.flatnonzero(np.diff(offsets) != NUM_SAMPLES_IN_PACKET) + 1
+    firsts = np.concatenate(([0], breaks))
+    lasts = np.concatenate((breaks, [offsets.size]))
+    for first, last in zip(firsts, lasts):
+        trace[offsets[first]:offsets[first] + (last - first) * NUM_SAMPLES_IN_PACKET] = samp[first:last].ravel()
+
+
+def _csc_file_layout(filename, assume_same_fs):
+    """Compute the packet offsets of a .ncs file reading only the packet headers (through a memmap)."""
+    packets = np.memmap(filename, dtype=CSC_PACKET, mode='r', offset=HEADER_BYTE_SIZE)
+    if assume_same_fs and packets.size > 0 and packets['Fs'].std() > 1e-6:
+        logger.warning('Fs is not fixed across trace of {:s}, not packing packets together'.format(filename))
+        assume_same_fs = False
+    if assume_same_fs:
+        offsets, num_samples, _ = _csc_packet_offsets(np.array(packets['timestamp']), np.array(packets['Fs']),
+                                                      np.array(packets['Ns']))
+    else:
+        offsets = np.arange(packets.size, dtype=np.int64) * NUM_SAMPLES_IN_PACKET
+        num_samples = packets.size * NUM_SAMPLES_IN_PACKET
+    del packets
+    return offsets, num_samples
+
+
+def _read_csc_file_into(filename, offsets, trace, packets_per_read):
+    """Read a .ncs file sequentially, packets_per_read packets at a time, and copy its samples into trace."""
+    with open(filename, mode='rb') as fin:
+        fin.seek(HEADER_BYTE_SIZE)
+        packet = 0
+        while packet < offsets.size:
+            packets = np.fromfile(fin, dtype=CSC_PACKET, count=packets_per_read)
+            if packets.size == 0:
+                break
+            _copy_csc_packets_to_trace(trace, packets['samp'], offsets[packet:packet + packets.size])
+            packet += packets.size
+
+
 # def read_all_csc(folder, assume_same_fs=True, memmap=False):
 #     files = [folder+"\\"+f for f in os.listdir(folder) if f.endswith('.ncs')]
 #     order = [int(file.split('.')[0].split('CSC')[1]) for file in files]
@@ -128,51 +181,52 @@ def read_single_csc(fin, assume_same_fs=True, memmap=False):
 #         pylab.append(data, channel_data, axis=1)
 #
 #     return data
-def read_all_csc(data_folder, dtype='int16', assume_same_fs=True, memmap=False, memmap_folder=None, save_for_spikedetekt=False, channels_to_save=None, return_sliced_data=False):
-    if sys.version_info[0] > 2:
-        mode = 'br'
-    else:
-        mode = 'r'
-
-    os_name = platform.system()
-    if os_name == 'Windows':
-        sep = '\\'
-    elif os_name=='Linux':
-        sep = r'/'
-
+def read_all_csc(data_folder, dtype='int16', assume_same_fs=True, memmap=False, memmap_folder=None, save_for_spikedetekt=False, channels_to_save=None, return_sliced_data=False, max_workers=None, packets_per_read=10000):
+    """Read all the .ncs files of a folder into a channels x samples array (ordered by the CSC number of the files).
+    The packet layout of every file (including any gap padding) is computed first from the packet headers. Then the
+    output (an in memory array or a memmap in memmap_folder) is preallocated and the files are read concurrently
+    (max_workers threads) straight into their rows.
+    Inputs:
+    data_folder - the folder with the .ncs files
+    dtype - the data type of the output
+    assume_same_fs - if True fill time gaps with zeros (see read_single_csc). Ignored if memmap is True
+    memmap - if True the output is a memmap in memmap_folder, named after the data_folder
+    max_workers - number of files read concurrently. If None use the ThreadPoolExecutor default
+    packets_per_read - number of packets each thread reads from its file at a time
+    Output:
+    The channels x samples array (or the sliced data if save_for_spikedetekt and return_sliced_data are set)
+    """
     files = [os.path.join(data_folder, f) for f in os.listdir(data_folder) if f.endswith('.ncs')]
-    order = [int(file.split('.')[0].split('CSC')[1]) for file in files]
+    order = [int(os.path.basename(file).split('.')[0].split('CSC')[1]) for file in files]
     sort_order =  sorted(range(len(order)),key=order.__getitem__)
     ordered_files = [files[i] for i in sort_order]
 
     if memmap:
         if not memmap_folder:
             raise NameError("A memmap_folder should be defined for memmapped data")
-        out_filename = data_folder.split(sep)[-1]+'.dat'
+        out_filename = os.path.basename(os.path.normpath(data_folder))+'.dat'
         out_full_filename = os.path.join(memmap_folder, out_filename)
 
-    data = None
-    i = 0;
-    for file in ordered_files:
-        fin = open(file, mode=mode)
-        x = read_single_csc(fin, assume_same_fs=assume_same_fs, memmap=memmap)
-        if not assume_same_fs or memmap:
-            channel_data = x['packets']['samp'].ravel()
-            if data is None:
-                data = pylab.memmap(out_full_filename, dtype=dtype, mode='w+', shape=(pylab.size(files), channel_data.size))
-            else:
-                data[i,:] = channel_data
-                data.flush()
-                i = i+1
-                print(i)
+    pad = assume_same_fs and not memmap
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        layouts = list(executor.map(lambda file: _csc_file_layout(file, pad), ordered_files))
+        num_samples = max([num_samples for _, num_samples in layouts])
+        if len(set([num_samples for _, num_samples in layouts])) > 1:
+            logger.warning('Not all channels have the same number of samples. Shorter channels are padded with zeros')
+
+        shape = (len(ordered_files), num_samples)
+        if memmap:
+            data = pylab.memmap(out_full_filename, dtype=dtype, mode='w+', shape=shape)
         else:
-            channel_data = x['trace']
-            if data is None:
-                data = pylab.zeros(shape=(pylab.size(files), channel_data.size), dtype=dtype)
-            else:
-                data[i,:] = channel_data
-                i = i+1
-                print(i)
+            data = np.zeros(shape=shape, dtype=dtype)
+
+        futures = [executor.submit(_read_csc_file_into, file, offsets, data[i], packets_per_read)
+                   for i, (file, (offsets, _)) in enumerate(zip(ordered_files, layouts))]
+        for i, future in enumerate(futures):
+            future.result()
+            logger.debug('Read {:s}'.format(ordered_files[i]))
+    if memmap:
+        data.flush()
 
     data_to_return = data
     if save_for_spikedetekt:
@@ -298,6 +352,67 @@ def write_nse(fname, time_stamps, remarks=''):
           fout.write(pk(fmt, ts, dwScNumber, dwCellNumber, *garbage))
 
 
+NRD_STX = 2048
+NRD_PKT_ID = 1
+NRD_NON_DATA_WORDS = 18 #stx, pkt_id, pkt_data_size, 2 x timestamp, status, ttl, 10 x extra and crc
+NRD_FIRST_DATA_WORD = 17
+
+
+def _nrd_packet_words(channels):
+    return NRD_NON_DATA_WORDS + channels
+
+
+def _check_nrd_packets(rows, channels):
+    """Header and CRC checks on a packets x words array. Returns a boolean array of the packets that pass."""
+    good = (rows[:, 0] == NRD_STX) & (rows[:, 1] == NRD_PKT_ID) & (rows[:, 2] == 10 + channels)
+    good &= np.bitwise_xor.reduce(rows, axis=1) == 0 #The crc word makes the xor of all the words of a packet zero
+    return good
+
+
+def _find_valid_nrd_packets(words, channels):
+    """Find the word position of every valid packet in a buffer of words and choose a chain of non overlapping ones.
+    Every position is a candidate, so the search resyncs straight after any corrupt region.
+    Input:
+    words - uint32 array
+    channels - total channels in the system
+    Output:
+    starts - the word positions of the chosen packets in increasing order
+    """
+    packet_words = _nrd_packet_words(channels)
+    num_candidates = words.size - packet_words + 1
+    if num_candidates <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.flatnonzero(words[:num_candidates] == NRD_STX)
+    candidates = candidates[(words[candidates + 1] == NRD_PKT_ID) & (words[candidates + 2] == 10 + channels)]
+    if candidates.size == 0:
+        return candidates
+    rows = words[candidates[:, None] + np.arange(packet_words)]
+    candidates = candidates[np.bitwise_xor.reduce(rows, axis=1) == 0]
+
+    if np.all(np.diff(candidates) >= packet_words):
+        return candidates
+    #Some valid looking packets overlap (a packet's data happen to look like a valid packet). Walk the chain, each
+    #packet being the first valid one after the end of the previous.
+    starts = []
+    next_start = 0
+    for candidate in candidates:
+        if candidate >= next_start:
+            starts.append(candidate)
+            next_start = candidate + packet_words
+    return np.array(starts, dtype=np.int64)
+
+
+def _count_nrd_errors(words, region_starts, channels):
+    """Classify the corrupt regions starting at region_starts by the first check their first packet fails.
+    Returns the number of (stx, pkt id, pkt size, crc) errors."""
+    region_starts = region_starts[region_starts + 2 < words.size]
+    stx_bad = words[region_starts] != NRD_STX
+    id_bad = ~stx_bad & (words[region_starts + 1] != NRD_PKT_ID)
+    size_bad = ~stx_bad & ~id_bad & (words[region_starts + 2] != 10 + channels)
+    crc_bad = ~stx_bad & ~id_bad & ~size_bad
+    return int(stx_bad.sum()), int(id_bad.sum()), int(size_bad.sum()), int(crc_bad.sum())
+
+
 def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=64, max_pkts=-1, buffer_size=10000, error_bugout=1000000000):
     """Read and write out selected raw traces from the .nrd file with error checking.
     Inputs:
@@ -327,150 +442,113 @@ def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=6
     ----------------------------------------------------------------------------------------------------------------------
     Data are written as a pure stream of binary data and can be easily and efficiently read using the numpy read function.
     For convenience, a function that reads the timestamps, events and channels (read_extracted_data) is included in the library.
+    The file is read in a single sequential pass, buffer_size packets at a time. The STX, packet id, packet size and
+    CRC checks are done on whole buffers at once. Only if a buffer has a bad packet are the corrupt regions located
+    (again on the whole buffer) and the packets after them resynced to. Packets with out of order timestamps are
+    dropped. The good packets of every buffer are appended to the output files before the next buffer is read.
     """
-    def seek_packet(f):
-        """Skip forward until we find the STX magic number."""
-        #Read in 32bit increments until the magic number is found
-        start = f.tell()
-        pkt = f.read(4)
-        while len(pkt) == 4:
-            if pkt == '\x00\x08\x00\x00': #Magic number 2048 0x0800
-                f.seek(-4,1) #Realign
-                break
-            pkt = f.read(4)
-        stop = f.tell()
-        return stop - start
-
-        logger.info('Notice: you are using the slow version of the extractor. All error checks are done')
-
-        #nrd packet format
-        nrd_packet = pylab.dtype([
-            ('stx', 'i'),
-            ('pkt_id', 'i'),
-            ('pkt_data_size', 'i'),
-            ('timestamp high', 'I'), #Neuralynx timestamp is ... in its own 32 bit world
-            ('timestamp low', 'I'),
-            ('status', 'i'),
-            ('ttl', 'I'),
-            ('extra', '10i'),
-            ('data', '{:d}i'.format(channels)),
-            ('crc', 'i')
-        ])
-        packet_size = nrd_packet.itemsize
-
-        pkt_cnt = 0
-        garbage_bytes = 0
-        stx_err_cnt = 0
-        pkt_id_err_cnt = 0
-        pkt_size_err_cnt = 0
-        pkt_ts_err_cnt = 0
-        pkt_crc_err_cnt = 0
-
-        if max_pkts != -1: #An insidious bug was killed here!
-            if buffer_size > max_pkts:
-                buffer_size = max_pkts
-
-        #The files we will write to.
-        fts = open(ftsname,'wb')
-        fttl = open(fttlname,'wb')
-        fchan = [open(fcn,'wb') for fcn in fchanname]
-
-        last_ts = 0
-        with open(fname,'rb') as f:
-            hdr = read_header(f)
-            logger.info('File header: {:s}'.format(hdr))
-
-            garbage_bytes += seek_packet(f)
-            these_packets = pylab.fromfile(f, dtype=nrd_packet, count=buffer_size)
-            while these_packets.size > 0:
-                all_packets_good = True
-                packets_read = these_packets.size
-
-                idx = pylab.find(these_packets['stx'] != 2048)
-                if idx.size > 0:
-                    stx_err_cnt += 1
-                    all_packets_good = False
-                    max_good_packets = idx[0]
-                    these_packets = these_packets[:max_good_packets]
-
-                if these_packets.size > 0:
-                    idx = pylab.find(these_packets['pkt_id'] != 1)
-                    if idx.size > 0:
-                      pkt_id_err_cnt += 1
-                      all_packets_good = False
-                      max_good_packets = idx[0]
-                      these_packets = these_packets[:max_good_packets]
-
-                if these_packets.size > 0:
-                    idx = pylab.find(these_packets['pkt_data_size'] != 10 + channels)
-                    if idx.size > 0:
-                      pkt_size_err_cnt += 1
-                      all_packets_good = False
-                      max_good_packets = idx[0]
-                      these_packets = these_packets[:max_good_packets]
-
-                if these_packets.size > 0:
-                    #crc computation
-                    field32 = pylab.vstack([these_packets[k].T for k in nrd_packet.fields.keys()]).astype('I')
-                    crc = pylab.zeros(these_packets.size,dtype='I')
-                    for idx in range(field32.shape[0]):
-                        crc ^= field32[idx,:]
-                    idx = pylab.find(crc != 0)
-                    if idx.size > 0:
-                        pkt_crc_err_cnt += 1
-                        all_packets_good = False
-                        max_good_packets = idx[0]
-                        these_packets = these_packets[:max_good_packets]
-
-                if these_packets.size > 0:
-                    ts = pylab.array((these_packets['timestamp high'].astype('uint64')<<32) | (these_packets['timestamp low']), dtype='uint64')
-                    bad_idx = -1
-                    if last_ts > ts[0]:#Time stamps out of order at buffer boundary
-                        bad_idx = 0
-                    else:
-                        idx = pylab.find(ts[:-1] > ts[1:])
-                        if idx.size > 0:
-                            bad_idx = idx[0] + 1
-                    if bad_idx > -1:
-                        logger.info('Out of order timestamp {:d}'.format(int(ts[bad_idx])))
-                        pkt_ts_err_cnt += 1
-                        all_packets_good = False
-                        max_good_packets = bad_idx
-                        these_packets = these_packets[:max_good_packets]
-                        ts = ts[:max_good_packets]
-
-                if these_packets.size > 0:
+    logger.info('Extracting ' + fname + ' in buffers of ' + str(buffer_size) + ' packets, all error checks are done')
+
+    packet_words = _nrd_packet_words(channels)
+    channel_list = list(channel_list)
+
+    pkt_cnt = 0
+    garbage_words = 0
+    stx_err_cnt = 0
+    pkt_id_err_cnt = 0
+    pkt_size_err_cnt = 0
+    pkt_ts_err_cnt = 0
+    pkt_crc_err_cnt = 0
+
+    if max_pkts != -1:
+        if buffer_size > max_pkts:
+            buffer_size = max_pkts
+
+    #The files we will write to.
+    fts = open(ftsname,'wb')
+    fttl = open(fttlname,'wb')
+    fchan = [open(fcn,'wb') for fcn in fchanname]
+
+    last_ts = 0
+    carry = np.empty(0, dtype=np.uint32)
+    with open(fname,'rb') as f:
+        hdr = read_header(f)
+        logger.info('File header: {:s}'.format(hdr.decode('latin-1', errors='replace')))
+
+        while True:
+            new_words = np.fromfile(f, dtype=np.uint32, count=buffer_size * packet_words)
+            end_of_file = new_words.size == 0
+            words = np.concatenate((carry, new_words))
+
+            num_rows = words.size // packet_words
+            rows = words[:num_rows * packet_words].reshape(num_rows, packet_words)
+            if num_rows > 0 and np.all(_check_nrd_packets(rows, channels)):
+                #Fast path, the buffer is aligned and all its packets are good
+                consumed = num_rows * packet_words
+            else:
+                starts = _find_valid_nrd_packets(words, channels)
+                rows = words[starts[:, None] + np.arange(packet_words)]
+                if end_of_file:
+                    consumed = words.size
+                else:
+                    #Leave in the carry over any words that could be the beginning of a packet not fully read yet
+                    consumed = max(words.size - packet_words + 1, 0)
+                    if starts.size > 0:
+                        consumed = max(consumed, starts[-1] + packet_words)
+                region_starts = np.concatenate(([0], starts + packet_words))
+                region_ends = np.concatenate((starts, [consumed]))
+                corrupt = region_ends > region_starts
+                garbage_words += int((region_ends - region_starts)[corrupt].sum())
+                errors = _count_nrd_errors(words, region_starts[corrupt], channels)
+                stx_err_cnt += errors[0]
+                pkt_id_err_cnt += errors[1]
+                pkt_size_err_cnt += errors[2]
+                pkt_crc_err_cnt += errors[3]
+            carry = words[consumed:]
+
+            if rows.shape[0] > 0:
+                ts = (rows[:, 3].astype('uint64') << np.uint64(32)) | rows[:, 4].astype('uint64')
+                in_order = ts >= np.maximum.accumulate(np.concatenate(([last_ts], ts)))[:-1]
+                if not np.all(in_order):
+                    for bad_ts in ts[~in_order]:
+                        logger.info('Out of order timestamp {:d}'.format(int(bad_ts)))
+                    pkt_ts_err_cnt += int((~in_order).sum())
+                    rows = rows[in_order]
+                    ts = ts[in_order]
+
+                if max_pkts != -1 and pkt_cnt + rows.shape[0] > max_pkts:
+                    rows = rows[:max_pkts - pkt_cnt]
+                    ts = ts[:max_pkts - pkt_cnt]
+
+                if rows.shape[0] > 0:
                     last_ts = ts[-1] #Ready for the next read
                     ts.tofile(fts)
-                    these_packets['ttl'].tofile(fttl)
-                    for idx,ch in enumerate(channel_list):
-                        these_packets['data'][:,ch].tofile(fchan[idx])
-
-                pkt_cnt += these_packets.size
-                if max_pkts != -1:
-                    if pkt_cnt >= max_pkts: #NOTE: This may give us upto buffer_size -1 more packets than we want.
-                        break
+                    rows[:, 6].tofile(fttl)
+                    for idx, ch in enumerate(channel_list):
+                        rows[:, NRD_FIRST_DATA_WORD + ch].astype('int32').tofile(fchan[idx])
+                    pkt_cnt += rows.shape[0]
 
-                if not all_packets_good:
-                    f.seek((these_packets.size-packets_read)*packet_size+4,1) #Rewind all the way except 32 bits
-                    garbage_bytes += seek_packet(f)
+            if max_pkts != -1 and pkt_cnt >= max_pkts:
+                break
 
-                if pkt_ts_err_cnt + pkt_crc_err_cnt + stx_err_cnt > error_bugout:
-                    logger.warning('Too many errors, bugging out')
-                    break
+            if pkt_ts_err_cnt + pkt_crc_err_cnt + stx_err_cnt > error_bugout:
+                logger.warning('Too many errors, bugging out')
+                break
 
-                these_packets = pylab.fromfile(f, dtype=nrd_packet, count=buffer_size)
+            if end_of_file:
+                break
 
-        fts.close()
-        fttl.close()
-        [fch.close() for fch in fchan]
+    fts.close()
+    fttl.close()
+    [fch.close() for fch in fchan]
 
-        logger.info('Extracted {:d} packets'.format(pkt_cnt))
-        logger.info('{:d} garbage words'.format(garbage_bytes))
-        logger.info('{:d} packets had bad stx'.format(stx_err_cnt))
-        logger.info('{:d} packets had bad pkt id'.format(pkt_id_err_cnt))
-        logger.info('{:d} packets had bad crc'.format(pkt_crc_err_cnt))
-        logger.info('{:d} packets had out of order timestamps'.format(pkt_ts_err_cnt))
+    logger.info('Extracted {:d} packets'.format(pkt_cnt))
+    logger.info('{:d} garbage words'.format(garbage_words))
+    logger.info('{:d} packets had bad stx'.format(stx_err_cnt))
+    logger.info('{:d} packets had bad pkt id'.format(pkt_id_err_cnt))
+    logger.info('{:d} packets had bad pkt size'.format(pkt_size_err_cnt))
+    logger.info('{:d} packets had bad crc'.format(pkt_crc_err_cnt))
+    logger.info('{:d} packets had out of order timestamps'.format(pkt_ts_err_cnt))
 
 
 
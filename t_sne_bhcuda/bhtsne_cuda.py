@@ -87,12 +87,15 @@ def _find_exe_dir():
 def t_sne(samples, use_scikit=False, files_dir=None, results_filename='result.dat', data_filename='data.dat',
           no_dims=DEFAULT_NO_DIMS, perplexity=DEFAULT_PERPLEXITY, theta=DEFAULT_THETA, eta=DEFAULT_ETA,
           iterations=DEFAULT_ITERATIONS, seed=DEFAULT_SEED, early_exaggeration=DEFAULT_EARLY_EXAGGERATION,
-          gpu_mem=DEFAULT_GPU_MEM, randseed=DEFAULT_RANDOM_SEED, verbose=2):
+          gpu_mem=DEFAULT_GPU_MEM, randseed=DEFAULT_RANDOM_SEED, verbose=2, checkpoint_file=None,
+          checkpoint_every=50):
     """
     Run t-sne on the sapplied samples (Nxsamples x Dfeatures array). It either:
     1) Calls the t_sne_bhcuda.exe (which should be in the Path of the OS somehow - maybe in the Scripts folder for
     Windows or the python/bin folder for Linux) which then runs t-sne either on the CPU or the GPU
-    or 2) Calls the sklearn t-sne module (which runs only on CPU).
+    or 2) Calls the sklearn t-sne module (which runs only on CPU)
+    or 3) If checkpoint_file is given, runs t-sne in this process with tsne_for_spikesort (cpu knn and the python
+    Barnes-Hut optimizer) saving its state every checkpoint_every iterations so that a killed run can be resumed.
 
     Parameters
     ----------
@@ -124,6 +127,11 @@ def t_sne(samples, use_scikit=False, files_dir=None, results_filename='result.da
     verbose -- Define verbosity. 0 = No output, 1 = Basic output, 2 = Full output, 3 = Also save t-sne results in
     interim files after every iteration. Option 3 is used to save all steps of t-sne to explore the way the algorithm
     seperates the data (good for movies).
+    checkpoint_file -- If not None the file the optimizer state (embedding, gains, update vectors, iteration, the P
+    matrix and a hash of the samples) is saved in. If it already exists the run resumes from it (a checkpoint of other
+    samples raises a ValueError). The final state is saved too, so rerunning returns the finished embedding. Not used
+    with use_scikit = True or seed > 0 (these run as if it was None)
+    checkpoint_every -- Number of iterations between checkpoints
 
     Returns
     -------
@@ -149,6 +157,25 @@ def t_sne(samples, use_scikit=False, files_dir=None, results_filename='result.da
 
         return t_sne_results
 
+    elif checkpoint_file is not None and seed <= 0:  # using the resumable python implementation
+        import numpy as np
+        from tsne_for_spikesort import cpu, t_sne as tsne_python
+
+        samples_hash = tsne_python.hash_samples(samples)
+        if not isfile(checkpoint_file):
+            if randseed != DEFAULT_RANDOM_SEED:
+                np.random.seed(randseed)
+            closest_indices, closest_distances = \
+                cpu.calculate_knn_distances_all_to_all(samples, perplexity=int(perplexity), verbose=verbose > 1)
+            p = tsne_python._compute_gaussian_perplexity_csr(closest_indices, closest_distances,
+                                                            perplexity=int(perplexity))
+            y = np.random.randn(len(samples), no_dims) * 0.0001
+        else:
+            p, y = None, None  # taken from the checkpoint (if it was made from the same samples)
+        return tsne_python.run_iterations_with_python(y, p, theta=theta, eta=eta, iterations=iterations,
+                                                      verbose=verbose, checkpoint_file=checkpoint_file,
+                                                      checkpoint_every=checkpoint_every, samples_hash=samples_hash)
+
     else:  # using the C++/cuda implementation
         save_data_for_tsne(samples, files_dir, data_filename, theta, perplexity,
                            eta, no_dims, iterations, seed, gpu_mem, verbose, randseed)
@@ -170,6 +197,31 @@ def t_sne(samples, use_scikit=False, files_dir=None, results_filename='result.da
         return load_tsne_result(files_dir, results_filename)
 
 
+def t_sne_new_samples(new_samples, reference_samples, reference_t_sne, perplexity=DEFAULT_PERPLEXITY,
+                      theta=DEFAULT_THETA, eta=DEFAULT_ETA, iterations=250, verbose=2):
+    """
+    Adds new samples (e.g. the spikes of a new recording chunk) to an existing t-sne embedding instead of running
+    t_sne on all the samples again. The existing embedding is not changed.
+
+    Parameters
+    ----------
+    new_samples -- The M_examples X D_features array of the new samples
+    reference_samples -- The N_examples X D_features array that reference_t_sne was calculated from
+    reference_t_sne -- The N_examples X no_dims embedding (as returned by t_sne)
+    perplexity, theta, eta -- As in t_sne (the gradient of the new samples is scaled to that of the full t-sne, so
+    the same eta works)
+    iterations -- The number of itterations used to optimise the positions of the new samples
+
+    Returns
+    -------
+    A M_examples X no_dims array of the embeded new examples
+    """
+    from tsne_for_spikesort import t_sne as tsne_python
+
+    return tsne_python.embed_new_samples(reference_samples, reference_t_sne, new_samples, perplexity=int(perplexity),
+                                         theta=theta, eta=eta, iterations=iterations, verbose=verbose)
+
+
 def save_data_for_tsne(samples, files_dir, filename, theta, perplexity, eta, no_dims, iterations, seed, gpu_mem,
                        verbose, randseed):
     """
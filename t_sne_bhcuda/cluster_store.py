@@ -0,0 +1,305 @@
+
+"""
+Cluster assignments of the t-sne manual clustering gui (tsne_cluster.py).
+
+The assignments are held as one dense array with the cluster id of every spike (labels) instead of a pandas DataFrame
+with a list of spike indices per cluster. Every edit only touches the labels of the selected spikes and is appended
+(and fsynced) as one json line to a journal file next to the cluster info file, so an edit costs O(selection size)
+and a crash loses at most the edit that was being written. Every compact_every edits (and on close) the state is
+written to a snapshot (cluster_info_file + '.labels.npz'), the cluster info .pkl is re-exported for the code that
+reads it and the journal is emptied. The snapshot keeps the modification time of the .pkl it was written with, so a
+.pkl changed by other code since (e.g. made again by create_cluster_info_from_kilosort_spike_templates) is loaded
+instead of the snapshot.
+
+The journal entries carry the whole change they apply (spikes, labels before and after, clusters shown and hidden),
+so undo and redo are journaled like any other edit and replaying the journal on top of the snapshot always gives
+back the state of the last written edit. The undo history itself lives in memory (it is rebuilt from the journal
+after a crash but not from a snapshot).
+"""
+import json
+import pickle
+import numpy as np
+import pandas as pd
+from os import fsync, replace, stat
+from os.path import isfile
+
+UNLABELED = 'UNLABELED'
+DEFAULT_CLUSTERS = [UNLABELED, 'NOISE', 'MUA']
+# the name of the unlabeled cluster in the .pkl files of the older gui
+OLD_UNLABELED_NAMES = ['UNLABELD']
+
+
+def _atomic_write(filename, write_function):
+    """
+    Writes through write_function(file) into a temporary file that then replaces filename, so a crash while writing
+    never leaves a half written file behind
+    """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as file:
+        write_function(file)
+        file.flush()
+        fsync(file.fileno())
+    replace(temp_filename, filename)
+
+
+class ClusterStore:
+    """
+    Journaled cluster assignments of num_of_spikes spikes.
+
+    labels -- the cluster id of every spike
+    names -- the names of the clusters (the id of a cluster is its position in names; names are never removed so ids
+             stay valid for the journal and the undo history)
+    visible -- which clusters exist (deleted or emptied clusters are hidden, not removed)
+    counts -- the number of spikes in every cluster
+    """
+    def __init__(self, cluster_info_file, num_of_spikes, use_existing=True, compact_every=200):
+        self.cluster_info_file = cluster_info_file
+        self.snapshot_file = cluster_info_file + '.labels.npz'
+        self.journal_file = cluster_info_file + '.journal'
+        self.compact_every = compact_every
+
+        self.undo_stack = []
+        self.redo_stack = []
+        self.sequence = 0
+        self._journal = None
+        self._edits_since_compaction = 0
+
+        if use_existing and isfile(self.snapshot_file) and self._snapshot_is_current():
+            self._load_snapshot()
+            self._replay_journal()
+        elif use_existing and isfile(cluster_info_file):
+            self._load_cluster_info(pd.read_pickle(cluster_info_file), num_of_spikes)
+        else:
+            self.names = list(DEFAULT_CLUSTERS)
+            self.visible = np.ones(len(self.names), dtype=np.bool_)
+            self.labels = np.zeros(num_of_spikes, dtype=np.int32)
+
+        assert len(self.labels) == num_of_spikes, 'The cluster info has a different number of spikes than the t-sne'
+        self._count()
+        self.compact()
+
+    # Loading ----------------------------------------------------------------------------------------------------------
+    def _cluster_info_mtime(self):
+        return stat(self.cluster_info_file).st_mtime_ns if isfile(self.cluster_info_file) else -1
+
+    def _snapshot_is_current(self):
+        """
+        False if the .pkl is not the one the snapshot exported (it was written by other code or a crash happened
+        between exporting it and writing the snapshot), so the .pkl holds the newer assignments
+        """
+        with np.load(self.snapshot_file) as snapshot:
+            if 'cluster_info_mtime' not in snapshot.files:
+                return True
+            return int(snapshot['cluster_info_mtime']) == self._cluster_info_mtime()
+
+    def _load_snapshot(self):
+        with np.load(self.snapshot_file) as snapshot:
+            self.labels = snapshot['labels'].astype(np.int32)
+            self.names = [str(name) for name in snapshot['names']]
+            self.visible = snapshot['visible'].astype(np.bool_)
+            self.sequence = int(snapshot['sequence'])
+        self._count()
+
+    def _load_cluster_info(self, cluster_info, num_of_spikes):
+        # a cluster info DataFrame of the old format (or of create_cluster_info_from_kilosort_spike_templates)
+        def store_name(name):
+            return UNLABELED if str(name) in OLD_UNLABELED_NAMES else str(name)
+
+        self.names = []
+        for name in cluster_info.index:
+            if store_name(name) not in self.names:
+                self.names.append(store_name(name))
+        if UNLABELED not in self.names:
+            self.names.insert(0, UNLABELED)
+        self.visible = np.ones(len(self.names), dtype=np.bool_)
+        self.labels = np.zeros(num_of_spikes, dtype=np.int32)
+        self.labels[:] = self.names.index(UNLABELED)
+        for name in cluster_info.index:
+            spike_indices = np.asarray(cluster_info.loc[name].Spike_Indices, dtype=np.int64)
+            self.labels[spike_indices] = self.names.index(store_name(name))
+
+    def _replay_journal(self):
+        if not isfile(self.journal_file):
+            return
+        with open(self.journal_file, 'r') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash while it was written (always the last one)
+                    break
+                if entry['sequence'] <= self.sequence:
+                    continue
+                self._apply_entry(entry['kind'], entry['change'])
+                self.sequence = entry['sequence']
+
+    def _count(self):
+        self.counts = np.bincount(self.labels, minlength=len(self.names)).astype(np.int64)
+
+    # Applying changes -------------------------------------------------------------------------------------------------
+    def _apply(self, change, inverse=False):
+        for name in change['new_names']:
+            if name not in self.names:
+                self.names.append(name)
+                self.visible = np.append(self.visible, False)
+                self.counts = np.append(self.counts, 0)
+
+        spikes = np.asarray(change['spikes'], dtype=np.int64)
+        old_labels = self.labels[spikes]
+        new_labels = np.asarray(change['before'] if inverse else change['after'], dtype=np.int32)
+        self.labels[spikes] = new_labels
+        self.counts -= np.bincount(old_labels, minlength=len(self.names))
+        self.counts += np.bincount(np.broadcast_to(new_labels, spikes.shape), minlength=len(self.names))
+
+        show, hide = (change['hide'], change['show']) if inverse else (change['show'], change['hide'])
+        self.visible[np.asarray(show, dtype=np.int64)] = True
+        self.visible[np.asarray(hide, dtype=np.int64)] = False
+
+    def _apply_entry(self, kind, change):
+        if kind == 'do':
+            self._apply(change)
+            self.undo_stack.append(change)
+            self.redo_stack = []
+        elif kind == 'undo':
+            self._apply(change, inverse=True)
+            if len(self.undo_stack) > 0:
+                self.undo_stack.pop()
+            self.redo_stack.append(change)
+        elif kind == 'redo':
+            self._apply(change)
+            if len(self.redo_stack) > 0:
+                self.redo_stack.pop()
+            self.undo_stack.append(change)
+
+    def _write(self, kind, change):
+        self.sequence += 1
+        self._journal.write(json.dumps({'sequence': self.sequence, 'kind': kind, 'change': change}) + '\n')
+        self._journal.flush()
+        fsync(self._journal.fileno())
+        self._apply_entry(kind, change)
+
+        self._edits_since_compaction += 1
+        if self._edits_since_compaction >= self.compact_every:
+            self.compact()
+
+    def _assignment(self, spike_indices, cluster_name, extra_hide=()):
+        """
+        The change that moves spike_indices to cluster_name (created if it does not exist). Clusters left empty by the
+        move (other than UNLABELED) are hidden.
+        """
+        spikes = np.unique(np.asarray(spike_indices, dtype=np.int64))
+        new_names = []
+        if cluster_name in self.names:
+            target = self.names.index(cluster_name)
+        else:
+            target = len(self.names)
+            new_names.append(cluster_name)
+
+        before = self.labels[spikes]
+        old_ids, moved = np.unique(before, return_counts=True)
+        emptied = old_ids[(self.counts[old_ids] == moved) & (old_ids != target) &
+                          (old_ids != self.names.index(UNLABELED))]
+        hide = np.union1d(emptied, np.asarray(extra_hide, dtype=np.int64))
+        show = [target] if target >= len(self.visible) or not self.visible[target] else []
+        return {'spikes': spikes.tolist(), 'before': before.tolist(), 'after': int(target), 'new_names': new_names,
+                'show': [int(i) for i in show], 'hide': hide.astype(np.int64).tolist()}
+
+    # Edits ------------------------------------------------------------------------------------------------------------
+    def assign(self, spike_indices, cluster_name):
+        """
+        Moves the spikes to cluster_name (a new cluster if no cluster has that name)
+        """
+        if len(spike_indices) == 0:
+            return
+        self._write('do', self._assignment(spike_indices, cluster_name))
+
+    def delete_clusters(self, cluster_names):
+        """
+        Removes the clusters and puts their spikes back to UNLABELED
+        """
+        ids = [self.names.index(name) for name in cluster_names if name in self.names and name != UNLABELED]
+        if len(ids) == 0:
+            return
+        self._write('do', self._assignment(self.spikes_of_clusters(ids), UNLABELED, extra_hide=ids))
+
+    def merge(self, cluster_names, spike_indices=None):
+        """
+        Moves all the spikes of the clusters (and the extra spike_indices, e.g. selected UNLABELED spikes) to the first
+        cluster of cluster_names. The other clusters are removed. UNLABELED is never merged as a whole.
+        """
+        target = cluster_names[0]
+        ids = [self.names.index(name) for name in cluster_names[1:] if name != UNLABELED]
+        spikes = self.spikes_of_clusters(ids)
+        if spike_indices is not None:
+            spikes = np.union1d(spikes, np.asarray(spike_indices, dtype=np.int64))
+        if len(spikes) == 0:
+            return
+        self._write('do', self._assignment(spikes, target, extra_hide=ids))
+
+    def undo(self):
+        if len(self.undo_stack) == 0:
+            return False
+        self._write('undo', self.undo_stack[-1])
+        return True
+
+    def redo(self):
+        if len(self.redo_stack) == 0:
+            return False
+        self._write('redo', self.redo_stack[-1])
+        return True
+
+    # Queries ----------------------------------------------------------------------------------------------------------
+    def cluster_ids(self):
+        """
+        The ids of the existing clusters (in the order of the gui's table)
+        """
+        return np.flatnonzero(self.visible)
+
+    def cluster_names(self, ids=None):
+        if ids is None:
+            ids = self.cluster_ids()
+        return [self.names[i] for i in ids]
+
+    def spikes_of_clusters(self, ids):
+        return np.flatnonzero(np.in1d(self.labels, np.asarray(ids, dtype=np.int64)))
+
+    def table(self):
+        """
+        The columns of the gui's clusters table
+        """
+        ids = self.cluster_ids()
+        return {'Cluster': self.cluster_names(ids), 'Num_of_Spikes': self.counts[ids].tolist()}
+
+    def to_dataframe(self):
+        """
+        The cluster info DataFrame of the old .pkl format (index Cluster, columns Num_of_Spikes and Spike_Indices)
+        """
+        ids = self.cluster_ids()
+        order = np.argsort(self.labels, kind='stable')
+        boundaries = np.searchsorted(self.labels[order], np.append(ids, ids + 1))
+        spike_indices = [order[boundaries[i]:boundaries[len(ids) + i]].astype(np.int32) for i in np.arange(len(ids))]
+        cluster_info = pd.DataFrame({'Cluster': self.cluster_names(ids), 'Num_of_Spikes': self.counts[ids],
+                                     'Spike_Indices': spike_indices})
+        return cluster_info.set_index('Cluster')
+
+    # Persistence ------------------------------------------------------------------------------------------------------
+    def compact(self):
+        """
+        Writes the cluster info .pkl and the snapshot and empties the journal. The snapshot holds the sequence number
+        of the last edit it includes so a crash between writing it and emptying the journal replays nothing twice, and
+        the modification time of the .pkl it exported.
+        """
+        if self._journal is not None:
+            self._journal.close()
+        _atomic_write(self.cluster_info_file,
+                      lambda file: pickle.dump(self.to_dataframe(), file, protocol=pickle.HIGHEST_PROTOCOL))
+        cluster_info_mtime = self._cluster_info_mtime()
+        _atomic_write(self.snapshot_file, lambda file: np.savez(file, labels=self.labels, names=np.array(self.names),
+                                                                visible=self.visible, sequence=self.sequence,
+                                                                cluster_info_mtime=cluster_info_mtime))
+        self._journal = open(self.journal_file, 'w')
+        self._edits_since_compaction = 0
+
+    def close(self):
+        self.compact()
+        self._journal.close()
@@ -0,0 +1,150 @@
+
+"""
+Running statistics of the spikes selected on the t-sne gui (tsne_cluster.py).
+
+Instead of averaging all the selected spikes of the (channels x time x spikes) cube and correlating all their times
+on every change of the selection, the sum of the selected waveforms and the autocorrelogram of the selection are
+kept and only the spikes added to or removed from the selection are read from the cube and correlated (with the
+spikes that stay selected). Changes too large to be done interactively can first be shown as an estimate from a
+random subsample of the selection and then refreshed exactly in steps of spikes_per_read changed spikes (start_update
+and step), so the gui can do one step per tick and drop the rest if the selection changes again.
+"""
+import numpy as np
+from BrainDataAnalysis import correlograms
+
+
+class SelectionStatistics:
+    """
+    cut_extracellular_data -- the (channels x time x spikes) cube (a memmap is only read at the changed spikes)
+    spike_times -- the time of every spike of the cube
+    lag, number_of_bins -- the autocorrelogram has number_of_bins equal bins between -lag and lag
+    spikes_per_read -- the number of spikes read from the cube at a time
+    max_exact_change -- changes of the selection with more spikes than this are first estimated (see needs_estimate)
+    estimate_size -- the number of spikes of the subsample the estimates are calculated from
+    """
+    def __init__(self, cut_extracellular_data, spike_times, lag=1500, number_of_bins=100, spikes_per_read=4096,
+                 max_exact_change=20000, estimate_size=5000):
+        self.data = cut_extracellular_data
+        self.spike_times = np.asarray(spike_times).astype(np.int64)
+        self.lag = lag
+        self.number_of_bins = number_of_bins
+        self.spikes_per_read = spikes_per_read
+        self.max_exact_change = max_exact_change
+        self.estimate_size = estimate_size
+        self.edges = np.linspace(-lag, lag, number_of_bins + 1)
+        self.reset()
+
+    def reset(self):
+        self.selected = np.zeros(len(self.spike_times), dtype=np.bool_)
+        self.count = 0
+        self.waveform_sum = np.zeros(self.data.shape[:2])
+        self.autocorrelogram = np.zeros(self.number_of_bins, dtype=np.int64)
+        self._pending_removed = np.array([], dtype=np.int64)
+        self._pending_added = np.array([], dtype=np.int64)
+
+    def _sum_of_waveforms(self, spike_indices):
+        # sorted indices so the memmap is read in order
+        spike_indices = np.sort(spike_indices)
+        waveform_sum = np.zeros(self.data.shape[:2])
+        for start in np.arange(0, len(spike_indices), self.spikes_per_read):
+            waveform_sum += np.sum(self.data[:, :, spike_indices[start:start + self.spikes_per_read]], axis=2)
+        return waveform_sum
+
+    def _correlogram(self, spike_indices_1, spike_indices_2):
+        if len(spike_indices_1) == 0 or len(spike_indices_2) == 0:
+            return np.zeros(self.number_of_bins, dtype=np.int64)
+        counts, _ = correlograms.correlogram(self.spike_times[spike_indices_1], self.spike_times[spike_indices_2],
+                                             self.lag, number_of_bins=self.number_of_bins)
+        return counts
+
+    def _changes(self, spike_indices):
+        new_selected = np.zeros(len(self.spike_times), dtype=np.bool_)
+        new_selected[np.asarray(spike_indices, dtype=np.int64)] = True
+        added = np.flatnonzero(new_selected & ~self.selected)
+        removed = np.flatnonzero(self.selected & ~new_selected)
+        return new_selected, added, removed
+
+    def needs_estimate(self, spike_indices):
+        """
+        True if updating to the spike_indices selection would read more than max_exact_change spikes
+        """
+        new_selected, added, removed = self._changes(spike_indices)
+        return min(len(added) + len(removed), np.sum(new_selected)) > self.max_exact_change
+
+    def _remove(self, removed):
+        # hist(S - R) = hist(S) - hist(R) - cross(R, S - R) - cross(S - R, R)
+        self.selected[removed] = False
+        kept = np.flatnonzero(self.selected)
+        self.waveform_sum -= self._sum_of_waveforms(removed)
+        self.autocorrelogram -= self._correlogram(removed, removed) + self._correlogram(removed, kept) + \
+            self._correlogram(kept, removed)
+        self.count = len(kept)
+
+    def _add(self, added):
+        # hist(S + A) = hist(S) + hist(A) + cross(A, S) + cross(S, A)
+        kept = np.flatnonzero(self.selected)
+        self.waveform_sum += self._sum_of_waveforms(added)
+        self.autocorrelogram += self._correlogram(added, added) + self._correlogram(added, kept) + \
+            self._correlogram(kept, added)
+        self.selected[added] = True
+        self.count = len(kept) + len(added)
+
+    def start_update(self, spike_indices):
+        """
+        Plans making spike_indices the selection (replacing any unfinished plan). Only the added and removed spikes
+        (or all the new selection if that is smaller than the change) will be read and correlated by step()
+        """
+        new_selected, added, removed = self._changes(spike_indices)
+        if len(added) + len(removed) > np.sum(new_selected):
+            self.reset()
+            added = np.flatnonzero(new_selected)
+            removed = np.array([], dtype=np.int64)
+        self._pending_removed = removed
+        self._pending_added = added
+
+    def step(self):
+        """
+        Removes or adds the next spikes_per_read spikes of the planned change. The statistics are always exact for the
+        spikes selected so far. Returns True if the planned change is finished
+        """
+        if len(self._pending_removed) > 0:
+            self._remove(self._pending_removed[:self.spikes_per_read])
+            self._pending_removed = self._pending_removed[self.spikes_per_read:]
+        elif len(self._pending_added) > 0:
+            self._add(self._pending_added[:self.spikes_per_read])
+            self._pending_added = self._pending_added[self.spikes_per_read:]
+        return len(self._pending_removed) == 0 and len(self._pending_added) == 0
+
+    def result(self):
+        """
+        Returns the average waveform (channels x time) of the selected spikes, their autocorrelogram counts and its bin
+        edges
+        """
+        return self.waveform_sum / max(self.count, 1), self.autocorrelogram, self.edges
+
+    def update(self, spike_indices):
+        """
+        Makes spike_indices the selection in one go (start_update and all the steps)
+
+        Returns the average waveform (channels x time), the autocorrelogram counts and its bin edges
+        """
+        self.start_update(spike_indices)
+        while not self.step():
+            pass
+        return self.result()
+
+    def estimate(self, spike_indices):
+        """
+        The statistics of spike_indices from a random subsample of estimate_size spikes. The running statistics are not
+        changed. The autocorrelogram counts are scaled by the ratio of the number of pairs in the selection to the
+        number of pairs in the subsample.
+
+        Returns the average waveform (channels x time), the autocorrelogram counts and its bin edges
+        """
+        spike_indices = np.asarray(spike_indices, dtype=np.int64)
+        n = len(spike_indices)
+        m = min(self.estimate_size, n)
+        sample = np.random.choice(spike_indices, size=m, replace=False)
+        average = self._sum_of_waveforms(sample) / max(m, 1)
+        pairs_ratio = n * (n - 1) / max(m * (m - 1), 1)
+        return average, self._correlogram(sample, sample) * pairs_ratio, self.edges
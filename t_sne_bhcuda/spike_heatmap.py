@@ -11,7 +11,8 @@ import scipy.interpolate as interpolate
 import os.path as op
 from six import exec_
 import matplotlib.pyplot as plt
-import pandas as pd
+import matplotlib.colors as colors
+from GUIs.Kilosort import spike_heatmap as kilosort_heatmap
 import itertools
 import warnings
 
@@ -35,43 +36,49 @@ def peaktopeak(data, voltage_step_size=1e-6, scale_microvolts=1000000, window_si
     p2p: the channels' peak to peak voltage difference
     """
     extracellular_avg_volts = np.average(data[:, :, :], axis=2)
+    argmaxima, argminima, maxima, minima, p2p = peaktopeak_of_average(extracellular_avg_volts,
+                                                                      voltage_step_size=voltage_step_size,
+                                                                      scale_microvolts=scale_microvolts,
+                                                                      window_size=window_size)
+    channels = np.arange(len(p2p))
+
+    stdv = stats.sem(data[:, :, :], axis=2)
+    stdv = stdv * voltage_step_size * scale_microvolts
+
+    stdv_minima = stdv[channels, argminima.astype(np.int64)]
+    stdv_maxima = stdv[channels, argmaxima.astype(np.int64)]
+
+    error = np.sqrt((stdv_minima * stdv_minima) + (stdv_maxima * stdv_maxima))
+
+    return argmaxima, argminima, maxima, minima, p2p, error
+
+
+def peaktopeak_of_average(extracellular_avg_volts, voltage_step_size=1e-6, scale_microvolts=1000000, window_size=60):
+    """
+    Same as peaktopeak (without the error) for the channels x time average over spikes
+
+    Returns
+    -------
+    argmaxima, argminima, maxima, minima, p2p: as in peaktopeak
+    """
     num_time_points = extracellular_avg_volts.shape[1]
     extracellular_avg_microvolts = extracellular_avg_volts * scale_microvolts * voltage_step_size
     num_channels = np.size(extracellular_avg_microvolts, axis=0)
     lower_bound = int(num_time_points / 2.0 - window_size / 2.0)
     upper_bound = int(num_time_points / 2.0 + window_size / 2.0)
 
-    argminima = np.zeros(num_channels)
-    for m in range(num_channels):
-        argminima[m] = np.argmin(extracellular_avg_microvolts[m][lower_bound:upper_bound])+lower_bound
+    window = extracellular_avg_microvolts[:, lower_bound:upper_bound]
+    channels = np.arange(num_channels)
 
-    argmaxima = np.zeros(num_channels)
-    for n in range(num_channels):
-        argmaxima[n] = np.argmax(extracellular_avg_microvolts[n][lower_bound:upper_bound])+lower_bound
+    argminima = (np.argmin(window, axis=1) + lower_bound).astype(np.float64)
+    argmaxima = (np.argmax(window, axis=1) + lower_bound).astype(np.float64)
 
-    maxima = np.zeros(num_channels)
-    for p in range(num_channels):
-            maxima[p] = np.max(extracellular_avg_microvolts[p][lower_bound:upper_bound])
-
-    minima = np.zeros(num_channels)
-    for k in range(num_channels):
-        minima[k] = np.min(extracellular_avg_microvolts[k][lower_bound:upper_bound])
+    maxima = window[channels, argmaxima.astype(np.int64) - lower_bound].astype(np.float64)
+    minima = window[channels, argminima.astype(np.int64) - lower_bound].astype(np.float64)
 
     p2p = maxima-minima
 
-    stdv_minima = np.zeros(num_channels)
-    stdv_maxima = np.zeros(num_channels)
-
-    stdv = stats.sem(data[:, :, :], axis=2)
-    stdv = stdv * voltage_step_size * scale_microvolts
-
-    for b in range(num_channels):
-        stdv_minima[b] = stdv[b, int(argminima[b])]
-        stdv_maxima[b] = stdv[b, int(argmaxima[b])]
-
-    error = np.sqrt((stdv_minima * stdv_minima) + (stdv_maxima * stdv_maxima))
-
-    return argmaxima, argminima, maxima, minima, p2p, error
+    return argmaxima, argminima, maxima, minima, p2p
 
 
 def get_probe_geometry_from_prb_file(prb_file):
@@ -255,35 +262,50 @@ def create_heatmap(data, prb_file, voltage_step_size=1e-6, scale_microvolts=1000
     """
     _, _, _, _, p2p, error = peaktopeak(data, voltage_step_size=voltage_step_size,
                                         scale_microvolts=scale_microvolts, window_size=window_size)
+    return create_heatmap_of_p2p(p2p, prb_file, rotate_90=rotate_90, flip_ud=flip_ud, flip_lr=flip_lr)
+
+
+def create_heatmap_of_average(extracellular_avg_volts, prb_file, voltage_step_size=1e-6, scale_microvolts=1000000,
+                              window_size=60, rotate_90=False, flip_ud=False, flip_lr=False):
+    """
+    Same as create_heatmap for the channels x time average over spikes (e.g. a running average kept by the gui)
+    instead of the channels x time x spikes array
+    """
+    _, _, _, _, p2p = peaktopeak_of_average(extracellular_avg_volts, voltage_step_size=voltage_step_size,
+                                            scale_microvolts=scale_microvolts, window_size=window_size)
+    return create_heatmap_of_p2p(p2p, prb_file, rotate_90=rotate_90, flip_ud=flip_ud, flip_lr=flip_lr)
+
+
+def create_heatmap_of_p2p(p2p, prb_file, rotate_90=False, flip_ud=False, flip_lr=False):
+    """
+    The heatmap image of the peak to peak voltages of all the channels (see create_heatmap). Every channel group of the
+    prb file is a shank, coloured from the minimum to the maximum p2p of its channels (as plot_topoplot does).
+    The interpolation is the cached sparse operator of the probe (GUIs.Kilosort.spike_heatmap.heatmap_operator) and the
+    colours come straight from the colormap, so no matplotlib figure is drawn.
+    """
+    p2p = np.asarray(p2p, dtype=np.float64)
+    operator = kilosort_heatmap.heatmap_operator(prb_file, rotate_90=rotate_90, flip_ud=flip_ud, flip_lr=flip_lr,
+                                                 shanks_from_groups=True)
+    cmap = plt.get_cmap("jet")
+    shank_images = []
+    for info, zi in zip(operator.shanks, operator.interpolate(p2p)):
+        values = p2p[info['channels']]
+        norm = colors.Normalize(vmin=values.min(), vmax=values.max())
+        # the rows from the top of the heatmap down (like a rendered image), the pixels outside the electrodes clear
+        shank_images.append(cmap(norm(np.ma.masked_invalid(zi.T[::-1])), bytes=True))
+
+    y_dim_pixels = max(image.shape[0] for image in shank_images)
+    grid_image_spacing = np.full((y_dim_pixels, 10, 4), 255, dtype=np.uint8)
+    columns = []
+    for shank, image in enumerate(shank_images):
+        if shank > 0:
+            columns.append(grid_image_spacing)
+        padding = np.full((y_dim_pixels - image.shape[0], image.shape[1], 4), 255, dtype=np.uint8)
+        columns.append(np.concatenate((image, padding), axis=0))
+    grid_image = np.ascontiguousarray(np.concatenate(columns, axis=1))
 
-    shanks = get_probe_geometry_from_prb_file(prb_file)
-    num_of_shanks = len(list(shanks.keys()))
-    fig = plt.figure()
-    for shank in shanks:
-        channel_positions = pd.Series(shanks[shank]['geometry'])
-        ax = fig.add_subplot(1, num_of_shanks, shank + 1)
-        data = p2p[channel_positions.index]
-        image, channels_grid = plot_topoplot(ax, channel_positions, data, show=False, rotate_90=rotate_90,
-                                             flip_ud=flip_ud, flip_lr=flip_lr)
-
-        image.write_png('temp.png')  # Required to generate the _rgbacache info
-        temp_image = image._rgbacache
-
-        if shank == 0:
-            y_dim_pixels = temp_image.shape[0]
-            grid_image_spacing = np.zeros((y_dim_pixels, 10, 4))
-            grid_image_spacing[:, :, :] = 255
-            grid_image = temp_image
-        else:
-            conc = np.concatenate((grid_image_spacing, temp_image), axis=1)
-            grid_image = np.append(grid_image, conc, axis=1)
-    plt.close(fig)
     x_size = grid_image.shape[0]
     y_size = grid_image.shape[1]
-    final_image = np.empty((x_size, y_size), dtype=np.uint32)
-    view = final_image.view(dtype=np.uint8).reshape((x_size, y_size, 4))
-    for i in np.arange(4):
-        view[:, :, i] = grid_image[:, :, i]
+    final_image = grid_image.view(dtype=np.uint32).reshape((x_size, y_size))
 
     return final_image, (x_size, y_size)
-
@@ -8,8 +8,12 @@ from bokeh.models.widgets import DataTable, TableColumn, Button, Select, Toggle,
 import numpy as np
 import pandas as pd
 from t_sne_bhcuda import spike_heatmap
-from itertools import chain
+from t_sne_bhcuda.cluster_store import ClusterStore, UNLABELED
+from t_sne_bhcuda.selection_statistics import SelectionStatistics
+from BrainDataAnalysis import correlograms
+from BrainDataAnalysis import waveform_cubes
 import copy
+from functools import partial
 
 # globals
 previous_tsne_source_selected = None
@@ -25,6 +29,7 @@ selected_cluster_names = None
 num_of_spikes_used = 0
 clusters_of_all_spikes = []
 update_old_selected_switch = True
+selection_refresh_generation = 0
 
 def gui_manual_cluster_tsne_spikes(tsne_array_or_filename, spike_times_list_or_filename, raw_extracellular_data,
                                    num_of_points_for_baseline, cut_extracellular_data_or_filename,
@@ -32,7 +37,7 @@ def gui_manual_cluster_tsne_spikes(tsne_array_or_filename, spike_times_list_or_f
                                    sampling_freq, autocor_bin_number,
                                      cluster_info_file, use_existing_cluster=False, time_samples_h5_dir=None,
                                    spike_indices_to_use=None, prb_file=None, k4=False,
-                                   verbose=False):
+                                   verbose=False, spike_major_cube=False):
     """
     Creates a GUI that shows the t-sne data and allows selection of them, showing the average spikes forms, the
     autocorrelogram and the heatmap of the selected spikes. It also allows putting the selected spikes in clusters.
@@ -64,15 +69,20 @@ def gui_manual_cluster_tsne_spikes(tsne_array_or_filename, spike_times_list_or_f
     cube_type: the data type of the cut cube data
     sampling_freq: the sampling frequency of the recording
     autocor_bin_number: the amount of bins that the autocorellogram will be split into
-    cluster_info_file: the file name to hold the cluster info (a .pkl file since this is a pickle of a pandas dataframe)
+    cluster_info_file: the file name to hold the cluster info (a .pkl file since this is a pickle of a pandas dataframe).
+    The GUI keeps the clusters in a ClusterStore (see cluster_store.py) which journals every edit in
+    cluster_info_file.journal and keeps its snapshots in cluster_info_file.labels.npz. The .pkl is rewritten from the
+    store every few edits and when the GUI closes.
     use_existing_cluster: if False then any .pkl file with the same name will be overwritten and there will be no
-    cluster info at the beginning of the GUI. If True then the existing .pkl file will be expanded (and its clusters
-    will appear at the beginning of the GUI).
+    cluster info at the beginning of the GUI. If True then the existing clusters (the store's snapshot and journal
+    if they exist, otherwise the .pkl file) will be expanded (and will appear at the beginning of the GUI).
     time_samples_h5_dir: the directory structure within the .kwik file where the spike times are saved
     spike_indices_to_use: A sub-sample of the spikes passed by the t-sne data and the raw or cut extracellular data
     prb_file: the probe geometry file defining the probe as used in the phy module
     k4: if True the screen is 4k (defines the size of the gui). Otherwise it is assumed to be HD
     verbose: if True then the GUI will print info on the interpreter
+    spike_major_cube: if True the cut data cube file is (or is created) spikes x channels x time points, so the reads
+    of the selected spikes' waveforms are reads of whole rows (see BrainDataAnalysis.waveform_cubes)
 
     Returns
     -------
@@ -126,7 +136,8 @@ def gui_manual_cluster_tsne_spikes(tsne_array_or_filename, spike_times_list_or_f
                                                                       num_ivm_channels, num_of_points_in_spike_trig,
                                                                       cube_type, used_extra_spike_times,
                                                                       num_of_points_for_baseline=
-                                                                      num_of_points_for_baseline)
+                                                                      num_of_points_for_baseline,
+                                                                      spike_major=spike_major_cube)
     else:
         if num_of_spikes_used != num_of_initial_spikes:
             print('Warning! If the cut_extracellular_data_or_filename does not point to a cut data cube with a number' +
@@ -135,17 +146,13 @@ def gui_manual_cluster_tsne_spikes(tsne_array_or_filename, spike_times_list_or_f
         if type(cut_extracellular_data_or_filename) is str and path.isfile(cut_extracellular_data_or_filename):
             print('Loading an existing channels x time x spikes data cube')
             cut_extracellular_data = load_extracellular_data_cube(cut_extracellular_data_or_filename, cube_type,
-                                                                  shape_of_cut_extracellular_data)
+                                                                  shape_of_cut_extracellular_data,
+                                                                  spike_major=spike_major_cube)
         else:
             print("If no extracellular raw or cut data are provided then a filename pointing to the " +
                   "cut extra data cube should be given")
             return
 
-    if type(cluster_info_file) is str:
-        import os.path as path
-        if not path.isfile(cluster_info_file):
-            create_new_cluster_info_file(cluster_info_file, num_of_spikes_used)
-
 
     time_axis = generate_time_axis(num_of_points_in_spike_trig, sampling_freq)
     clusters_of_all_spikes = np.empty((num_of_spikes_used), dtype=np.int32)
@@ -171,46 +178,41 @@ def get_spike_times_from_kwik_file(kwik_filename, time_samples_h5_dir, verbose=F
 
 def create_data_cube_from_raw_extra_data(raw_extracellular_data, data_cube_filename, num_ivm_channels,
                                          num_of_points_in_spike_trig, cube_type, extra_spike_times,
-                                         num_of_points_for_baseline=None):
+                                         num_of_points_for_baseline=None, spike_major=False, channels_of_spikes=None,
+                                         n_jobs=1):
+    """
+    Cuts the spike windows out of the raw data into a memmapped cube (see waveform_cubes.create_data_cube, which reads
+    the raw data sequentially in chunks). If spike_major the file is spikes x channels x time points (so reading the
+    waveforms of a set of spikes reads whole rows) and channels_of_spikes can keep only some channels of every spike.
+    The cube is returned as a channels x time points x spikes (view) in both layouts.
+    """
     import os.path as path
     if path.isfile(data_cube_filename):
         import os
         os.remove(data_cube_filename)
 
-    num_of_spikes = len(extra_spike_times)
-    shape_of_spike_trig_avg = ((num_ivm_channels,
-                                num_of_points_in_spike_trig,
-                                num_of_spikes))
-
-    data_cube = np.memmap(data_cube_filename,
-                          dtype=cube_type,
-                          mode='w+',
-                          shape=shape_of_spike_trig_avg)
-    for spike in np.arange(0, num_of_spikes):
-        trigger_point = extra_spike_times[spike]
-        start_point = int(trigger_point - num_of_points_in_spike_trig / 2)
-        if start_point < 0:
-            break
-        end_point = int(trigger_point + num_of_points_in_spike_trig / 2)
-        if end_point > raw_extracellular_data.shape[1]:
-            break
-        temp = raw_extracellular_data[:, start_point:end_point]
-        if num_of_points_for_baseline is not None:
-            baseline = np.mean(temp[:, [0, num_of_points_for_baseline]], 1)
-            temp = (temp.T - baseline.T).T
-        data_cube[:, :, spike] = temp.astype(cube_type)
+    cube_shape = waveform_cubes.create_data_cube(raw_extracellular_data, data_cube_filename, extra_spike_times,
+                                                 num_of_points_in_spike_trig, cube_type,
+                                                 num_of_points_for_baseline=num_of_points_for_baseline,
+                                                 spike_major=spike_major, channels_of_spikes=channels_of_spikes,
+                                                 n_jobs=n_jobs)
     del raw_extracellular_data
-    del temp
-    del baseline
-    del data_cube
 
-    cut_extracellular_data = load_extracellular_data_cube(data_cube_filename, cube_type, shape_of_spike_trig_avg)
+    cut_extracellular_data = waveform_cubes.load_data_cube(data_cube_filename, cube_type, cube_shape,
+                                                           spike_major=spike_major)
 
     return cut_extracellular_data
 
 
 def load_extracellular_data_cube(data_cube_filename, cube_type,
-                                 shape_of_spike_trig_avg):
+                                 shape_of_spike_trig_avg, spike_major=False):
+    """
+    shape_of_spike_trig_avg is the channels x time points x spikes shape of the cube (in both layouts)
+    """
+    if spike_major:
+        num_of_channels, num_of_points_in_spike_trig, num_of_spikes = shape_of_spike_trig_avg
+        cube_shape = waveform_cubes.data_cube_shape(num_of_spikes, num_of_channels, num_of_points_in_spike_trig)
+        return waveform_cubes.load_data_cube(data_cube_filename, cube_type, cube_shape, spike_major=True)
     cut_extracellular_data = np.memmap(data_cube_filename,
                                        dtype=cube_type,
                                        mode='r',
@@ -227,33 +229,13 @@ def generate_time_axis(num_of_points_in_spike_trig, sampling_freq):
 
 # Spike train autocorelogram
 def crosscorrelate_spike_trains(spike_times_train_1, spike_times_train_2, lag=None):
-    if spike_times_train_1.size < spike_times_train_2.size:
-        if lag is None:
-            lag = np.ceil(10 * np.mean(np.diff(spike_times_train_1)))
-        reverse = False
-    else:
-        if lag is None:
-            lag = np.ceil(20 * np.mean(np.diff(spike_times_train_2)))
-        spike_times_train_1, spike_times_train_2 = spike_times_train_2, spike_times_train_1
-        reverse = True
-
-    # calculate cross differences in spike times
-    differences = np.array([])
-    for k in np.arange(0, spike_times_train_1.size):
-        differences = np.append(differences, spike_times_train_1[k] - spike_times_train_2[np.nonzero(
-            (spike_times_train_2 > spike_times_train_1[k] - lag)
-             & (spike_times_train_2 < spike_times_train_1[k] + lag)
-             & (spike_times_train_2 != spike_times_train_1[k]))])
-    if reverse is True:
-        differences = -differences
-    norm = np.sqrt(spike_times_train_1.size * spike_times_train_2.size)
-    return differences, norm
+    return correlograms.crosscorrelate_spike_trains(spike_times_train_1, spike_times_train_2, lag=lag)
 
 
 # Cluster info file and pandas series functions
 def create_new_cluster_info_file(filename, tsne_length):
     cluster_info = pd.DataFrame(
-        {'Cluster': 'UNLABELD', 'Num_of_Spikes': tsne_length, 'Spike_Indices': [np.arange(tsne_length)]})
+        {'Cluster': 'UNLABELED', 'Num_of_Spikes': tsne_length, 'Spike_Indices': [np.arange(tsne_length)]})
     cluster_info = cluster_info.append(pd.Series({'Cluster': 'NOISE', 'Num_of_Spikes': 0, 'Spike_Indices': []}),
                                        ignore_index=True)
     cluster_info = cluster_info.append(pd.Series({'Cluster': 'MUA', 'Num_of_Spikes': 0, 'Spike_Indices': []}),
@@ -462,6 +444,37 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
     tsne_figure.select(BoxSelectTool).select_every_mousemove = False
     tsne_figure.select(LassoSelectTool).select_every_mousemove = False
 
+    # running average and autocorrelogram of the selected spikes (updated only with the spikes that change)
+    selection_statistics = SelectionStatistics(cut_extracellular_data, all_extra_spike_times, lag=1500,
+                                               number_of_bins=autocor_bin_number)
+
+    def show_selection_statistics(avg_x, hist, edges):
+        # update spike plot
+        spike_mline_plot.data_source.data['ys'] = avg_x.tolist()
+
+        # update autocorelogram
+        hist_plot.data_source.data["top"] = hist
+        hist_plot.data_source.data["left"] = edges[:-1] / sampling_freq
+        hist_plot.data_source.data["right"] = edges[1:] / sampling_freq
+
+        # update heatmap
+        if prb_file is not None:
+            final_image, (x_size, y_size) = spike_heatmap.create_heatmap_of_average(avg_x, prb_file, rotate_90=True,
+                                                                                    flip_ud=True, flip_lr=False)
+            new_image_data = dict(image=[final_image], x=[0], y=[0], dw=[x_size], dh=[y_size])
+            heatmap_data_source.data.update(new_image_data)
+
+    def refresh_selection_statistics(generation):
+        # one step (spikes_per_read spikes) of the exact update per tick. A newer selection makes the
+        # remaining steps of this one stale
+        global selection_refresh_generation
+        if generation != selection_refresh_generation:
+            return
+        if selection_statistics.step():
+            show_selection_statistics(*selection_statistics.result())
+        else:
+            curdoc().add_next_tick_callback(partial(refresh_selection_statistics, generation))
+
 
     def on_tsne_data_update(attr, old, new):
         global previously_selected_spike_indices
@@ -471,9 +484,12 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
         global selected_points_size
         global checkbox_find_clusters_of_selected_points
 
+        global selection_refresh_generation
+
         previously_selected_spike_indices = np.array(old['1d']['indices'])
         currently_selected_spike_indices = np.array(new['1d']['indices'])
         num_of_selected_spikes = len(currently_selected_spike_indices)
+        selection_refresh_generation += 1
 
         if num_of_selected_spikes > 0:
             if verbose:
@@ -484,25 +500,14 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
             tsne_nonselected_points_glyph.size = non_selected_points_size
             tsne_nonselected_points_glyph.fill_alpha = non_selected_points_alpha
 
-            # update spike plot
-            avg_x = np.mean(cut_extracellular_data[:, :, currently_selected_spike_indices], axis=2)
-            spike_mline_plot.data_source.data['ys'] = avg_x.tolist()
-
-            # update autocorelogram
-            diffs, norm = crosscorrelate_spike_trains(all_extra_spike_times[currently_selected_spike_indices].astype(np.int64),
-                                                      all_extra_spike_times[currently_selected_spike_indices].astype(np.int64), lag=1500)
-            hist, edges = np.histogram(diffs, bins=autocor_bin_number)
-            hist_plot.data_source.data["top"] = hist
-            hist_plot.data_source.data["left"] = edges[:-1] / sampling_freq
-            hist_plot.data_source.data["right"] = edges[1:] / sampling_freq
-
-            # update heatmap
-            if prb_file is not None:
-                data = cut_extracellular_data[:, :, currently_selected_spike_indices]
-                final_image, (x_size, y_size) = spike_heatmap.create_heatmap(data, prb_file, rotate_90=True,
-                                                                             flip_ud=True, flip_lr=False)
-                new_image_data = dict(image=[final_image], x=[0], y=[0], dw=[x_size], dh=[y_size])
-                heatmap_data_source.data.update(new_image_data)
+            # update spike plot, autocorelogram and heatmap. Large changes of the selection are first shown from a
+            # subsample of the selected spikes and refreshed with the exact statistics over the next ticks
+            if selection_statistics.needs_estimate(currently_selected_spike_indices):
+                show_selection_statistics(*selection_statistics.estimate(currently_selected_spike_indices))
+                selection_statistics.start_update(currently_selected_spike_indices)
+                curdoc().add_next_tick_callback(partial(refresh_selection_statistics, selection_refresh_generation))
+            else:
+                show_selection_statistics(*selection_statistics.update(currently_selected_spike_indices))
 
 
     tsne_source.on_change('selected', on_tsne_data_update)
@@ -547,11 +552,8 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
     # --------------- CONTROLS --------------
     # Texts and Tables
     # the clusters DataTable
-    if use_existing_cluster:
-        cluster_info = load_cluster_info(cluster_info_file)
-    else:
-        cluster_info = create_new_cluster_info_file(cluster_info_file, len(tsne))
-    cluster_info_data_source = ColumnDataSource(cluster_info)
+    cluster_store = ClusterStore(cluster_info_file, len(tsne[0]), use_existing=use_existing_cluster)
+    cluster_info_data_source = ColumnDataSource(cluster_store.table())
     clusters_columns = [TableColumn(field='Cluster', title='Clusters'),
                         TableColumn(field='Num_of_Spikes', title='Number of Spikes')]
     clusters_table = DataTable(source=cluster_info_data_source, columns=clusters_columns, selectable=True,
@@ -560,9 +562,9 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
 
     def on_select_cluster_info_table(attr, old, new):
         global selected_cluster_names
-        cluster_info = load_cluster_info(cluster_info_file)
-        indices = list(chain.from_iterable(cluster_info.iloc[new['1d']['indices']].Spike_Indices.tolist()))
-        selected_cluster_names = list(cluster_info.index[new['1d']['indices']])
+        cluster_ids = cluster_store.cluster_ids()[new['1d']['indices']]
+        indices = cluster_store.spikes_of_clusters(cluster_ids).tolist()
+        selected_cluster_names = cluster_store.cluster_names(cluster_ids)
         old = new = tsne_source.selected
         tsne_source.selected['1d']['indices'] = indices
         tsne_source.trigger('selected', old, new)
@@ -571,7 +573,7 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
     cluster_info_data_source.on_change('selected', on_select_cluster_info_table)
 
     def update_data_table():
-        cluster_info_data_source = ColumnDataSource(load_cluster_info(cluster_info_file))
+        cluster_info_data_source = ColumnDataSource(cluster_store.table())
         cluster_info_data_source.on_change('selected', on_select_cluster_info_table)
         clusters_table.source = cluster_info_data_source
         options = list(cluster_info_data_source.data['Cluster'])
@@ -584,25 +586,9 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
 
     def on_text_edit_new_cluster_name(attr, old, new):
         global currently_selected_spike_indices
-        global clusters_of_all_spikes
 
         new_cluster_name = new_cluster_name_edit.value
-
-        spike_indices_to_delete_from_existing_clusters = {}
-        for spike_index in currently_selected_spike_indices:
-            if clusters_of_all_spikes[spike_index] != -1:
-                cluster_index = clusters_of_all_spikes[spike_index]
-                if cluster_index not in spike_indices_to_delete_from_existing_clusters:
-                    spike_indices_to_delete_from_existing_clusters[cluster_index] = [spike_index]
-                else:
-                    spike_indices_to_delete_from_existing_clusters[cluster_index].append(spike_index)
-        cluster_info = load_cluster_info(cluster_info_file)
-        for cluster_index in spike_indices_to_delete_from_existing_clusters.keys():
-            cluster_name = cluster_info.iloc[cluster_index].name
-            remove_spikes_from_cluster(cluster_info_file, cluster_name,
-                                       spike_indices_to_delete_from_existing_clusters[cluster_index], unassign=False)
-
-        add_cluster_to_cluster_info(cluster_info_file, new_cluster_name, currently_selected_spike_indices)
+        cluster_store.assign(currently_selected_spike_indices, new_cluster_name)
 
         update_data_table()
 
@@ -620,21 +606,16 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
         global tsne_clusters_scatter_plot
 
         if state:
-            cluster_info = load_cluster_info(cluster_info_file)
-            num_of_clusters = cluster_info.shape[0]
-            indices_list_of_lists = cluster_info['Spike_Indices'].tolist()
-            indices = [item for sublist in indices_list_of_lists for item in sublist]
-            cluster_indices = np.arange(num_of_clusters)
+            indices = cluster_store.spikes_of_clusters(cluster_store.cluster_ids())
 
             if verbose:
                 print('Showing all clusters in colors... wait for it...')
 
-            colors = []
-            for c in cluster_indices:
-                r = np.random.random(size=1) * 255
-                g = np.random.random(size=1) * 255
-                for i in np.arange(len(indices_list_of_lists[c])):
-                    colors.append("#%02x%02x%02x" % (int(r), int(g), 50))
+            r = np.random.random(size=len(cluster_store.names)) * 255
+            g = np.random.random(size=len(cluster_store.names)) * 255
+            color_of_cluster = np.array(["#%02x%02x%02x" % (int(r[c]), int(g[c]), 50)
+                                         for c in np.arange(len(cluster_store.names))])
+            colors = color_of_cluster[cluster_store.labels[indices]].tolist()
 
             first_time = True
             for renderer in tsne_figure.renderers:
@@ -665,24 +646,15 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
     button_show_clusters_of_selected_points = Button(label='Show clusters of selected points')
 
     def on_button_show_clusters_change():
-        global clusters_of_all_spikes
-        currently_selected_spike_indices = tsne_source.selected['1d']['indices']
-        cluster_info = load_cluster_info(cluster_info_file)
-        clusters_selected = []
-        new_indices_to_select = []
+        currently_selected_spike_indices = np.array(tsne_source.selected['1d']['indices'], dtype=np.int64)
         update_data_table()
-        for spike_index in currently_selected_spike_indices:
-            if clusters_of_all_spikes[spike_index] not in clusters_selected:
-                clusters_selected.append(clusters_of_all_spikes[spike_index])
-                indices_in_cluster = cluster_info.iloc[clusters_of_all_spikes[spike_index]].Spike_Indices
-                new_indices_to_select.append(indices_in_cluster)
-        if len(new_indices_to_select) > 0:
+        cluster_ids = np.unique(cluster_store.labels[currently_selected_spike_indices])
+        clusters_selected = np.flatnonzero(np.in1d(cluster_store.cluster_ids(), cluster_ids)).tolist()
+        if len(clusters_selected) > 0:
             old = clusters_table.source.selected
             clusters_table.source.selected['1d']['indices'] = clusters_selected
             new = clusters_table.source.selected
             clusters_table.source.trigger('selected', old, new)
-            for c in np.arange(len(clusters_selected)):
-                clusters_selected[c] = cluster_info.index[clusters_selected[c]]
 
 
     button_show_clusters_of_selected_points.on_click(on_button_show_clusters_change)
@@ -691,26 +663,13 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
     button_merge_clusters_of_selected_points = Button(label='Merge clusters of selected points')
 
     def on_button_merge_clusters_change():
-        global clusters_of_all_spikes
-        currently_selected_spike_indices = tsne_source.selected['1d']['indices']
-        cluster_info = load_cluster_info(cluster_info_file)
-        clusters_selected = []
-        for spike_index in currently_selected_spike_indices:
-            if clusters_of_all_spikes[spike_index] not in clusters_selected:
-                clusters_selected.append(clusters_of_all_spikes[spike_index])
-        if len(clusters_selected) > 0:
-            clusters_selected = np.sort(clusters_selected)
-            clusters_selected_names = []
-            for cluster_index in clusters_selected:
-                clusters_selected_names.append(cluster_info.iloc[cluster_index].name)
+        currently_selected_spike_indices = np.array(tsne_source.selected['1d']['indices'], dtype=np.int64)
+        cluster_ids = np.unique(cluster_store.labels[currently_selected_spike_indices])
+        clusters_selected_names = [name for name in cluster_store.cluster_names(cluster_ids) if name != UNLABELED]
+        if len(clusters_selected_names) > 0:
+            # all the spikes of the clusters (and the selected UNLABELED ones) go to the first cluster
             cluster_name = clusters_selected_names[0]
-            add_cluster_to_cluster_info(cluster_info_file, cluster_name, currently_selected_spike_indices)
-            i = 0
-            for c in np.arange(1, len(clusters_selected)):
-                cluster_info = remove_cluster_from_cluster_info(cluster_info_file,
-                                                                cluster_info.iloc[clusters_selected[c] - i].name,
-                                                                unassign=False)
-                i = i + 1 # Every time you remove a cluster the original index of the remaining clusters drops by one
+            cluster_store.merge(clusters_selected_names, spike_indices=currently_selected_spike_indices)
 
             update_data_table()
             user_info_edit.value = 'Clusters '+ ', '.join(clusters_selected_names) + ' merged to cluster ' + cluster_name
@@ -722,8 +681,7 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
 
     def on_button_delete_cluster():
         global selected_cluster_names
-        for cluster_name in selected_cluster_names:
-            remove_cluster_from_cluster_info(cluster_info_file, cluster_name)
+        cluster_store.delete_clusters(selected_cluster_names)
         user_info_edit.value = 'Deleted clusters: ' + ', '.join(selected_cluster_names)
         update_data_table()
 
@@ -739,9 +697,8 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
 
     def move_selected_points_to_cluster(attr, old, new):
         global currently_selected_spike_indices
-        if len(currently_selected_spike_indices) > 0 and new is not 'No cluster selected':
-            remove_spikes_from_all_clusters(cluster_info_file, currently_selected_spike_indices)
-            add_spikes_to_cluster(cluster_info_file, new, currently_selected_spike_indices)
+        if len(currently_selected_spike_indices) > 0 and new != 'No cluster selected':
+            cluster_store.assign(currently_selected_spike_indices, new)
             update_data_table()
             select_cluster_to_move_points_to.value = 'No cluster selected'
             user_info_edit.value = 'Selected clusters = ' + new
@@ -760,6 +717,23 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
 
     undo_selected_points_button.on_click(on_button_undo_selection)
 
+    # undo and redo cluster edit buttons
+    undo_cluster_edit_button = Button(label='Undo last cluster edit')
+    redo_cluster_edit_button = Button(label='Redo cluster edit')
+
+    def on_button_undo_cluster_edit():
+        if cluster_store.undo():
+            update_data_table()
+            user_info_edit.value = 'Undid the last cluster edit'
+
+    def on_button_redo_cluster_edit():
+        if cluster_store.redo():
+            update_data_table()
+            user_info_edit.value = 'Redid the last undone cluster edit'
+
+    undo_cluster_edit_button.on_click(on_button_undo_cluster_edit)
+    redo_cluster_edit_button.on_click(on_button_redo_cluster_edit)
+
     # Sliders -------------------
     # use the fake data trick to call the callback only when the mouse is released (mouseup only works for CustomJS)
 
@@ -846,6 +820,7 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
                         new_cluster_name_edit,
                         button_show_all_clusters,
                         undo_selected_points_button,
+                        row(undo_cluster_edit_button, redo_cluster_edit_button),
                         heatmap_plot))
     else:
         lay = row(column(tsne_figure,
@@ -861,11 +836,13 @@ def generate_gui(tsne, cut_extracellular_data, all_extra_spike_times, time_axis,
                          select_cluster_to_move_points_to,
                          new_cluster_name_edit,
                          button_show_all_clusters,
-                         undo_selected_points_button))
+                         undo_selected_points_button,
+                         row(undo_cluster_edit_button, redo_cluster_edit_button)))
 
 
     session = push_session(curdoc())
     session.show(lay)  # open the document in a browser
     session.loop_until_closed()  # run forever, requires stopping the interpreter in order to stop :)
+    cluster_store.close()
 
 
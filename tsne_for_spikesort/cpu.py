@@ -0,0 +1,191 @@
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# CPU equivalents of the gpu.py functions that calculate the high dimensional space distances, sort them and pick the
+# 3 x perplexity closer ones. The outputs have the same layout as the gpu ones (float indices, sorted sqrt distances)
+# so they can be used interchangeably in t_sne.run
+
+def _calculate_distances_on_cpu(a, b, dots_a=None, dots_b=None):
+    """
+    Squared euclidean distances (||a||^2 + ||b||^2 - 2<a,b>) between the rows of a (m x k) and b (n x k) in float32,
+    the same calculation the gpu does with the cuBLAS gemm. The product goes through numpy's BLAS which releases the
+    GIL, so tiles can be calculated concurrently from different threads.
+    """
+    if dots_a is None:
+        dots_a = np.einsum('ij,ij->i', a, a)
+    if dots_b is None:
+        dots_b = np.einsum('ij,ij->i', b, b)
+    distances = np.dot(a, b.T)
+    distances *= -2.0
+    distances += dots_a[:, np.newaxis]
+    distances += dots_b[np.newaxis, :]
+    return distances
+
+
+def _select_knns(num_of_neighbours, distances, start_index):
+    """
+    Partial sort of every row of the distances matrix. Only the num_of_neighbours smallest distances are put in order
+    (ties are resolved by the lower index like the gpu's stable radix sort).
+    """
+    m, n = distances.shape
+    if num_of_neighbours < n:
+        candidates = np.argpartition(distances, num_of_neighbours - 1, axis=1)[:, :num_of_neighbours]
+    else:
+        candidates = np.tile(np.arange(n), (m, 1))
+    candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+    order = np.lexsort((candidates, candidate_distances), axis=1)
+    selected_sorted_indices = np.take_along_axis(candidates, order, axis=1) + start_index
+    selected_sorted_distances = np.take_along_axis(candidate_distances, order, axis=1)
+    return selected_sorted_indices, selected_sorted_distances
+
+
+def _knns_of_tile(first_matrix, second_matrix, num_of_neighbours, start_index, block_size, dots_second=None):
+    """
+    The knns of all the rows of first_matrix amongst the rows of second_matrix. The second matrix is gone through in
+    blocks of block_size rows and the running top num_of_neighbours are merged with the top of every new block, so the
+    memory used is first_matrix.shape[0] x (block_size + num_of_neighbours).
+    """
+    m = first_matrix.shape[0]
+    n = second_matrix.shape[0]
+    if dots_second is None:
+        dots_second = np.einsum('ij,ij->i', second_matrix, second_matrix)
+    dots_first = np.einsum('ij,ij->i', first_matrix, first_matrix)
+
+    best_indices = np.empty((m, 0), dtype=np.int64)
+    best_distances = np.empty((m, 0), dtype=np.float32)
+    for block_start in np.arange(0, n, block_size):
+        block_end = min(block_start + block_size, n)
+        distances = _calculate_distances_on_cpu(first_matrix, second_matrix[block_start:block_end],
+                                                dots_a=dots_first, dots_b=dots_second[block_start:block_end])
+        block_indices, block_distances = _select_knns(min(num_of_neighbours, block_end - block_start), distances,
+                                                      block_start)
+        merged_indices = np.concatenate((best_indices, block_indices), axis=1)
+        merged_distances = np.concatenate((best_distances, block_distances), axis=1)
+        positions, best_distances = _select_knns(min(num_of_neighbours, merged_indices.shape[1]), merged_distances, 0)
+        best_indices = np.take_along_axis(merged_indices, positions, axis=1)
+
+    return best_indices + start_index, best_distances
+
+
+def calculate_knn_distances_all_to_all(template_features_sparse_clean, perplexity=100, tile_size=2048,
+                                       block_size=8192, max_workers=None, verbose=True):
+    """
+    CPU version of gpu.calculate_knn_distances_all_to_all
+
+    template_features_sparse_clean -- samples x features array
+    tile_size -- number of samples whose knns are calculated by one thread at a time
+    block_size -- number of samples the distances of a tile are calculated against at a time
+    max_workers -- number of threads. If None use the ThreadPoolExecutor default
+
+    Returns the samples x (3 * perplexity + 1) arrays of the indices (as floats like the gpu) and distances of the
+    closest samples (each sample is its own first neighbour)
+    """
+    start = timer()
+    num_of_neighbours = perplexity * 3 + 1
+    features = np.ascontiguousarray(template_features_sparse_clean, dtype=np.float32)
+    m = features.shape[0]
+
+    closest_indices = np.empty((m, num_of_neighbours))
+    closest_distances = np.empty((m, num_of_neighbours))
+    dots = np.einsum('ij,ij->i', features, features)
+
+    tiles = [(i, min(i + tile_size, m)) for i in np.arange(0, m, tile_size)]
+
+    def do_tile(tile_index):
+        tile_start, tile_end = tiles[tile_index]
+        indices, distances = _knns_of_tile(features[tile_start:tile_end], features, num_of_neighbours, 0, block_size,
+                                           dots_second=dots)
+        closest_indices[tile_start:tile_end, :indices.shape[1]] = indices
+        closest_distances[tile_start:tile_end, :indices.shape[1]] = distances
+        return tile_index
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for finished, tile_index in enumerate(executor.map(do_tile, range(len(tiles)))):
+            if verbose:
+                print('FINISHED CALCULATING ' + str(finished + 1) + ' OF ' + str(len(tiles)) + ' TILES')
+
+    end = timer()
+    if verbose:
+        print("Spend Time:", "%.3f" % (end - start), "s")
+
+    return closest_indices, np.sqrt(np.abs(closest_distances))
+
+
+def calculate_knn_distances_close_on_probe(template_features_sorted, indices_of_first_and_second_matrices,
+                                           perplexity=100, block_size=8192, max_workers=None, verbose=True):
+    """
+    CPU version of gpu.calculate_knn_distances_close_on_probe. The knns of the samples in every first matrix range
+    are found only amongst the samples of the corresponding second matrix range (the samples close on the probe, see
+    spikes.define_all_spike_spike_matrices_for_distance_calc). Every pair of ranges is a tile done on its own thread.
+    """
+    start = timer()
+
+    indices_of_first_matrices = indices_of_first_and_second_matrices[0]
+    indices_of_second_matrices = indices_of_first_and_second_matrices[1]
+
+    num_of_neighbours = perplexity * 3 + 1
+    features = np.ascontiguousarray(template_features_sorted, dtype=np.float32)
+    closest_indices = np.empty((features.shape[0], num_of_neighbours))
+    closest_distances = np.empty((features.shape[0], num_of_neighbours))
+
+    def do_tile(matrix_index):
+        first_start, first_end = indices_of_first_matrices[matrix_index]
+        second_start, second_end = indices_of_second_matrices[matrix_index]
+        indices, distances = _knns_of_tile(features[first_start:first_end], features[second_start:second_end],
+                                           num_of_neighbours, second_start, block_size)
+        closest_indices[first_start:first_end, :indices.shape[1]] = indices
+        closest_distances[first_start:first_end, :indices.shape[1]] = distances
+        return matrix_index
+
+    number_of_tiles = len(indices_of_first_matrices)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for finished, matrix_index in enumerate(executor.map(do_tile, range(number_of_tiles))):
+            if verbose:
+                print('FINISHED CALCULATING ' + str(finished + 1) + ' OF ' + str(number_of_tiles) + ' ITERATIONS')
+
+    end = timer()
+    if verbose:
+        print("Spend Time:", "%.3f" % (end - start), "s")
+
+    return closest_indices, np.sqrt(np.abs(closest_distances))
+
+
+def calculate_knn_distances_with_tree(template_features_sorted, perplexity=100, indices_of_first_and_second_matrices=None,
+                                      max_workers=-1, verbose=True):
+    """
+    Exact knns with a kd-tree (scipy's cKDTree). This is faster than the brute force distances only for low
+    dimensional features (up to ~20 dimensions). If indices_of_first_and_second_matrices is given the search is
+    constrained to the close on probe ranges like calculate_knn_distances_close_on_probe.
+    The distances are the exact euclidean ones (not the ||a||^2 + ||b||^2 - 2<a,b> float32 approximation).
+    """
+    from scipy.spatial import cKDTree
+
+    start = timer()
+    num_of_neighbours = perplexity * 3 + 1
+    features = np.asarray(template_features_sorted, dtype=np.float64)
+
+    if indices_of_first_and_second_matrices is None:
+        ranges = [((0, features.shape[0]), (0, features.shape[0]))]
+    else:
+        ranges = list(zip(indices_of_first_and_second_matrices[0], indices_of_first_and_second_matrices[1]))
+
+    closest_indices = np.empty((features.shape[0], num_of_neighbours))
+    closest_distances = np.empty((features.shape[0], num_of_neighbours))
+    for (first_start, first_end), (second_start, second_end) in ranges:
+        tree = cKDTree(features[second_start:second_end])
+        k = min(num_of_neighbours, second_end - second_start)
+        distances, indices = tree.query(features[first_start:first_end], k=k, workers=max_workers)
+        distances = np.reshape(distances, (first_end - first_start, k))
+        indices = np.reshape(indices, (first_end - first_start, k))
+        closest_indices[first_start:first_end, :k] = indices + second_start
+        closest_distances[first_start:first_end, :k] = distances
+
+    end = timer()
+    if verbose:
+        print("Spend Time:", "%.3f" % (end - start), "s")
+
+    return closest_indices, closest_distances
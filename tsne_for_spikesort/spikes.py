@@ -1,5 +1,7 @@
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
 import matplotlib.pyplot as plt
 
 
@@ -28,7 +30,8 @@ def _normalize(L, normalizeFrom=0, normalizeTo=1):
 
 
 def generate_probe_positions_of_spikes(base_folder, binary_data_filename, number_of_channels_in_binary_file,
-                                       used_spikes_indices=None, position_mult=2.25, threshold=0.1):
+                                       used_spikes_indices=None, position_mult=2.25, threshold=0.1,
+                                       max_relevant_channels=None, max_memory_per_block=2**27, max_workers=None):
     """
     Generate positions (x, y coordinates) for each spike on the probe. This function assumes that the spikes were
     generated with the kilosort algorithm so the base_folder holds all the necessary .npy arrays.
@@ -58,6 +61,14 @@ def generate_probe_positions_of_spikes(base_folder, binary_data_filename, number
                the number of times the standard deviation should be larger than the difference between a
                channel's minimum and the median of the minima of all channels in order to demarcate the channel as
                relevant to the spike
+    max_relevant_channels : int
+                           if not None only this number of the relevant channels (the ones with the largest
+                           differences, picked with argpartition) are used for each spike
+    max_memory_per_block : int
+                          bytes of raw data windows (int16 as read and float32) held at a time by each thread (this
+                          defines how many spikes are in each block)
+    max_workers : int
+                 number of threads that work on blocks concurrently. If None use the ThreadPoolExecutor default
 
     Returns
     -------
@@ -73,62 +84,95 @@ def generate_probe_positions_of_spikes(base_folder, binary_data_filename, number
     active_channel_map = np.squeeze(channel_map, axis=1)
     channel_positions = np.load(os.path.join(base_folder, 'channel_positions.npy'))
 
-    spike_templates = np.load(os.path.join(base_folder, r'spike_templates.npy'))
+    spike_templates = np.squeeze(np.load(os.path.join(base_folder, r'spike_templates.npy')))
     templates = np.load(os.path.join(base_folder, r'templates.npy'))
 
     data_raw = np.memmap(os.path.join(base_folder, binary_data_filename),
                          dtype=np.int16, mode='r')
 
+    # time x channels view of the raw data (the binary file is time major) so a spike's window is contiguous on disk
     number_of_timepoints_in_raw = int(data_raw.shape[0] / number_of_channels_in_binary_file)
-    data_raw_kilosorted = np.reshape(data_raw, (number_of_channels_in_binary_file, number_of_timepoints_in_raw), order='F')
+    data_raw_kilosorted = np.reshape(data_raw[:number_of_timepoints_in_raw * number_of_channels_in_binary_file],
+                                     (number_of_timepoints_in_raw, number_of_channels_in_binary_file))
 
-    spike_times = np.squeeze(np.load(os.path.join(base_folder, 'spike_times.npy')).astype(np.int))
+    spike_times = np.squeeze(np.load(os.path.join(base_folder, 'spike_times.npy')).astype(np.int64))
 
     time_points = 50
     if used_spikes_indices is None:
         used_spikes_indices = np.arange(0, len(spike_times))
+    used_spikes_indices = np.asarray(used_spikes_indices)
 
-    # Run the loop over all spikes to get the positions
-    counter = 0
-    weighted_average_postions = np.empty((len(used_spikes_indices), 2))
-    spike_distance_on_probe = np.empty(len(used_spikes_indices))
-    for spike_index in np.arange(0, len(used_spikes_indices)):
-        spike_raw_data = data_raw_kilosorted[active_channel_map,
-                                             (spike_times[used_spikes_indices[spike_index]]-time_points):
-                                             (spike_times[used_spikes_indices[spike_index]]+time_points)]
-        template = templates[spike_templates[used_spikes_indices[spike_index]], :, :].squeeze()
-        relevant_channels = _get_relevant_channels_over_median_peaks(threshold, template)
-
-        spike_raw_data_median_over_time = np.median(spike_raw_data, axis=1)
-        peaks_to_median = spike_raw_data_median_over_time - spike_raw_data.min(axis=1)
-        peaks_to_median = peaks_to_median[relevant_channels]
+    # The relevant channels depend only on the template so they are found once per template
+    relevant_channels_of_templates = np.zeros((templates.shape[0], templates.shape[2]), dtype=bool)
+    for template_index in np.unique(spike_templates[used_spikes_indices]):
+        relevant_channels = _get_relevant_channels_over_median_peaks(threshold, templates[template_index])
+        relevant_channels_of_templates[template_index, relevant_channels] = True
 
-        relevant_channels_sorted = [v for (k, v) in sorted(zip(peaks_to_median, relevant_channels), reverse=True)]
-
-        peaks_to_median_sorted = sorted(peaks_to_median, reverse=True)
-        peaks_to_median_sorted.append(np.median(spike_raw_data_median_over_time[relevant_channels]))
+    number_of_channels = len(active_channel_map)
+    # every window element is read as int16 and then converted to float32
+    spikes_per_block = max(1, int(max_memory_per_block / (2 * time_points * number_of_channels * (2 + 4))))
+    blocks = [(i, min(i + spikes_per_block, len(used_spikes_indices)))
+              for i in np.arange(0, len(used_spikes_indices), spikes_per_block)]
 
-        weights = _normalize(peaks_to_median_sorted)[:-1]
-        relevant_channels_positions = channel_positions[relevant_channels_sorted]
+    weighted_average_postions = np.empty((len(used_spikes_indices), 2))
+    window = np.arange(-time_points, time_points)
 
-        pos_x = relevant_channels_positions[0, 0]
-        pos_y = relevant_channels_positions[0, 1]
+    def positions_of_block(block):
+        block_start, block_end = block
+        block_spikes = used_spikes_indices[block_start:block_end]
 
-        new_pos_x = pos_x - np.mean(((pos_x - relevant_channels_positions[:, 0]) * weights)[1:])
-        new_pos_y = pos_y - np.mean(((pos_y - relevant_channels_positions[:, 1]) * weights)[1:])
-        weighted_average_postions[spike_index, :] = [new_pos_x, new_pos_y]
-        spike_distance_on_probe[spike_index] = np.sqrt(np.power(new_pos_x, 2) + np.power(new_pos_y, 2))
+        # spikes x time x channels windows of the raw data (only the active channels are read)
+        time_indices = np.clip(spike_times[block_spikes][:, np.newaxis] + window, 0, number_of_timepoints_in_raw - 1)
+        spike_raw_data = data_raw_kilosorted[time_indices[:, :, np.newaxis], active_channel_map].astype(np.float32)
 
-        counter += 1
-        if counter % 5000 == 0:
-            print('Completed ' + str(counter) + ' spikes')
+        spike_raw_data_median_over_time = np.median(spike_raw_data, axis=1)
+        peaks_to_median = spike_raw_data_median_over_time - spike_raw_data.min(axis=1)
+        del spike_raw_data
+
+        # Equal peaks are ordered by channel, the highest first, like sorted(zip(peaks, channels), reverse=True) of
+        # the single spike version
+        relevant = relevant_channels_of_templates[spike_templates[block_spikes]]
+        if max_relevant_channels is not None and max_relevant_channels < number_of_channels:
+            masked_peaks = np.where(relevant, peaks_to_median, -np.inf)
+            top_channels = number_of_channels - 1 - \
+                np.argsort(-masked_peaks[:, ::-1], axis=1, kind='stable')[:, :max_relevant_channels]
+            top = np.zeros(relevant.shape, dtype=bool)
+            np.put_along_axis(top, top_channels, True, axis=1)
+            relevant &= top
+
+        # The weights normalise the peaks of the relevant channels together with the median over the relevant
+        # channels of the medians over time (between 0 and 1)
+        medians_of_relevant = np.nanmedian(np.where(relevant, spike_raw_data_median_over_time, np.nan), axis=1)
+        v_max = np.maximum(np.max(np.where(relevant, peaks_to_median, -np.inf), axis=1), medians_of_relevant)
+        v_min = np.minimum(np.min(np.where(relevant, peaks_to_median, np.inf), axis=1), medians_of_relevant)
+        weights = (peaks_to_median - v_min[:, np.newaxis]) / (v_max - v_min)[:, np.newaxis]
+        weights[~relevant] = 0
+
+        # The position of the largest peak channel moved by the mean of the weighted position differences of the
+        # other relevant channels
+        largest_peak_channels = number_of_channels - 1 - \
+            np.argmax(np.where(relevant, peaks_to_median, -np.inf)[:, ::-1], axis=1)
+        largest_peak_positions = channel_positions[largest_peak_channels]
+        weighted_differences = np.einsum('sc,scd->sd', weights,
+                                         largest_peak_positions[:, np.newaxis, :] - channel_positions[np.newaxis, :, :])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weighted_average_postions[block_start:block_end] = largest_peak_positions - \
+                weighted_differences / (np.sum(relevant, axis=1) - 1)[:, np.newaxis]
+        return block_end
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        reported = 0
+        for block_end in executor.map(positions_of_block, blocks):
+            if block_end - reported >= 5000 or block_end == len(used_spikes_indices):
+                print('Completed ' + str(block_end) + ' spikes')
+                reported = block_end
+
+    spike_distance_on_probe = np.sqrt(np.sum(np.power(weighted_average_postions, 2), axis=1))
     weighted_average_postions = weighted_average_postions * position_mult
 
     # sort according to position on probe
-    spike_indices_sorted_by_probe_distance = np.array([b[0] for b in sorted(enumerate(spike_distance_on_probe),
-                                                                            key=lambda dist: dist[1])])
-    spike_distances_on_probe_sorted = np.array([b[1] for b in sorted(enumerate(spike_distance_on_probe),
-                                                                     key=lambda dist: dist[1])])
+    spike_indices_sorted_by_probe_distance = np.argsort(spike_distance_on_probe, kind='stable')
+    spike_distances_on_probe_sorted = spike_distance_on_probe[spike_indices_sorted_by_probe_distance]
 
     return weighted_average_postions, spike_distance_on_probe, \
         spike_indices_sorted_by_probe_distance, spike_distances_on_probe_sorted
@@ -207,6 +251,61 @@ def generate_probe_positions_of_templates(base_folder, binary_data_filename, num
     return np.array(templates_positions)
 
 
+def generate_template_features_matrix(spike_templates, template_features, template_feature_ind, used_templates=None,
+                                      spikes_per_chunk=None):
+    """
+    Generate the sparse spikes x templates matrix of the kilosort template features (the input to the t-sne).
+    Spike s has the feature template_features[s, i] at the column of the template template_feature_ind[t, i], where t
+    is the spike's template (spike_templates[s]).
+
+    Parameters
+    ----------
+    spike_templates : (np.array(N)) the template of each spike (kilosort's spike_templates.npy)
+    template_features : (np.array((N, F))) the features of each spike (kilosort's template_features.npy). This can
+                        be a memmap (np.load(..., mmap_mode='r'))
+    template_feature_ind : (np.array((T, F))) the templates each of a template's features refers to (kilosort's
+                           template_feature_ind.npy)
+    used_templates : (np.array) the indices of the templates to keep (e.g. np.argwhere(template_marking)). Only the
+                     spikes of these templates are kept (rows) and only the features on these templates (columns).
+                     If None all templates are used
+    spikes_per_chunk : (int) if not None the features are read and turned into a sparse matrix this number of spikes
+                       at a time (for recordings with millions of spikes)
+
+    Returns
+    -------
+    template_features_sparse : (scipy.sparse.csr_matrix) the used spikes x used templates features matrix
+    used_spikes_indices : (np.array) the indices of the spikes that are the rows of the matrix
+    """
+    spike_templates = np.squeeze(spike_templates)
+    number_of_templates = template_feature_ind.shape[0]
+    if used_templates is None:
+        used_templates = np.arange(number_of_templates)
+    used_templates = np.squeeze(used_templates).reshape(-1)
+
+    # column of each template in the matrix (-1 for templates not used)
+    column_of_template = -np.ones(number_of_templates, dtype=np.int64)
+    column_of_template[used_templates] = np.arange(len(used_templates))
+    columns_of_features = column_of_template[template_feature_ind]
+
+    used_spikes_indices = np.squeeze(np.argwhere(column_of_template[spike_templates] >= 0)).reshape(-1)
+    if spikes_per_chunk is None:
+        spikes_per_chunk = max(len(used_spikes_indices), 1)
+
+    chunks = []
+    for chunk_start in np.arange(0, len(used_spikes_indices), spikes_per_chunk):
+        chunk_spikes = used_spikes_indices[chunk_start:chunk_start + spikes_per_chunk]
+        columns = columns_of_features[spike_templates[chunk_spikes]]
+        features = np.asarray(template_features[chunk_spikes])
+        kept = columns >= 0
+        rows = np.broadcast_to(np.arange(len(chunk_spikes))[:, np.newaxis], columns.shape)
+        chunks.append(sparse.csr_matrix((features[kept], (rows[kept], columns[kept])),
+                                        shape=(len(chunk_spikes), len(used_templates))))
+
+    if len(chunks) == 0:
+        return sparse.csr_matrix((0, len(used_templates))), used_spikes_indices
+    return sparse.vstack(chunks, format='csr'), used_spikes_indices
+
+
 def view_spike_positions(spike_positions, brain_regions, probe_dimensions, labels_offset=80, font_size=20):
     """
     Plot the spike positions as a scatter plot on a probe marked with brain regions
@@ -270,7 +369,7 @@ def create_indices_for_difference_comparison(spike_indices_sorted_by_probe_dista
 
 
 def define_spike_spike_matrix_for_distance_calc(spike_probe_distances_sorted, starting_index, max_elements_in_matrix,
-                                                probe_distance_threshold=100):
+                                                probe_distance_threshold=100, indices_of_second_arrays=None):
     """
     Define the two spikes-features matrices that are going to be compared by the generate_probe_positions_of_spikes()
     function to find the distances of all the spikes of the first matrix to all the spikes of the second.
@@ -286,6 +385,8 @@ def define_spike_spike_matrix_for_distance_calc(spike_probe_distances_sorted, st
     Those matrices should have the spikes from starting_index to final_index_of_first_array for the first one and from
     starting_index to final_index_of_second_array for the second one.
     IMPORTANT NOTE: All these indices are the ones after the spikes are sorted according to distance on the probe!
+    Because the distances are sorted, both the index of the last spike of the second array and the number of elements
+    grow with the last index of the first array, so the final index is found with a search over a growing window.
 
     Parameters
     ----------
@@ -294,6 +395,7 @@ def define_spike_spike_matrix_for_distance_calc(spike_probe_distances_sorted, st
     max_elements_in_matrix: (int) the number of spike spike distances the gpu will be able to work with
     (GPU memory < 4 * max_elements_in_matrix)
     probe_distance_threshold: (float) the probe distance over which spikes don't need to have their distances calculated
+    indices_of_second_arrays: (np.array(N)) the result of _indices_of_second_arrays (calculated if None)
 
     Returns
     -------
@@ -302,28 +404,74 @@ def define_spike_spike_matrix_for_distance_calc(spike_probe_distances_sorted, st
     final_index_of_second_array: (int) the spike index of the spikes sorted according to probe distance of the last spike
     to be included in the second spike-features matrix
     """
-    current_elements_in_matrix = 0
-    final_index_of_first_array = starting_index
-    while max_elements_in_matrix >= current_elements_in_matrix:
-        spike_probe_distances_sorted_shifted = spike_probe_distances_sorted - \
-                                                    spike_probe_distances_sorted[final_index_of_first_array]
-        final_index_of_second_array = (
-            np.abs(spike_probe_distances_sorted_shifted - probe_distance_threshold)).argmin()
-        current_elements_in_matrix = (final_index_of_second_array - starting_index) * \
-                                     (final_index_of_first_array - starting_index)
-        final_index_of_first_array += 1
+    number_of_spikes = spike_probe_distances_sorted.shape[0]
+    if indices_of_second_arrays is None:
+        indices_of_second_arrays = _indices_of_second_arrays(spike_probe_distances_sorted, probe_distance_threshold)
+
+    # the first index of the first array whose matrix has more elements than max_elements_in_matrix. The window looked
+    # at doubles until that index is in it, so the work is proportional to the size of the block (the running maximum
+    # keeps the search right even if the elements are not monotonic because of equal probe distances)
+    window = 64
+    while True:
+        window_end = min(starting_index + window, number_of_spikes)
+        first_indices = np.arange(starting_index, window_end)
+        elements_in_matrix = (indices_of_second_arrays[starting_index:window_end] - starting_index) * \
+                             (first_indices - starting_index)
+        over_max = np.searchsorted(np.maximum.accumulate(elements_in_matrix), max_elements_in_matrix, side='right')
+        if over_max < window_end - starting_index or window_end == number_of_spikes:
+            break
+        window *= 2
+    final_index_of_first_array = starting_index + over_max
+
+    if final_index_of_first_array >= number_of_spikes - 1:
+        return number_of_spikes, number_of_spikes
+
+    return final_index_of_first_array + 1, indices_of_second_arrays[final_index_of_first_array]
+
+
+def _indices_of_second_arrays(spike_probe_distances_sorted, probe_distance_threshold):
+    """
+    For every spike the index of the spike whose probe distance is the closest to the spike's one plus
+    probe_distance_threshold (the first one of equally close spikes, like np.argmin). O(N log N) with searchsorted
+    instead of an argmin over all the spikes for each spike.
+    """
+    distances = spike_probe_distances_sorted
+    targets = distances + probe_distance_threshold
+    right = np.clip(np.searchsorted(distances, targets, side='left'), 0, len(distances) - 1)
+    left = np.clip(right - 1, 0, len(distances) - 1)
+    left_is_closer = np.abs(distances[left] - targets) <= np.abs(distances[right] - targets)
+    closest = np.where(left_is_closer, left, right)
+    # the first occurrence of the closest distance
+    return np.searchsorted(distances, distances[closest], side='left')
+
+
+def memory_per_block(indices_of_first_matrices, indices_of_second_matrices, bytes_per_element=4):
+    """
+    The bytes needed for the distances matrix of each pair of first and second matrices (bytes_per_element = 4 for the
+    float32 distances of gpu.py and cpu.py)
+    """
+    first = np.array(indices_of_first_matrices)
+    second = np.array(indices_of_second_matrices)
+    return (first[:, 1] - first[:, 0]) * (second[:, 1] - second[:, 0]) * bytes_per_element
 
-        if final_index_of_first_array == spike_probe_distances_sorted.shape[0]:   # - 1:
-            final_index_of_second_array = final_index_of_first_array
-            #final_index_of_second_array = (
-            #    np.abs(spike_probe_distances_sorted_shifted - probe_distance_threshold)).argmin()
-            return final_index_of_first_array, final_index_of_second_array
 
-    return final_index_of_first_array, final_index_of_second_array
+def define_all_spike_spike_matrices_for_distance_calc(spike_probe_distances_sorted, max_elements_in_matrix=None,
+                                                      probe_distance_threshold=100, memory_budget=None,
+                                                      bytes_per_element=4, verbose=True):
+    """
+    Splits the spikes (sorted by probe distance) into the first and second matrices whose distances are calculated
+    (see define_spike_spike_matrix_for_distance_calc).
+    The size of the blocks is given either by max_elements_in_matrix or by memory_budget (in bytes, e.g. a cpu cache
+    size or an amount of RAM, with bytes_per_element bytes for each spike spike distance).
+    Use memory_per_block on the results to see the memory each block will need.
+    """
+    if max_elements_in_matrix is None:
+        if memory_budget is None:
+            raise ValueError('Either max_elements_in_matrix or memory_budget must be given')
+        max_elements_in_matrix = int(memory_budget / bytes_per_element)
 
+    indices_of_second_arrays = _indices_of_second_arrays(spike_probe_distances_sorted, probe_distance_threshold)
 
-def define_all_spike_spike_matrices_for_distance_calc(spike_probe_distances_sorted, max_elements_in_matrix,
-                                                      probe_distance_threshold=100):
     starting_index = 0
     indices_of_first_matrices = []
     indices_of_second_matrices = []
@@ -332,13 +480,16 @@ def define_all_spike_spike_matrices_for_distance_calc(spike_probe_distances_sort
         fifa, fisa = define_spike_spike_matrix_for_distance_calc(spike_probe_distances_sorted,
                                                                  starting_index=starting_index,
                                                                  max_elements_in_matrix=max_elements_in_matrix,
-                                                                 probe_distance_threshold=probe_distance_threshold)
+                                                                 probe_distance_threshold=probe_distance_threshold,
+                                                                 indices_of_second_arrays=indices_of_second_arrays)
         indices_of_first_matrices.append((starting_index, fifa))
         indices_of_second_matrices.append((starting_index, fisa))
 
-        print("Matrices defined with starting index: " + str(starting_index) + ", first matrix last index: " +
-              str(indices_of_first_matrices[-1][1]) + " and second matrix last index: "
-              + str(indices_of_second_matrices[-1][1]))
+        if verbose:
+            print("Matrices defined with starting index: " + str(starting_index) + ", first matrix last index: " +
+                  str(indices_of_first_matrices[-1][1]) + " and second matrix last index: "
+                  + str(indices_of_second_matrices[-1][1]) + " (" +
+                  str((fifa - starting_index) * (fisa - starting_index) * bytes_per_element) + " bytes)")
 
         starting_index = fifa + 1
 
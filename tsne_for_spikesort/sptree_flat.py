@@ -0,0 +1,295 @@
+
+import numpy as np
+from numba import njit, prange
+from scipy import sparse
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Array based version of sptree.SPTree. The nodes of the tree are rows of contiguous arrays (centers of mass, cell
+# centers, half widths, cumulative sizes, child indices) instead of one python object per node, the tree is built
+# level by level with a counting sort of the points into the children of each node and the force computations are
+# iterative numba loops run in parallel over the points.
+
+MAX_DEPTH = 64
+
+
+@njit(cache=True)
+def _grow(array, new_size):
+    grown = np.empty((new_size,) + array.shape[1:], dtype=array.dtype)
+    grown[:array.shape[0]] = array
+    return grown
+
+
+@njit(cache=True)
+def _build_tree(data, max_depth):
+    num_of_points, dimension = data.shape
+    num_children = 2 ** dimension
+
+    permutation = np.arange(num_of_points)
+    scratch = np.empty(num_of_points, dtype=np.int64)
+
+    capacity = 2 * num_of_points + 1
+    center_of_mass = np.zeros((capacity, dimension))
+    cell_center = np.zeros((capacity, dimension))
+    half_width = np.zeros((capacity, dimension))
+    cum_size = np.zeros(capacity, dtype=np.int64)
+    children = -np.ones((capacity, num_children), dtype=np.int64)
+    is_leaf = np.ones(capacity, dtype=np.bool_)
+    start = np.zeros(capacity, dtype=np.int64)
+    end = np.zeros(capacity, dtype=np.int64)
+    depth = np.zeros(capacity, dtype=np.int64)
+
+    # root cell covering all the data
+    for dim in range(dimension):
+        min_of_data = np.min(data[:, dim])
+        max_of_data = np.max(data[:, dim])
+        cell_center[0, dim] = (max_of_data + min_of_data) / 2
+        half_width[0, dim] = (max_of_data - min_of_data) / 2 * (1 + 1e-5) + 1e-10
+    end[0] = num_of_points
+    node_count = 1
+    tree_depth = 1
+
+    counts = np.zeros(num_children, dtype=np.int64)
+    offsets = np.zeros(num_children, dtype=np.int64)
+    codes = np.empty(num_of_points, dtype=np.int64)
+
+    # nodes are appended in breadth first order, so going through them in order processes every level in turn
+    node = 0
+    while node < node_count:
+        node_start = start[node]
+        node_end = end[node]
+        cum_size[node] = node_end - node_start
+        for i in range(node_start, node_end):
+            for dim in range(dimension):
+                center_of_mass[node, dim] += data[permutation[i], dim]
+        for dim in range(dimension):
+            center_of_mass[node, dim] /= cum_size[node]
+
+        if cum_size[node] <= 1 or depth[node] >= max_depth:
+            node += 1
+            continue
+
+        # do not subdivide cells of duplicate points
+        all_same = True
+        first = permutation[node_start]
+        for i in range(node_start + 1, node_end):
+            for dim in range(dimension):
+                if data[permutation[i], dim] != data[first, dim]:
+                    all_same = False
+                    break
+            if not all_same:
+                break
+        if all_same:
+            node += 1
+            continue
+
+        # counting sort of the node's points by the child cell they fall in
+        counts[:] = 0
+        for i in range(node_start, node_end):
+            code = 0
+            for dim in range(dimension):
+                if data[permutation[i], dim] >= cell_center[node, dim]:
+                    code += 1 << dim
+            codes[i] = code
+            counts[code] += 1
+        position = node_start
+        for child in range(num_children):
+            offsets[child] = position
+            position += counts[child]
+        for i in range(node_start, node_end):
+            scratch[offsets[codes[i]]] = permutation[i]
+            offsets[codes[i]] += 1
+        permutation[node_start:node_end] = scratch[node_start:node_end]
+
+        if node_count + num_children > capacity:
+            capacity = 2 * capacity
+            center_of_mass = _grow(center_of_mass, capacity)
+            cell_center = _grow(cell_center, capacity)
+            half_width = _grow(half_width, capacity)
+            cum_size = _grow(cum_size, capacity)
+            old_capacity = children.shape[0]
+            children = _grow(children, capacity)
+            children[old_capacity:] = -1
+            is_leaf = _grow(is_leaf, capacity)
+            is_leaf[old_capacity:] = True
+            start = _grow(start, capacity)
+            end = _grow(end, capacity)
+            depth = _grow(depth, capacity)
+            center_of_mass[old_capacity:] = 0
+
+        is_leaf[node] = False
+        position = node_start
+        for child in range(num_children):
+            if counts[child] == 0:
+                continue
+            new_node = node_count
+            node_count += 1
+            children[node, child] = new_node
+            for dim in range(dimension):
+                half_width[new_node, dim] = half_width[node, dim] / 2
+                if (child >> dim) & 1:
+                    cell_center[new_node, dim] = cell_center[node, dim] + half_width[new_node, dim]
+                else:
+                    cell_center[new_node, dim] = cell_center[node, dim] - half_width[new_node, dim]
+            start[new_node] = position
+            end[new_node] = position + counts[child]
+            depth[new_node] = depth[node] + 1
+            if depth[new_node] + 1 > tree_depth:
+                tree_depth = depth[new_node] + 1
+            position += counts[child]
+        node += 1
+
+    return center_of_mass[:node_count], cell_center[:node_count], half_width[:node_count], cum_size[:node_count], \
+        children[:node_count], is_leaf[:node_count], start[:node_count], end[:node_count], permutation, tree_depth
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _compute_non_edge_forces(queries, theta, center_of_mass, max_width, cum_size, children, is_leaf, start, end,
+                             position_of_point, stack_size, neg_force, sum_q_of_point):
+    # position_of_point is the position of each query in the tree's permutation (-1 for queries not in the tree)
+    num_of_points, dimension = queries.shape
+    num_children = children.shape[1]
+    theta_squared = theta * theta
+    for point_index in prange(num_of_points):
+        stack = np.empty(stack_size, dtype=np.int64)
+        force = np.zeros(dimension)
+        buffer = np.empty(dimension)
+        sum_q = 0.0
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+
+            # Make sure that we spend no time on empty nodes or self-interactions
+            size = cum_size[node]
+            if is_leaf[node] and start[node] <= position_of_point[point_index] < end[node]:
+                size -= 1
+            if size == 0:
+                continue
+
+            # Compute distance between point and center-of-mass
+            distance = 0.0
+            for dim in range(dimension):
+                buffer[dim] = queries[point_index, dim] - center_of_mass[node, dim]
+                distance += buffer[dim] * buffer[dim]
+
+            # Check whether we can use this node as a "summary" (max_width / sqrt(distance) < theta)
+            if is_leaf[node] or max_width[node] * max_width[node] < theta_squared * distance:
+                q = 1.0 / (1.0 + distance)
+                mult = size * q
+                sum_q += mult
+                mult *= q
+                for dim in range(dimension):
+                    force[dim] += mult * buffer[dim]
+            else:
+                for child in range(num_children):
+                    if children[node, child] >= 0:
+                        stack[top] = children[node, child]
+                        top += 1
+        for dim in range(dimension):
+            neg_force[point_index, dim] = force[dim]
+        sum_q_of_point[point_index] = sum_q
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _compute_edge_forces(queries, data, row_p, col_p, val_p, pos_force):
+    # row n of the csr arrays has the p values between queries[n] and the data points
+    num_of_points, dimension = queries.shape
+    for n in prange(num_of_points):
+        for i in range(row_p[n], row_p[n + 1]):
+            j = col_p[i]
+            distance = 1.0
+            for dim in range(dimension):
+                difference = queries[n, dim] - data[j, dim]
+                distance += difference * difference
+            mult = val_p[i] / distance
+            for dim in range(dimension):
+                pos_force[n, dim] += mult * (queries[n, dim] - data[j, dim])
+
+
+class FlatSPTree:
+    """
+    Barnes-Hut space partitioning tree (quadtree for 2D, octree for 3D data) held in flat arrays.
+    Node 0 is the root. For every node:
+    center_of_mass, cell_center, half_width -- (nodes x dimension) arrays
+    cum_size -- number of points under the node
+    children -- (nodes x 2^dimension) indices of the children nodes (-1 for empty children)
+    is_leaf -- True for the nodes that have not been subdivided
+    start, end -- the node's points are permutation[start:end]
+    """
+    def __init__(self, inp_data, max_depth=MAX_DEPTH):
+        assert np.ndim(inp_data) == 2
+
+        self.data = np.ascontiguousarray(inp_data, dtype=np.float64)
+        self.num_of_points, self.dimension = self.data.shape
+        self.num_children = 2 ** self.dimension
+
+        self.center_of_mass, self.cell_center, self.half_width, self.cum_size, self.children, self.is_leaf, \
+            self.start, self.end, self.permutation, self.depth = _build_tree(self.data, max_depth)
+
+        self.max_width = np.max(self.half_width, axis=1)
+        self.position_of_point = np.empty(self.num_of_points, dtype=np.int64)
+        self.position_of_point[self.permutation] = np.arange(self.num_of_points)
+
+    def get_depth(self):
+        return self.depth
+
+    def get_all_indices(self):
+        return self.permutation.copy()
+
+    def is_correct(self):
+        for node in np.arange(len(self.cum_size)):
+            points = self.data[self.permutation[self.start[node]:self.end[node]]]
+            if np.any(points < self.cell_center[node] - self.half_width[node]) or \
+                    np.any(points >= self.cell_center[node] + self.half_width[node]):
+                return False
+        return True
+
+    def compute_non_edge_forces(self, theta):
+        """
+        Returns the (N x dimension) repulsive forces (not yet divided by sum_q) and sum_q
+        """
+        neg_force, sum_q_of_point = self.compute_non_edge_forces_on(self.data, theta, self.position_of_point)
+        return neg_force, np.sum(sum_q_of_point)
+
+    def compute_non_edge_forces_on(self, points, theta, position_of_point=None):
+        """
+        Repulsive forces that the tree's points exert on other (M x dimension) points (e.g. new points embedded in
+        a fixed map). Returns the (M x dimension) forces (not yet divided by sum_q) and the (M) sum_q of each point
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        if position_of_point is None:
+            position_of_point = -np.ones(len(points), dtype=np.int64)
+        neg_force = np.zeros((len(points), self.dimension))
+        sum_q_of_point = np.zeros(len(points))
+        stack_size = self.depth * self.num_children + 1
+        _compute_non_edge_forces(points, theta, self.center_of_mass, self.max_width, self.cum_size, self.children,
+                                 self.is_leaf, self.start, self.end, position_of_point, stack_size, neg_force,
+                                 sum_q_of_point)
+        return neg_force, sum_q_of_point
+
+    def compute_edge_forces(self, indices_p, values_p=None, points=None):
+        """
+        Attractive forces. indices_p is either a scipy.sparse (csr) P matrix (then values_p is not used) or the
+        (N x k) indices of the knns with values_p their (N x k) p values.
+        If points is given the rows of P are for these (M x dimension) points (not the tree's ones) and the columns
+        for the tree's points
+        """
+        if points is None:
+            points = self.data
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        if sparse.issparse(indices_p):
+            p = indices_p.tocsr()
+            row_p = p.indptr.astype(np.int64)
+            col_p = p.indices.astype(np.int64)
+            val_p = p.data.astype(np.float64)
+        else:
+            n, k = np.shape(indices_p)
+            row_p = np.arange(0, n * k + 1, k, dtype=np.int64)
+            col_p = np.ravel(indices_p).astype(np.int64)
+            val_p = np.ravel(values_p).astype(np.float64)
+
+        pos_force = np.zeros((len(points), self.dimension))
+        _compute_edge_forces(points, self.data, row_p, col_p, val_p, pos_force)
+        return pos_force
@@ -1,24 +1,47 @@
 import sys
 import time
+import hashlib
 
 import matplotlib.pylab as pylab
 import numpy as np
+from scipy import sparse
 
-from tsne_for_spikesort import gpu
-from tsne_for_spikesort import sptree_jit as sptree
+try:
+    from tsne_for_spikesort import gpu
+except ImportError:  # no cuda (numba.cuda / accelerate), only the cpu knn is available
+    gpu = None
+from tsne_for_spikesort import cpu
+from tsne_for_spikesort import sptree_flat
 
 # import tsne_for_spikesort.spikesorttsne as sptsne
 import tsne_for_spikesort.io_with_cpp as io
 
 from subprocess import Popen, PIPE
 
-from os import replace
-from os.path import join as path_join
+from os import replace, fsync
+from os.path import isfile, join as path_join
 import sys
 
 
 def run(data, indices_of_first_and_second_matrices, intermediate_file_dir, iters, perplexity, eta=200, num_dims=2,
-        theta=0.2, verbose=True, exe_dir=None):
+        theta=0.2, verbose=True, exe_dir=None, knn_method='gpu', optimizer='exe', callback=None,
+        checkpoint_file=None, checkpoint_every=50):
+    """
+    knn_method -- 'gpu' (cuda), 'cpu' (blocked BLAS distances on a thread pool) or 'tree' (exact kd-tree search, for
+    low dimensional data). All are constrained to the close on probe indices_of_first_and_second_matrices.
+    optimizer -- 'exe' runs the iterations in the Barnes_Hut executable (through files in intermediate_file_dir),
+    'python' runs them in this process (run_iterations_with_python, intermediate_file_dir is not used)
+    callback -- for the 'python' optimizer, called as callback(iteration, y, error) after every iteration
+    checkpoint_file -- for the 'python' optimizer, the file the optimizer state is saved in every checkpoint_every
+    iterations. If it exists (and was made from the same data) the run resumes from it (without recalculating the knns
+    and the P matrix)
+    """
+    data_hash = hash_samples(data) if checkpoint_file is not None else None
+    if optimizer == 'python' and checkpoint_file is not None and isfile(checkpoint_file):
+        # y and p are loaded from the checkpoint
+        return run_iterations_with_python(None, None, theta=theta, eta=eta, iterations=iters,
+                                          verbose=verbose, callback=callback, checkpoint_file=checkpoint_file,
+                                          checkpoint_every=checkpoint_every, samples_hash=data_hash)
 
     # zero mean input data
     data = pylab.demean(data, axis=0)
@@ -33,16 +56,48 @@ def run(data, indices_of_first_and_second_matrices, intermediate_file_dir, iters
 
     # find distances in hd space and sort
     s1 = time.time()
-    closest_indices_in_hd, closest_distances_in_hd = \
-        gpu.calculate_knn_distances_close_on_probe(template_features_sorted=data,
-                                                   indices_of_first_and_second_matrices=
-                                                   indices_of_first_and_second_matrices,
-                                                   perplexity=perplexity,
-                                                   verbose=verbose)
+    if knn_method == 'gpu':
+        if gpu is None:
+            raise ImportError("The gpu knn needs numba.cuda and accelerate. Use knn_method='cpu' instead")
+        knn_module = gpu
+    elif knn_method == 'cpu':
+        knn_module = cpu
+    elif knn_method == 'tree':
+        knn_module = None
+    else:
+        raise ValueError("knn_method must be 'gpu', 'cpu' or 'tree'")
+    if knn_module is None:
+        closest_indices_in_hd, closest_distances_in_hd = \
+            cpu.calculate_knn_distances_with_tree(template_features_sorted=data, perplexity=perplexity,
+                                                  indices_of_first_and_second_matrices=
+                                                  indices_of_first_and_second_matrices,
+                                                  verbose=verbose)
+    else:
+        closest_indices_in_hd, closest_distances_in_hd = \
+            knn_module.calculate_knn_distances_close_on_probe(template_features_sorted=data,
+                                                              indices_of_first_and_second_matrices=
+                                                              indices_of_first_and_second_matrices,
+                                                              perplexity=perplexity,
+                                                              verbose=verbose)
     e1 = time.time()
     if verbose > 1:
         print('Time for Knn distance calculation: ' + str(e1 - s1))
 
+    if optimizer == 'python':
+        p = _compute_gaussian_perplexity_csr(closest_indices_in_hd, closest_distances_in_hd, perplexity=perplexity)
+        y = np.random.random((num_samples, num_dims)) * 0.0001
+        s2 = time.time()
+        y = run_iterations_with_python(y, p, theta=theta, eta=eta, iterations=iters, verbose=verbose,
+                                       callback=callback, checkpoint_file=checkpoint_file,
+                                       checkpoint_every=checkpoint_every, samples_hash=data_hash)
+        e2 = time.time()
+        if verbose > 1:
+            print('Time for calculating the t-sne data: ' + str(e2 - s2))
+            print('Time for total calculation: ' + str(e2 - s1))
+        return y
+    elif optimizer != 'exe':
+        raise ValueError("optimizer must be 'exe' or 'python'")
+
     # compute_gaussian_perplexity
     indices_p, values_p = _compute_gaussian_perplexity(closest_indices_in_hd, closest_distances_in_hd,
                                                        perplexity=perplexity)
@@ -63,8 +118,6 @@ def run(data, indices_of_first_and_second_matrices, intermediate_file_dir, iters
 
     s2 = time.time()
 
-    #y = run_iterations_with_python(iters, indices_p, values_p, eta, verbose)
-
     #y = run_iterations_with_cython(y, num_samples, num_dims, indices_p, values_p, num_knns, perplexity,
     #                               theta, eta, iters, verbose)
 
@@ -81,121 +134,307 @@ def run(data, indices_of_first_and_second_matrices, intermediate_file_dir, iters
 
 
 def _compute_gaussian_perplexity(selected_sorted_indices, selected_sorted_distances,
-                                 perplexity=100):
-    k = selected_sorted_indices.shape[1]
+                                 perplexity=100, tolerance=1e-5, max_iterations=200):
+    """
+    Finds for every spike the beta (precision of the gaussian) that gives the required perplexity over its knn
+    distances. The bisection runs on all the spikes at once. Each iteration updates the betas of the spikes that have
+    not converged yet (the converged ones are masked out of the next iterations).
+
+    Returns the (n x k) indices and conditional p values of the knns
+    """
     n = selected_sorted_indices.shape[0]
     dbl_min = sys.float_info[3]
     dbl_max = sys.float_info[0]
-
-    ind_p = selected_sorted_indices.astype(np.int)
-    val_p = np.empty((n, k))
-    for spike in np.arange(n):
-        beta = 1.0
-        found = False
-        min_beta = -dbl_max
-        max_beta = dbl_max
-        tolerance = 1e-5
-
-        iter = 0
-        sum_p = 0
-        while not found and iter < 200:
-            cur_distances = selected_sorted_distances[spike, :]
-            cur_p = np.exp(-beta * cur_distances)
-            sum_p = dbl_min + np.sum(cur_p)
-            H = np.sum(beta * cur_distances * cur_p) / sum_p + np.log(sum_p)
-
-            H_diff = H - np.log(perplexity)
-            if H_diff < tolerance and -H_diff < tolerance:
-                found = True
-            else:
-                if H_diff > 0:
-                    min_beta = beta
-                    if max_beta == dbl_max or max_beta == -dbl_max:
-                        beta *= 2.0
-                    else:
-                        beta = (beta + max_beta) / 2.0
-                else:
-                    max_beta = beta
-                    if min_beta == -dbl_max or min_beta == dbl_max:
-                        beta /= 2.0
-                    else:
-                        beta = (beta + min_beta) / 2.0
-            iter += 1
-
-        cur_p /= sum_p
-
-        val_p[spike, :] = cur_p
+    log_perplexity = np.log(perplexity)
+
+    ind_p = selected_sorted_indices.astype(np.int64)
+    distances = np.asarray(selected_sorted_distances, dtype=np.float64)
+    val_p = np.empty(distances.shape)
+
+    beta = np.ones(n)
+    min_beta = np.full(n, -dbl_max)
+    max_beta = np.full(n, dbl_max)
+    active = np.arange(n)
+
+    for iteration in np.arange(max_iterations):
+        if active.size == 0:
+            break
+        cur_distances = distances[active]
+        cur_beta = beta[active]
+        cur_p = np.exp(-cur_beta[:, np.newaxis] * cur_distances)
+        sum_p = dbl_min + np.sum(cur_p, axis=1)
+        H = cur_beta * np.sum(cur_distances * cur_p, axis=1) / sum_p + np.log(sum_p)
+        val_p[active] = cur_p / sum_p[:, np.newaxis]
+
+        H_diff = H - log_perplexity
+        found = np.abs(H_diff) < tolerance
+
+        too_flat = ~found & (H_diff > 0)
+        rows = active[too_flat]
+        min_beta[rows] = beta[rows]
+        beta[rows] = np.where(max_beta[rows] == dbl_max, beta[rows] * 2.0, (beta[rows] + max_beta[rows]) / 2.0)
+
+        too_peaked = ~found & (H_diff <= 0)
+        rows = active[too_peaked]
+        max_beta[rows] = beta[rows]
+        beta[rows] = np.where(min_beta[rows] == -dbl_max, beta[rows] / 2.0, (beta[rows] + min_beta[rows]) / 2.0)
+
+        active = active[~found]
 
     return ind_p, val_p
 
 
-def _compute_gradient_on_cpu_with_sptree(t_sne, indices_p, values_p, theta):
-
-    dimension = t_sne.shape[1]
-    num_of_points = t_sne.shape[0]
-    neg_forces = np.zeros((num_of_points, dimension))
-    sum_q = [0.0]
+def _compute_gaussian_perplexity_csr(selected_sorted_indices, selected_sorted_distances, perplexity=100):
+    """
+    The symmetrised and normalised P matrix ((P + P.T) / sum) of the knns as a scipy.sparse csr matrix.
+    This is what the Barnes_Hut exe builds from the (n x k) indices and values of _compute_gaussian_perplexity.
+    """
+    ind_p, val_p = _compute_gaussian_perplexity(selected_sorted_indices, selected_sorted_distances,
+                                                perplexity=perplexity)
+    n, k = ind_p.shape
+    conditional_p = sparse.csr_matrix((val_p.ravel(), ind_p.ravel(), np.arange(0, n * k + 1, k)), shape=(n, n))
+    p = (conditional_p + conditional_p.T).tocsr()
+    p.sum_duplicates()
+    p.data /= np.sum(p.data)
+    return p
 
-    tree = sptree.SPTree(inp_dimension=dimension, inp_data=t_sne, inp_num_of_points=num_of_points)
 
-    pos_forces = tree.compute_edge_forces(indices_p=indices_p, values_p=values_p, N=num_of_points)
-    for n in np.arange(num_of_points):
-        tree.compute_non_edge_forces(point_index=n, theta=theta, neg_force=neg_forces, sum_q=sum_q)
+def _compute_gradient_on_cpu_with_sptree(t_sne, indices_p, values_p=None, theta=0.5):
 
-    dy = pos_forces - (neg_forces / sum_q[0])
-
-    return dy
+    """
+    indices_p -- either the (N x k) knn indices (with values_p the (N x k) p values) or the csr P matrix
+    """
+    tree = sptree_flat.FlatSPTree(inp_data=t_sne)
 
+    pos_forces = tree.compute_edge_forces(indices_p, values_p)
+    neg_forces, sum_q = tree.compute_non_edge_forces(theta=theta)
 
-def run_iterations_with_python(iters, indices_p, values_p, num_samples, num_dims, eta, verbose):
+    dy = pos_forces - (neg_forces / sum_q)
 
-    momentum = 0.5
-    final_momentum = 0.8
-    exaggeration = 12.0
-    stop_lying_iter = 250
-    mom_switch_iter = 250
-
-    uy = np.zeros((num_samples, num_dims))
-    gains = np.ones((num_samples, num_dims))
+    return dy
 
-    # run loop
-    verbose_gradient = False
-    if verbose > 2:
-        verbose_gradient = True
 
-    # lie about p-values
-    values_p *= exaggeration
+def _evaluate_error(y, p, theta, sum_q=None):
+    """
+    Approximate KL divergence of the embedding y (sum_q from the Barnes-Hut tree), as the Barnes_Hut exe does it
+    """
+    if sum_q is None:
+        sum_q = sptree_flat.FlatSPTree(inp_data=y).compute_non_edge_forces(theta=theta)[1]
+    rows = np.repeat(np.arange(p.shape[0]), np.diff(p.indptr))
+    buffer = y[rows] - y[p.indices]
+    q = (1.0 / (1.0 + np.sum(buffer * buffer, axis=1))) / sum_q
+    flt_min = np.finfo(np.float32).tiny
+    return np.sum(p.data * np.log((p.data + flt_min) / (q + flt_min)))
+
+
+def run_iterations_with_python(y, p, theta=0.5, eta=200, iterations=1000, verbose=True, callback=None,
+                               exaggeration=12.0, stop_lying_iter=250, mom_switch_iter=250, momentum=0.5,
+                               final_momentum=0.8, error_every=50, checkpoint_file=None, checkpoint_every=50,
+                               max_checkpoint_overhead=0.05, samples_hash=None):
+    """
+    Barnes-Hut t-SNE gradient descent in this process (the same schedule as the Barnes_Hut exe).
+    The gradient is calculated on all cores by the numba functions of sptree_flat.
+
+    y -- (N x num_dims) initial embedding
+    p -- the symmetrised and normalised csr P matrix (see _compute_gaussian_perplexity_csr)
+    callback -- if not None it is called as callback(iteration, y, error) after every iteration. error is the KL
+    divergence, calculated every error_every iterations (and at the last one), None otherwise
+    checkpoint_file -- if not None the state of the optimizer is saved in it (see save_checkpoint) every
+    checkpoint_every iterations, unless saving took more than max_checkpoint_overhead of the time spent iterating
+    since the last save (then the save is put off to the next checkpoint_every). If the file exists the
+    optimization resumes from the iteration it was saved at (y and p are then taken from the file). The final state is
+    saved too, so running again with the same number of iterations returns the finished embedding
+    samples_hash -- the hash_samples of the data the embedding is made from. It is saved in the checkpoint and a
+    checkpoint of other data (a different hash or number of samples) is rejected with a ValueError
+    Returns the final embedding
+    """
+    start_iteration = 0
+    if checkpoint_file is not None and isfile(checkpoint_file):
+        checkpoint = load_checkpoint(checkpoint_file)
+        if y is not None and len(y) != len(checkpoint['y']):
+            raise ValueError('The checkpoint ' + checkpoint_file + ' has ' + str(len(checkpoint['y'])) +
+                             ' samples, not ' + str(len(y)) + '. Delete it to start a new run')
+        if samples_hash is not None and checkpoint.get('samples_hash') != samples_hash:
+            raise ValueError('The checkpoint ' + checkpoint_file + ' was made from different samples. '
+                             'Delete it to start a new run')
+        start_iteration = checkpoint['iteration']
+        y, p, uy, gains = checkpoint['y'], checkpoint['p'], checkpoint['uy'], checkpoint['gains']
+        if verbose:
+            print('Resuming from iteration ' + str(start_iteration) + ' of ' + checkpoint_file)
 
-    for it in np.arange(iters):
-        # compute_gradient
-        dy = gpu.compute_gradient_on_gpu(y, indices_p=indices_p, values_p=values_p, verbose=verbose_gradient)
-        # dy = _compute_gradient_on_cpu_with_sptree(y, indices_p=indices_p, values_p=values_p, theta=theta)
+    y = np.array(y, dtype=np.float64)
+    p = sparse.csr_matrix(p, dtype=np.float64, copy=True)
+    num_samples, num_dims = y.shape
+
+    if start_iteration == 0:
+        uy = np.zeros((num_samples, num_dims))
+        gains = np.ones((num_samples, num_dims))
+        if checkpoint_file is not None:
+            save_checkpoint(checkpoint_file, 0, y, uy, gains, p, samples_hash=samples_hash)
+
+    # lie about p-values (until stop_lying_iter, the same for the momentum)
+    if start_iteration <= stop_lying_iter:
+        p.data *= exaggeration
+    if start_iteration > mom_switch_iter:
+        momentum = final_momentum
+
+    s3 = time.time()
+    last_save = time.time()
+    save_duration = 0
+    for it in np.arange(start_iteration, iterations):
+        dy = _compute_gradient_on_cpu_with_sptree(y, p, theta=theta)
 
         # update gains
-        gains[np.argwhere(np.sign(dy) != np.sign(uy))] += 0.05
-        gains[np.argwhere(np.sign(dy) == np.sign(uy))] *= 0.95
-        gains[np.argwhere(gains < 0.01)] = 0.01
+        gains = np.where(np.sign(dy) != np.sign(uy), gains + 0.05, gains * 0.95)
+        gains[gains < 0.01] = 0.01
 
         # update gradient
         uy = momentum * uy - eta * gains * dy
         y += uy
 
         # zero mean solution
-        y = pylab.demean(y, axis=0)
+        y -= np.mean(y, axis=0)
 
         if it == stop_lying_iter:
-            values_p /= exaggeration
+            p.data /= exaggeration
         if it == mom_switch_iter:
             momentum = final_momentum
 
         # evaluate error and print progress
-        if it % 5 == 0 and verbose:
-            e3 = time.time()
-            print('Time for iteration ' + str(it) + ' = ' + str(e3 - s3))
-            s3 = time.time()
+        error = None
+        if (it > 0 and it % error_every == 0) or it == iterations - 1:
+            error = _evaluate_error(y, p / exaggeration if it < stop_lying_iter else p, theta)
+            if verbose:
+                e3 = time.time()
+                print('Iteration ' + str(it) + ': error is ' + str(error) + ' (' + str(error_every) +
+                      ' iterations in ' + str(e3 - s3) + ' seconds)')
+                s3 = time.time()
+
+        if callback is not None:
+            callback(it, y, error)
+
+        if checkpoint_file is not None and (it + 1) % checkpoint_every == 0 and it + 1 < iterations and \
+                save_duration <= max_checkpoint_overhead * (time.time() - last_save):
+            s4 = time.time()
+            save_checkpoint(checkpoint_file, it + 1, y, uy, gains, samples_hash=samples_hash)
+            last_save = time.time()
+            save_duration = last_save - s4
+
+    if checkpoint_file is not None and start_iteration < iterations:
+        # the complete state, so a rerun does not repeat the iterations since the last save
+        save_checkpoint(checkpoint_file, iterations, y, uy, gains, samples_hash=samples_hash)
+
+    return y
+
+
+def embed_new_samples(reference_data, reference_y, new_data, perplexity=100, theta=0.5, eta=200, iterations=250,
+                      momentum=0.5, final_momentum=0.8, mom_switch_iter=100, block_size=8192, verbose=True):
+    """
+    Places new samples in an existing t-sne embedding without recalculating it.
+    The reference embedding is held fixed (its Barnes-Hut tree is built once). The new samples get p values from their
+    knns amongst the reference samples, start at the p weighted mean of their neighbours' positions and only their
+    coordinates are optimised (with each new sample's repulsion normalised by its own sum_q).
+    A new sample's p values are a conditional distribution (they sum to 1) and its sum_q is over N points, so its
+    gradient is about N times the gradient of a sample in the full optimisation (where P and sum_q are over all the
+    pairs). The gradient is divided by N so eta is on the same scale as in run_iterations_with_python.
+
+    reference_data -- the (N x features) data the reference_y embedding was made from
+    reference_y -- the (N x num_dims) embedding
+    new_data -- (M x features) new samples, preprocessed in the same way as the reference_data
+    Returns the (M x num_dims) embedding of the new samples
+    """
+    reference_y = np.ascontiguousarray(reference_y, dtype=np.float64)
+    num_of_neighbours = min(3 * perplexity, len(reference_y))
+
+    s1 = time.time()
+    indices, distances = cpu._knns_of_tile(np.asarray(new_data, dtype=np.float32),
+                                           np.asarray(reference_data, dtype=np.float32),
+                                           num_of_neighbours, 0, block_size)
+    distances = np.sqrt(np.abs(distances))
+    indices_p, values_p = _compute_gaussian_perplexity(indices, distances, perplexity=perplexity)
+    e1 = time.time()
+    if verbose > 1:
+        print('Time for Knn distance and perplexity calculation: ' + str(e1 - s1))
+
+    y = np.einsum('ij,ijk->ik', values_p, reference_y[indices_p])
+
+    tree = sptree_flat.FlatSPTree(inp_data=reference_y)
+    num_of_reference_samples = len(reference_y)
+    uy = np.zeros(y.shape)
+    gains = np.ones(y.shape)
+    for it in np.arange(iterations):
+        pos_forces = tree.compute_edge_forces(indices_p, values_p, points=y)
+        neg_forces, sum_q = tree.compute_non_edge_forces_on(y, theta)
+        dy = (pos_forces - neg_forces / sum_q[:, np.newaxis]) / num_of_reference_samples
+
+        gains = np.where(np.sign(dy) != np.sign(uy), gains + 0.05, gains * 0.95)
+        gains[gains < 0.01] = 0.01
+
+        uy = momentum * uy - eta * gains * dy
+        y += uy
+
+        if it == mom_switch_iter:
+            momentum = final_momentum
+
+    if verbose > 1:
+        print('Time for embedding ' + str(len(y)) + ' new samples: ' + str(time.time() - s1))
 
     return y
 
+
+def _checkpoint_p_file(checkpoint_file):
+    return checkpoint_file + '.p.npz'
+
+
+def _atomic_write(filename, write_function):
+    """
+    Writes through write_function(file) into a temporary file that then replaces filename, so a crash while writing
+    never leaves a half written file behind
+    """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as file:
+        write_function(file)
+        file.flush()
+        fsync(file.fileno())
+    replace(temp_filename, filename)
+
+
+def hash_samples(samples):
+    """
+    A hash of the values, shape and type of the samples array, to tell if a checkpoint was made from them
+    """
+    samples = np.ascontiguousarray(samples)
+    samples_hash = hashlib.sha1(str((samples.shape, samples.dtype.str)).encode())
+    samples_hash.update(samples.view(np.uint8).ravel())
+    return samples_hash.hexdigest()
+
+
+def save_checkpoint(checkpoint_file, iteration, y, uy, gains, p=None, samples_hash=None):
+    """
+    Saves the state of run_iterations_with_python (the next iteration to run, the embedding y, the update vectors uy,
+    the gains and the hash of the samples if given) in checkpoint_file. The P matrix does not change during the
+    optimization so it is saved (if given) once in checkpoint_file + '.p.npz'
+    """
+    if p is not None:
+        _atomic_write(_checkpoint_p_file(checkpoint_file), lambda file: sparse.save_npz(file, p.tocsr()))
+    extra = {} if samples_hash is None else {'samples_hash': samples_hash}
+    _atomic_write(checkpoint_file, lambda file: np.savez(file, iteration=iteration, y=y, uy=uy, gains=gains,
+                                                         **extra))
+
+
+def load_checkpoint(checkpoint_file):
+    """
+    Returns a dictionary with the iteration, y, uy, gains, (un-exaggerated) p and (if it was saved) the samples_hash
+    saved by save_checkpoint
+    """
+    with np.load(checkpoint_file) as saved:
+        checkpoint = {key: saved[key] for key in saved.files}
+    checkpoint['iteration'] = int(checkpoint['iteration'])
+    if 'samples_hash' in checkpoint:
+        checkpoint['samples_hash'] = str(checkpoint['samples_hash'])
+    checkpoint['p'] = sparse.load_npz(_checkpoint_p_file(checkpoint_file))
+    return checkpoint
+
 '''
 def run_iterations_with_cython(Y, N, no_dims, col_P, val_P, K, perplexity, theta, eta, iterations, verbose):
     tsne = sptsne.SP_TSNE()
@@ -0,0 +1,45 @@
+
+"""
+Regression check of t_sne.embed_new_samples with the default eta: new samples of known clusters must end up (and
+stay after the optimisation) next to their cluster in the reference embedding.
+
+With the gradient not scaled by the number of reference samples the default eta threw most new samples away from
+good starting positions (median distance to their cluster's centre 11, max 687, only 28% within 10).
+"""
+import numpy as np
+from tsne_for_spikesort import t_sne
+
+
+def check_embed_new_samples(num_of_reference_samples=4000, num_of_new_samples=300, num_of_clusters=5,
+                            num_of_features=20, perplexity=30, iterations=250, max_distance=10,
+                            min_fraction_close=0.95, seed=0):
+    np.random.seed(seed)
+    centres_hd = np.random.randn(num_of_clusters, num_of_features) * 10
+    # the clusters' centres in the reference embedding, 30 apart
+    centres_y = np.stack([np.arange(num_of_clusters) * 30.0, np.zeros(num_of_clusters)], axis=1)
+    centres_y -= np.mean(centres_y, axis=0)
+
+    reference_clusters = np.random.randint(num_of_clusters, size=num_of_reference_samples)
+    reference_data = centres_hd[reference_clusters] + np.random.randn(num_of_reference_samples, num_of_features)
+    reference_y = centres_y[reference_clusters] + np.random.randn(num_of_reference_samples, 2)
+
+    new_clusters = np.random.randint(num_of_clusters, size=num_of_new_samples)
+    new_data = centres_hd[new_clusters] + np.random.randn(num_of_new_samples, num_of_features)
+
+    distances = {}
+    for name, its in [('start', 0), ('optimised', iterations)]:
+        new_y = t_sne.embed_new_samples(reference_data, reference_y, new_data, perplexity=perplexity,
+                                        iterations=its, verbose=0)
+        distances[name] = np.linalg.norm(new_y - centres_y[new_clusters], axis=1)
+        print(name + ': median distance to the cluster centre ' + str(np.median(distances[name])) + ', max ' +
+              str(np.max(distances[name])) + ', within ' + str(max_distance) + ' ' +
+              str(np.mean(distances[name] < max_distance)))
+
+    assert np.mean(distances['start'] < max_distance) >= min_fraction_close
+    assert np.mean(distances['optimised'] < max_distance) >= min_fraction_close, \
+        'The optimisation moved the new samples away from their clusters'
+    assert np.median(distances['optimised']) < 2 * max(np.median(distances['start']), 1)
+
+
+if __name__ == '__main__':
+    check_embed_new_samples()